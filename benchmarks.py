@@ -0,0 +1,593 @@
+"""
+Micro-benchmarks of data/model hot paths against synthetic inputs (no dataset or model downloads needed)
+- usage: python benchmarks.py <benchmark name>, e.g. python benchmarks.py encode
+- heavy framework imports are done inside each benchmark so that e.g. torch benchmarks don't need tensorflow
+"""
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+
+SEED = 1337
+NUM_STRINGS = 100000  # size of the synthetic comment corpus
+NUM_WORDS = 30000  # size of the synthetic word list (and WordPiece vocab)
+MAX_SEQ_LEN = 200
+MAX_CORES = 24
+
+
+def synthetic_words(num_words=NUM_WORDS, seed=SEED):
+    """ Random lower-case 'words' of 2-12 characters """
+    rng = np.random.RandomState(seed)
+    letters = np.array(list('abcdefghijklmnopqrstuvwxyz'))
+    return sorted({''.join(rng.choice(letters, rng.randint(2, 13))) for _ in range(num_words)})
+
+
+def synthetic_corpus(num_strings=NUM_STRINGS, words=None, seed=SEED):
+    """
+    Comments of Zipf-distributed words w/ log-normal lengths (mostly short, long tail up to ~500 words)
+    """
+    rng = np.random.RandomState(seed)
+    words = synthetic_words() if words is None else words
+    lengths = np.clip(rng.lognormal(mean=3.3, sigma=0.9, size=num_strings).astype(int), 1, 500)
+    word_ids = np.minimum(rng.zipf(1.3, size=lengths.sum()) - 1, len(words) - 1)
+    splits = np.split(word_ids, np.cumsum(lengths)[:-1])
+    return [' '.join(words[i] for i in comment) for comment in splits]
+
+
+def synthetic_bert_tokenizers(words):
+    """
+    (slow, fast) BERT tokenizer pair built from a temporary vocab file of words and their ## suffixes
+    """
+    from transformers import BertTokenizer, BertTokenizerFast
+    vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + list('abcdefghijklmnopqrstuvwxyz') + \
+            ['##' + x for x in 'abcdefghijklmnopqrstuvwxyz'] + words
+    vocab_path = os.path.join(tempfile.mkdtemp(), 'vocab.txt')
+    with open(vocab_path, 'w') as f:
+        f.write('\n'.join(vocab))
+    return BertTokenizer(vocab_path), BertTokenizerFast(vocab_path)
+
+
+def report(name, num_rows, elapsed, unit='strings'):
+    print('{:<40s} {:>10.2f}s {:>12.0f} {}/sec'.format(name, elapsed, num_rows / elapsed, unit))
+
+
+def benchmark_encode():
+    """ Per-string multiprocessing map (classifier_baseline before batching) vs encode_strings """
+    import multiprocessing as mp
+    from functools import partial
+    from preprocessor import encode_strings
+
+    words = synthetic_words()
+    corpus = synthetic_corpus(words=words)
+    slow_tokenizer, fast_tokenizer = synthetic_bert_tokenizers(words)
+
+    start_time = time.time()
+    encode_partial = partial(slow_tokenizer.encode,
+                             truncation=True,
+                             max_length=MAX_SEQ_LEN,
+                             pad_to_max_length=True,
+                             add_special_tokens=True)
+    with mp.Pool(MAX_CORES) as p:
+        baseline_ids = np.array(p.map(encode_partial, corpus))
+    report('p.map(tokenizer.encode)', len(corpus), time.time() - start_time)
+
+    start_time = time.time()
+    slow_ids = encode_strings(corpus, slow_tokenizer, MAX_SEQ_LEN, num_workers=MAX_CORES)
+    report('encode_strings (slow, chunked MP)', len(corpus), time.time() - start_time)
+
+    start_time = time.time()
+    fast_ids = encode_strings(corpus, fast_tokenizer, MAX_SEQ_LEN)
+    report('encode_strings (fast, batched)', len(corpus), time.time() - start_time)
+
+    print('slow IDs match baseline: {}, fast IDs match baseline: {}'.format((slow_ids == baseline_ids).all(),
+                                                                            (fast_ids == baseline_ids).all()))
+    print('baseline array: {:.0f}MB, encode_strings array: {:.0f}MB'.format(baseline_ids.nbytes / 2 ** 20,
+                                                                            fast_ids.nbytes / 2 ** 20))
+
+
+def benchmark_vocab():
+    """ keras Tokenizer fit/texts_to_sequences/pad_sequences (BiGRU before) vs preprocessor.VocabTokenizer """
+    from tensorflow.keras.preprocessing.text import Tokenizer
+    from tensorflow.keras.preprocessing.sequence import pad_sequences
+    from preprocessor import VocabTokenizer
+
+    rng = np.random.RandomState(SEED)
+    # capitalized words and punctuation exercise the keras lower-casing and filters
+    corpus = [x.capitalize() + rng.choice(['', '.', '!', ' ?', ', ok']) for x in synthetic_corpus(1000000)]
+    vocab_size = 100000
+
+    start_time = time.time()
+    keras_tokenizer = Tokenizer(num_words=vocab_size)
+    keras_tokenizer.fit_on_texts(corpus)
+    keras_sequences = pad_sequences(keras_tokenizer.texts_to_sequences(corpus), maxlen=MAX_SEQ_LEN)
+    report('keras Tokenizer + pad_sequences', len(corpus), time.time() - start_time)
+
+    start_time = time.time()
+    vocab_tokenizer = VocabTokenizer(num_words=vocab_size, num_workers=MAX_CORES)
+    vocab_tokenizer.fit_on_texts(corpus)
+    vocab_sequences = vocab_tokenizer.texts_to_padded_sequences(corpus, MAX_SEQ_LEN)
+    report('VocabTokenizer ({} processes)'.format(MAX_CORES), len(corpus), time.time() - start_time)
+
+    print('word index matches keras: {}, sequences match keras: {}'.format(
+        vocab_tokenizer.word_index == keras_tokenizer.word_index,
+        (vocab_sequences == keras_sequences).all()))
+
+
+def synthetic_padded_sequences(num_rows, vocab_size, seed=SEED):
+    """ Pre-padded [num_rows, MAX_SEQ_LEN] int32 token IDs w/ the log-normal comment lengths of synthetic_corpus """
+    rng = np.random.RandomState(seed)
+    lengths = np.clip(rng.lognormal(mean=3.3, sigma=0.9, size=num_rows).astype(int), 1, MAX_SEQ_LEN)
+    sequences = np.zeros((num_rows, MAX_SEQ_LEN), dtype=np.int32)
+    for row, length in enumerate(lengths):
+        sequences[row, MAX_SEQ_LEN - length:] = rng.randint(1, vocab_size, length)
+    return sequences
+
+
+def benchmark_bigru():
+    """ BiGRU epoch + test predict time: batches padded to MAX_SEQ_LEN vs the bucketed tf.data pipeline """
+    import classifier_bigru_fasttext_tf as bigru
+
+    num_rows, vocab_size = 50000, 20000
+    rng = np.random.RandomState(SEED)
+    features = synthetic_padded_sequences(num_rows, vocab_size)
+    labels = (rng.rand(num_rows) < 0.1).astype(np.float32)
+    embedding_matrix = rng.randn(vocab_size, bigru.EMBEDDING_DIMS).astype(np.float32)
+
+    for bucketed_input in [False, True]:
+        bigru.BUCKETED_INPUT = bucketed_input
+        classifier = bigru.build_classifier_model(embedding_matrix)
+        classifier.compile(optimizer='adam', loss='binary_crossentropy')
+        name = 'bucketed tf.data' if bucketed_input else 'padded to {}'.format(bigru.MAX_SEQ_LEN)
+
+        start_time = time.time()
+        if bucketed_input:
+            classifier.fit(bigru.make_bucketed_dataset(features, labels), epochs=1, verbose=0)
+        else:
+            classifier.fit(features, labels, batch_size=bigru.BATCH_SIZE, epochs=1, verbose=0)
+        report('train epoch - {}'.format(name), num_rows, time.time() - start_time, unit='rows')
+
+        start_time = time.time()
+        if bucketed_input:
+            bigru.predict_length_sorted(classifier, features)
+        else:
+            classifier.predict(features, batch_size=bigru.BATCH_SIZE)
+        report('predict - {}'.format(name), num_rows, time.time() - start_time, unit='rows')
+
+
+def tiny_bert_classifier(baseline, vocab_size, hidden_size=128, seed=SEED):
+    """ classifier_baseline.ClassifierHead on a randomly initialized 2-layer BERT """
+    import torch
+    from transformers import BertConfig, BertModel
+
+    torch.manual_seed(seed)
+    config = BertConfig(vocab_size=vocab_size, hidden_size=hidden_size, num_hidden_layers=2,
+                        num_attention_heads=2, intermediate_size=4 * hidden_size, max_position_embeddings=256)
+    baseline.BASE_MODEL_OUTPUT_DIM = hidden_size
+    return baseline.ClassifierHead(BertModel(config))
+
+
+def benchmark_cpu_train():
+    """
+    classifier_baseline.train epoch on CPU w/ a tiny randomly initialized BERT: float32 vs bfloat16 autocast
+    - also runs ACCUM_FOR=2 at half the batch size, which should reach a similar loss
+    """
+    import torch
+    import classifier_baseline as baseline
+    from torch_helpers import TrainingBackend
+
+    num_rows, vocab_size = 4096, 5000
+    rng = np.random.RandomState(SEED)
+    features = synthetic_padded_sequences(num_rows, vocab_size)[:, ::-1].copy()  # right-padded like BERT inputs
+    labels = (rng.rand(num_rows) < 0.1).astype(np.float32)
+    baseline.LOG_INTERVAL = 10 ** 9  # only sync the loss at the end of the epoch
+
+    for mixed_precision, batch_size, accum_for in [(False, 32, 1), (True, 32, 1), (True, 16, 2)]:
+        classifier = tiny_bert_classifier(baseline, vocab_size)
+        opt = torch.optim.Adam(classifier.parameters(), lr=1e-4)
+        baseline.BACKEND = TrainingBackend('cpu', mixed_precision)
+        baseline.BATCH_SIZE, baseline.ACCUM_FOR = batch_size, accum_for
+        classifier, opt = baseline.BACKEND.prepare(classifier, opt)
+
+        start_time = time.time()
+        baseline.train(classifier, [features, labels, None], torch.nn.BCELoss(), opt, 1, 0)
+        report('{} BS={} ACCUM_FOR={}'.format('bfloat16' if mixed_precision else 'float32', batch_size, accum_for),
+               num_rows, time.time() - start_time, unit='rows')
+
+
+def _per_tensor_lr_groups(model, base_lr, decay_factor):
+    """ torch_helpers.layerwise_lr_decay before grouping: 1 param group per tensor """
+    import re
+    decayed_lr_params = []
+    max_num = None
+    for name, param in reversed(list(model.named_parameters())):
+        try:
+            if 'base_model' not in name:
+                block_lr = base_lr
+            else:
+                if 'layer' in name:
+                    block_num = int(re.findall(r'\d+', name)[0]) + 1
+                    if max_num is None:
+                        max_num = block_num
+                else:
+                    block_num = 0
+                block_lr = base_lr * decay_factor ** (max_num - block_num)
+        except:
+            block_lr = base_lr
+        decayed_lr_params.append({'params': param, 'lr': block_lr})
+    return decayed_lr_params
+
+
+def benchmark_lr_groups():
+    """
+    Adam step time w/ layerwise LR decay on a 24-block BERT-shaped classifier (# tensors of XLM-R large):
+    1 param group per tensor vs torch_helpers.layerwise_lr_decay groups + multi-tensor Adam
+    """
+    import torch
+    from transformers import BertConfig, BertModel
+    import classifier_baseline as baseline
+    from torch_helpers import layerwise_lr_decay, multi_tensor_adam
+
+    hidden_size, num_steps = 256, 20
+    baseline.BASE_MODEL_OUTPUT_DIM = hidden_size
+    classifier = baseline.ClassifierHead(BertModel(BertConfig(vocab_size=30000, hidden_size=hidden_size,
+                                                              num_hidden_layers=24, num_attention_heads=4,
+                                                              intermediate_size=4 * hidden_size)))
+    for param in classifier.parameters():
+        param.grad = torch.randn_like(param) * 1e-3
+
+    per_tensor_groups = _per_tensor_lr_groups(classifier, 1e-5, 0.95)
+    block_groups = layerwise_lr_decay(classifier, 1e-5, 0.95)
+    per_tensor_lrs = {id(group['params']): group['lr'] for group in per_tensor_groups}
+    block_lrs = {id(param): group['lr'] for group in block_groups for param in group['params']}
+    print('{} tensors: {} per-tensor groups -> {} block groups, same LR per tensor: {}'.format(
+        len(per_tensor_lrs), len(per_tensor_groups), len(block_groups),
+        all(np.isclose(per_tensor_lrs[x], block_lrs[x]) for x in per_tensor_lrs)))
+
+    for name, opt in [('per-tensor groups, Adam', torch.optim.Adam(per_tensor_groups, lr=1e-5)),
+                      ('block groups, Adam', torch.optim.Adam(block_groups, lr=1e-5)),
+                      ('block groups, multi-tensor', multi_tensor_adam(block_groups, 1e-5))]:
+        opt.step()  # warm-up (allocates the Adam state)
+        start_time = time.time()
+        for _ in range(num_steps):
+            opt.step()
+        report('opt.step() - {}'.format(name), num_steps, time.time() - start_time, unit='steps')
+
+
+def _per_tensor_swa_update(swa_buffers, params, n_avg):
+    """ swa.SWA.update_swa_group before the multi-tensor rewrite """
+    for p, buf in zip(params, swa_buffers):
+        virtual_decay = 1 / float(n_avg + 1)
+        diff = (p.data - buf) * virtual_decay
+        buf.add_(diff)
+
+
+def _per_tensor_swa_swap(swa_buffers, params):
+    """ swa.SWA.swap_swa_sgd before the multi-tensor rewrite """
+    import torch
+    for p, buf in zip(params, swa_buffers):
+        tmp = torch.empty_like(p.data)
+        tmp.copy_(p.data)
+        p.data.copy_(buf)
+        buf.copy_(tmp)
+
+
+def synthetic_transformer_params(num_blocks=24, hidden_size=256, seed=SEED):
+    """ fp32 parameter tensors shaped like a BERT encoder's (16 per block) - 384 tensors by default """
+    import torch
+    torch.manual_seed(seed)
+    block_shapes = [(hidden_size, hidden_size), (hidden_size,)] * 4 + [(hidden_size,)] * 2 + \
+                   [(4 * hidden_size, hidden_size), (4 * hidden_size,), (hidden_size, 4 * hidden_size),
+                    (hidden_size,), (hidden_size,), (hidden_size,)]
+    return [torch.nn.Parameter(torch.randn(shape)) for _ in range(num_blocks) for shape in block_shapes]
+
+
+def benchmark_swa():
+    """
+    SWA update/swap: per-tensor loops (before) vs multi-tensor ops vs flattened group buffers (flatten=True)
+    - checks that the averages and swapped params are bit-identical to the per-tensor loops
+    """
+    import torch
+    from swa import SWA
+
+    num_updates = 20
+    params = synthetic_transformer_params()
+    param_steps = [[torch.randn_like(p) * 1e-2 for p in params] for _ in range(num_updates)]
+
+    def run_updates(update_fn):
+        with torch.no_grad():
+            for p, p0 in zip(params, initial_params):
+                p.copy_(p0)
+        elapsed = 0.
+        for step in range(num_updates):
+            with torch.no_grad():
+                torch._foreach_add_(params, param_steps[step])
+            start_time = time.time()
+            update_fn(step)
+            elapsed += time.time() - start_time
+        return elapsed
+
+    initial_params = [p.detach().clone() for p in params]
+    per_tensor_buffers = [torch.zeros_like(p) for p in params]
+    elapsed = run_updates(lambda step: _per_tensor_swa_update(per_tensor_buffers, params, step))
+    report('update - per-tensor ({} tensors)'.format(len(params)), num_updates, elapsed, unit='updates')
+    start_time = time.time()
+    _per_tensor_swa_swap(per_tensor_buffers, params)
+    report('swap - per-tensor', 1, time.time() - start_time, unit='swaps')
+    per_tensor_params = [p.detach().clone() for p in params]
+
+    for flatten in [False, True]:
+        opt = SWA(torch.optim.SGD(params, lr=0.), flatten=flatten)
+        elapsed = run_updates(lambda step: opt.update_swa())
+        name = 'flattened' if flatten else 'multi-tensor'
+        report('update - {}'.format(name), num_updates, elapsed, unit='updates')
+        start_time = time.time()
+        opt.swap_swa_sgd()
+        report('swap - {}'.format(name), 1, time.time() - start_time, unit='swaps')
+        print('bit-identical averages: {}, bit-identical swapped params: {}'.format(
+            all(torch.equal(opt.state[p]['swa_buffer'], x) for p, x in zip(params, per_tensor_buffers)),
+            all(torch.equal(p, x) for p, x in zip(params, per_tensor_params))))
+
+
+def benchmark_swa_offload():
+    """
+    SWA buffer placement/precision: time spent in update_swa() calls (async updates return early), memory of the
+    averages, of the staging copies of the params and of the float32 accumulation scratch, and the averages' mean abs
+    deviation from float32 averages kept next to the params
+    - bfloat16 averages are stochastically rounded; round-to-nearest would drop the small late updates
+    """
+    import torch
+    from swa import SWA
+
+    num_updates = 100
+    params = synthetic_transformer_params(num_blocks=6)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    params = [torch.nn.Parameter(p.data.to(device)) for p in params]
+    options = [('float32, param device', {}),
+               ('float32, host, async', {'swa_device': 'cpu', 'async_update': True}),
+               ('bfloat16, param device', {'swa_dtype': torch.bfloat16}),
+               ('bfloat16, host, async', {'swa_device': 'cpu', 'swa_dtype': torch.bfloat16, 'async_update': True})]
+    opts = [SWA(torch.optim.SGD(params, lr=0.), **kwargs) for _, kwargs in options]
+
+    def tensors_mb(tensors):
+        return sum(x.numel() * x.element_size() for x in tensors) / 2 ** 20
+    elapsed = [0.] * len(opts)
+    torch.manual_seed(SEED)
+    for _ in range(num_updates):
+        with torch.no_grad():
+            torch._foreach_add_(params, [torch.randn_like(p) * 1e-2 for p in params])
+        for i, opt in enumerate(opts):
+            start_time = time.time()
+            opt.update_swa()
+            elapsed[i] += time.time() - start_time
+        for opt in opts:  # stands in for the training steps the background updates overlap w/
+            opt.wait_swa_update()
+
+    for (name, _), opt, opt_elapsed in zip(options, opts, elapsed):
+        bufs = [opt.state[p]['swa_buffer'] for p in params]
+        deviation = torch.cat([(b.to(device).float() - opts[0].state[p]['swa_buffer']).abs().flatten()
+                               for p, b in zip(params, bufs)]).mean().item()
+        report('update - {}'.format(name), num_updates, opt_elapsed, unit='updates')
+        print('    averages on {}: {:.1f}MB, staging: {:.1f}MB, scratch: {:.1f}MB, mean abs deviation: {:.2e}'.format(
+            bufs[0].device, tensors_mb(bufs), tensors_mb(getattr(opt, '_staging', {}).values()),
+            tensors_mb(getattr(opt, '_scratch', {}).values()), deviation))
+
+    # checkpoint round trip: load into a new SWA, swap in the averages (evaluate), then swap the live params back
+    live_params = [p.detach().clone() for p in params]
+    for (name, kwargs), opt in zip(options, opts):
+        loaded_opt = SWA(torch.optim.SGD(params, lr=0.), **kwargs)
+        loaded_opt.load_state_dict(opt.state_dict())
+        loaded_opt.swap_swa_sgd()
+        swapped_in = all(torch.equal(p, opt.state[p]['swa_buffer'].to(p.device, p.dtype)) for p in params)
+        loaded_opt.swap_swa_sgd()
+        print('load -> swap -> swap - {}: averages swapped in: {}, live params restored: {}'.format(
+            name, swapped_in, all(torch.equal(p, x) for p, x in zip(params, live_params))))
+
+
+def _per_token_mask_tokens(inputs, tokenizer, mlm_prob=0.15):
+    """ torch_helpers.mask_tokens before MaskedLMCollator: per-token Python masks (w/o its .cuda() random words) """
+    import torch
+    labels = inputs.clone()
+    probability_matrix = torch.full(labels.shape, mlm_prob)
+    special_tokens_mask = [
+        tokenizer.get_special_tokens_mask(val, already_has_special_tokens=True) for val in labels.tolist()
+    ]
+    pad_tokens_mask = [[1 if x == tokenizer.pad_token_id else 0 for x in val] for val in labels.tolist()]
+    probability_matrix.masked_fill_(torch.tensor(special_tokens_mask, dtype=torch.bool), value=0.0)
+    probability_matrix.masked_fill_(torch.tensor(pad_tokens_mask, dtype=torch.bool), value=0.0)
+    masked_indices = torch.bernoulli(probability_matrix).bool()
+    labels[~masked_indices] = -100
+    indices_replaced = torch.bernoulli(torch.full(labels.shape, 0.8)).bool() & masked_indices
+    inputs[indices_replaced] = tokenizer.mask_token_id
+    indices_random = torch.bernoulli(torch.full(labels.shape, 0.5)).bool() & masked_indices & ~indices_replaced
+    random_words = torch.randint(len(tokenizer), labels.shape, dtype=torch.long)
+    inputs[indices_random] = random_words[indices_random]
+    return inputs, labels
+
+
+def benchmark_mlm():
+    """
+    MLM masking of dynamically padded (length-bucketed, trimmed) batches: per-token mask_tokens (before) vs
+    MaskedLMCollator - tokens/sec, and the fraction of non-special tokens that get predicted, replaced by [MASK],
+    replaced by a random word (which should be ~15%, ~80% and ~10% of the predicted tokens for both)
+    """
+    import torch
+    from torch_helpers import length_bucketed_batches, trim_batch, MaskedLMCollator
+
+    num_rows, vocab_size = 8192, 5000
+    tokenizer, _ = synthetic_bert_tokenizers(synthetic_words(vocab_size))
+    features = synthetic_padded_sequences(num_rows, len(tokenizer))[:, ::-1].copy()  # right-padded like BERT inputs
+    lengths = (features != tokenizer.pad_token_id).sum(axis=1)
+    batches = [trim_batch(features, lengths, x)[0].long()
+               for x in length_bucketed_batches(lengths, 32, rng=np.random.RandomState(SEED))]
+    is_special = torch.zeros(len(tokenizer), dtype=torch.bool)
+    is_special[tokenizer.all_special_ids] = True
+
+    collator = MaskedLMCollator(tokenizer)
+    for name, mask_fn in [('per-token mask_tokens', lambda x: _per_token_mask_tokens(x, tokenizer)),
+                          ('MaskedLMCollator', collator)]:
+        torch.manual_seed(SEED)
+        counts = np.zeros(4)  # candidate tokens, predicted, [MASK], random word
+        elapsed = 0.
+        for batch in batches:
+            start_time = time.time()
+            inputs, labels = mask_fn(batch.clone())
+            elapsed += time.time() - start_time
+            predicted = labels != -100
+            counts += [(~is_special[batch]).sum().item(), predicted.sum().item(),
+                       (predicted & (inputs == tokenizer.mask_token_id)).sum().item(),
+                       (predicted & (inputs != tokenizer.mask_token_id) & (inputs != batch)).sum().item()]
+        report(name, lengths.sum(), elapsed, unit='tokens')
+        print('predicted: {:.4f}, [MASK]: {:.4f}, random word: {:.4f}'.format(
+            counts[1] / counts[0], counts[2] / counts[1], counts[3] / counts[1]))
+
+
+def _per_substring_tokenize(vocab, text, unk_token='[UNK]', max_input_chars_per_word=100, dropout=0.1):
+    """ preprocessor.tokenize before StochasticWordpiece: substring join + dict lookup per candidate end """
+    from random import random
+    output_tokens = []
+    for token in text.split():
+        chars = list(token)
+        if len(chars) > max_input_chars_per_word:
+            output_tokens.append(unk_token)
+            continue
+        is_bad = False
+        start = 0
+        sub_tokens = []
+        while start < len(chars):
+            end = len(chars)
+            cur_substr = None
+            while start < end:
+                substr = "".join(chars[start:end])
+                if start > 0:
+                    substr = "##" + substr
+                if substr in vocab and random() > dropout:
+                    cur_substr = substr
+                    break
+                end -= 1
+            if cur_substr is None:
+                is_bad = True
+                break
+            sub_tokens.append(cur_substr)
+            start = end
+        if is_bad:
+            output_tokens.append(unk_token)
+        else:
+            output_tokens.extend(sub_tokens)
+    return output_tokens
+
+
+def benchmark_wordpiece():
+    """
+    Stochastic WordPiece over a few augmentation epochs: per-substring tokenize (before) vs StochasticWordpiece
+    - vocab of words, ## suffixes of every 3rd word and single letters, so dropped hits fall back to shorter pieces
+    - tokens per word and [UNK] rate of each over the epochs
+    - timing only - test_preprocessor.py checks tokens, segmentation distributions and dropout seeding
+    """
+    import random
+    from preprocessor import StochasticWordpiece
+
+    num_epochs = 3
+    words = synthetic_words()
+    vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + list('abcdefghijklmnopqrstuvwxyz') + \
+            ['##' + x for x in 'abcdefghijklmnopqrstuvwxyz'] + words + ['##' + x[len(x) // 2:] for x in words[::3]]
+    vocab = {x: i for i, x in enumerate(dict.fromkeys(vocab))}
+    # out-of-vocab characters exercise the [UNK] fallback
+    corpus = [x + ' ' + x[::-1].upper()[:3] if i % 10 == 0 else x
+              for i, x in enumerate(synthetic_corpus(20000, words=words))]
+    num_words = sum(len(x.split()) for x in corpus)
+
+    random.seed(SEED)
+    wordpiece = StochasticWordpiece(vocab, seed=SEED)
+    for name, tokenize_batch in [('per-substring tokenize', lambda x: [_per_substring_tokenize(vocab, y) for y in x]),
+                                 ('StochasticWordpiece.tokenize_batch', wordpiece.tokenize_batch)]:
+        num_tokens, num_unk = 0, 0
+        elapsed = 0.
+        for _ in range(num_epochs):
+            start_time = time.time()
+            epoch_tokens = tokenize_batch(corpus)
+            elapsed += time.time() - start_time
+            num_tokens += sum(len(x) for x in epoch_tokens)
+            num_unk += sum(x.count('[UNK]') for x in epoch_tokens)
+        report(name, num_epochs * len(corpus), elapsed)
+        print('tokens per word: {:.4f}, [UNK] rate: {:.4f}'.format(num_tokens / (num_epochs * num_words),
+                                                                   num_unk / num_tokens))
+
+
+def _ddp_worker(rank, world_size, port, features, labels):
+    """ 1 rank of benchmark_ddp: trains an epoch w/ ACCUM_FOR=2, then checks weights and gathered predictions """
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port), WORLD_SIZE=str(world_size), RANK=str(rank))
+    import torch
+    import torch.distributed as dist
+    from torch.nn.parallel import DistributedDataParallel
+    import classifier_baseline as baseline
+    from torch_helpers import init_distributed, TrainingBackend, predict_probs, get_sequence_lengths
+
+    init_distributed('gloo')
+    torch.set_num_threads(max(1, os.cpu_count() // world_size))
+    baseline.LOG_INTERVAL = 10 ** 9
+    baseline.BATCH_SIZE, baseline.ACCUM_FOR = 16, 2
+    baseline.BACKEND = TrainingBackend('cpu', mixed_precision=False)
+    baseline.PROFILER.output_path = None
+
+    classifier = tiny_bert_classifier(baseline, int(features.max()) + 1)
+    opt = torch.optim.Adam(classifier.parameters(), lr=1e-4)
+    classifier, opt = baseline.BACKEND.prepare(classifier, opt)
+    if world_size > 1:
+        classifier = DistributedDataParallel(classifier, find_unused_parameters=True)
+
+    start_time = time.time()
+    baseline.train(classifier, [features, labels, None], torch.nn.BCELoss(), opt, 0, 0)
+    elapsed = time.time() - start_time
+    preds = baseline.predict_sharded(classifier, features, 0)
+
+    # every rank should end the epoch w/ the same weights
+    model = getattr(classifier, 'module', classifier)
+    checksums = torch.stack([p.detach().double().sum() for p in model.parameters()])
+    all_checksums = [torch.zeros_like(checksums) for _ in range(world_size)]
+    if world_size > 1:
+        dist.all_gather(all_checksums, checksums)
+    else:
+        all_checksums = [checksums]
+
+    if rank == 0:
+        report('train epoch - {} rank(s)'.format(world_size), len(features), elapsed, unit='rows')
+        full_preds = predict_probs(model, features, get_sequence_lengths(features, 0), baseline.BATCH_SIZE)
+        print('weights equal across ranks: {}, gathered preds match 1-process predict: {}'.format(
+            all(torch.equal(all_checksums[0], x) for x in all_checksums),
+            np.allclose(preds, full_preds, atol=1e-5)))
+    if world_size > 1:
+        dist.destroy_process_group()
+
+
+def benchmark_ddp():
+    """
+    Data-parallel classifier_baseline.train over local gloo processes (1 vs 2 ranks) on a tiny random BERT
+    - the cores are split evenly between the ranks
+    """
+    import torch.multiprocessing as mp
+
+    num_rows, vocab_size = 4096, 5000
+    rng = np.random.RandomState(SEED)
+    features = synthetic_padded_sequences(num_rows, vocab_size)[:, ::-1].copy()
+    labels = (rng.rand(num_rows) < 0.1).astype(np.float32)
+    for port, world_size in enumerate([1, 2], 29511):
+        mp.spawn(_ddp_worker, args=(world_size, port, features, labels), nprocs=world_size)
+
+
+BENCHMARKS = {'encode': benchmark_encode,
+              'vocab': benchmark_vocab,
+              'bigru': benchmark_bigru,
+              'cpu_train': benchmark_cpu_train,
+              'ddp': benchmark_ddp,
+              'lr_groups': benchmark_lr_groups,
+              'swa': benchmark_swa,
+              'swa_offload': benchmark_swa_offload,
+              'mlm': benchmark_mlm,
+              'wordpiece': benchmark_wordpiece}
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print('usage: python benchmarks.py [{}]'.format('|'.join(BENCHMARKS)))
+        sys.exit(1)
+    BENCHMARKS[sys.argv[1]]()
@@ -2,35 +2,57 @@
 Baseline PyTorch classifier using a pretrained HuggingFace Transformer model
 - Run prepare_data.py prior to generate the prerequisite training files
 - Classifier head on-top of the 1st token of the last hidden layer from the base pretrained model
-- Uses APEX mixed precision (FP16) training
+- Uses APEX mixed precision (FP16) training on CUDA if apex is installed, else torch.autocast (FP16 w/ loss scaling)
+- trains on CPU-only machines w/ bfloat16 autocast (DEVICE/MIXED_PRECISION), w/ NUM_THREADS/CPU_AFFINITY thread config
+- data-parallel training over several processes (DistributedDataParallel, DIST_BACKEND) when launched w/ torchrun, e.g.,
+  torchrun --nproc_per_node=4 classifier_baseline.py - each rank trains on its shard of every epoch's batches and
+  predicts its shard of rows, rank 0 gathers the predictions and writes all outputs
 - Allows for gradient accumulation with the ACCUM_FOR flag
 - checkpoint ensembling by predicting the test-set every epoch (saves to $PREDICTION_DIR/{EPOCH_NUM}.csv)
+- saves validation predictions of the epochs not trained against the val dataset to $VAL_PREDICTION_DIR/{EPOCH_NUM}.csv
+  (used to search blend weights in prepare_predictions.py)
 - Given NUM_EPOCHS, trains against the train dataset for half the epochs, and the val dataset for remaining half
 - for preprocessing comments, truncates adjacent whitespaces to a single whitespace
+- dynamic padding: batches group rows of similar length, get trimmed to their longest row and use an attention mask
+- saves the fine-tuned classifier to MODEL_OUTPUT_DIR (if set) for CPU scoring w/ predict_cpu.py
+- caches encoded token IDs on disk (int32) in $TOKEN_CACHE_DIR - only new/changed strings are re-encoded
+- PROFILE appends per-stage timings, samples/tokens per sec and peak memory to $PROFILE_DIR/classifier_baseline.jsonl
+  (see profiling.py), PROFILE_STEPS captures a torch.profiler trace of some 1st epoch steps in $PROFILE_DIR/trace/
 """
 import json
 import os
 import time
-from random import shuffle
+import contextlib
 from functools import partial
-import multiprocessing as mp
 import pandas as pd
 import numpy as np
 import torch
-from transformers import AutoTokenizer, AutoModel, AutoConfig
-from sklearn.metrics import roc_auc_score
-from apex import amp
-from tqdm import trange
-from preprocessor import get_id_text_label_from_csv, get_id_text_from_test_csv
+from torch.nn.parallel import DistributedDataParallel
+from transformers import AutoTokenizer, AutoModel, AutoConfig, WEIGHTS_NAME
+try:
+    from apex import amp
+except ImportError:  # apex is only needed for training - loading ClassifierHead for CPU scoring works without it
+    amp = None
+from tqdm import tqdm
+from preprocessor import get_id_text_label_from_csv, get_id_text_from_test_csv, TokenCache, encode_strings
+from scoring import fast_roc_auc
+from profiling import RunProfiler
+from torch_helpers import get_sequence_lengths, length_bucketed_batches, predict_probs, save_model, BatchPrefetcher, \
+    RunningMetrics, peak_tensor_memory_mb, step_profiler, TrainingBackend, configure_cpu_threads, init_distributed, \
+    get_rank, get_world_size, shard_batches, gather_predictions, layerwise_lr_decay, multi_tensor_adam, EMA
 
 with open('SETTINGS.json') as f:
     SETTINGS_DICT = json.load(f)
 
 PRETRAINED_MODEL = 'mrm8488/distill-bert-base-spanish-wwm-cased-finetuned-spa-squad2-es'
-TRAIN_CSV_PATH = os.path.join(SETTINGS_DICT['TRAIN_DATA_DIR'], 'curr_run_train.csv')
-TEST_CSV_PATH = os.path.join(SETTINGS_DICT['TRAIN_DATA_DIR'], 'curr_run_test.csv')
-VAL_CSV_PATH = os.path.join(SETTINGS_DICT['TRAIN_DATA_DIR'], 'curr_run_val.csv')
-MAX_CORES = 24  # limit MP calls to use this # cores at most; for tokenizing
+TRAIN_CSV_PATH = os.path.join(SETTINGS_DICT['TRAIN_DATA_DIR'],
+                              'curr_run_train.{}'.format(SETTINGS_DICT['DATA_FORMAT']))
+TEST_CSV_PATH = os.path.join(SETTINGS_DICT['TRAIN_DATA_DIR'],
+                             'curr_run_test.{}'.format(SETTINGS_DICT['DATA_FORMAT']))
+VAL_CSV_PATH = os.path.join(SETTINGS_DICT['TRAIN_DATA_DIR'],
+                            'curr_run_val.{}'.format(SETTINGS_DICT['DATA_FORMAT']))
+MAX_CORES = 24  # limit MP calls to use this # cores at most; for tokenizing w/ slow (python) tokenizers
+USE_FAST_TOKENIZER = True  # use the batched Rust tokenizer if the pretrained model has one
 BASE_MODEL_OUTPUT_DIM = 768  # hidden layer dimensions
 NUM_OUTPUTS = 1  # Num of output units (should be 1 for Toxicity)
 MAX_SEQ_LEN = 200  # max sequence length for input strings: gets padded/truncated
@@ -40,11 +62,39 @@ NUM_EPOCHS = 6
 # Gradient Accumulation: updates every ACCUM_FOR steps so that effective BS = BATCH_SIZE * ACCUM_FOR
 BATCH_SIZE = 64
 ACCUM_FOR = 1
+BUCKET_SIZE_MULT = 50  # training rows are length-sorted within buckets of BATCH_SIZE * BUCKET_SIZE_MULT rows
 LR = 1e-5  # Learning rate - constant value
-
-# For multi-gpu environments - make only 1 GPU visible to process
-os.environ['CUDA_DEVICE_ORDER'] = 'PCI_BUS_ID'
-os.environ['CUDA_VISIBLE_DEVICES'] = '0'
+LR_DECAY = None  # if set, each transformer block below the top one trains w/ LR_DECAY times the LR of the block above
+EMA_DECAY = None  # if set, val/test predictions (and the saved model) use an EMA of the weights w/ this decay
+EMA_EVERY = 1  # update the EMA every EMA_EVERY optimizer steps
+MODEL_OUTPUT_DIR = None  # if set, the fine-tuned classifier is saved here after the last epoch
+USE_TOKEN_CACHE = True  # reuse token IDs encoded by previous runs w/ the same PRETRAINED_MODEL and MAX_SEQ_LEN
+LOG_INTERVAL = 50  # steps between progress bar loss updates (each one syncs the device)
+TRACK_TRAIN_AUC = False  # also show the running AUC of the epoch's train predictions in the progress bar
+PROFILE = True  # log per-stage timings/throughput/peak memory of the run (JSONL) - the timers themselves are cheap
+PROFILE_SYNC = False  # sync the GPU at the end of each timed stage - accurate forward/backward split, slower steps
+PROFILE_STEPS = None  # (first step, last step) of the 1st epoch to capture w/ torch.profiler, e.g., (10, 15)
+MIXED_PRECISION = True  # FP16 on CUDA (apex if installed), bfloat16 autocast on CPU; False = FP32 training
+USE_APEX = True  # use apex AMP for CUDA mixed precision when it's installed
+NUM_THREADS = None  # CPU training: intra-op threads (None = torch default, typically # physical cores)
+NUM_INTEROP_THREADS = None  # CPU training: inter-op threads (None = torch default)
+CPU_AFFINITY = None  # CPU training: list of CPU ids to pin the process to, e.g., list(range(24)) for 1 socket
+DIST_BACKEND = 'gloo'  # torch.distributed backend when launched w/ torchrun (gloo = CPU workers)
+DIST_SEED = 1337  # distributed ranks draw identical epoch batches from RandomState(DIST_SEED + epoch) before sharding
+
+# For multi-gpu environments - make only 1 GPU visible to process (unless already set by the caller)
+os.environ.setdefault('CUDA_DEVICE_ORDER', 'PCI_BUS_ID')
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '0')
+DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+BACKEND = TrainingBackend(DEVICE, MIXED_PRECISION, apex_amp=amp if USE_APEX else None)
+PROFILER = RunProfiler(os.path.join(SETTINGS_DICT['PROFILE_DIR'], 'classifier_baseline.jsonl') if PROFILE else None,
+                       sync_fn=BACKEND.synchronize if PROFILE_SYNC else None,
+                       tensor_memory_fn=peak_tensor_memory_mb)
+
+
+def cln(x):  # Truncates adjacent whitespaces to single whitespace
+    return ' '.join(x.split())
 
 
 class ClassifierHead(torch.nn.Module):
@@ -53,14 +103,15 @@ class ClassifierHead(torch.nn.Module):
     - connects the CLS token of the last hidden layer with the FC
     """
 
-    def __init__(self, base_model):
+    def __init__(self, base_model, hidden_size=None):
         super(ClassifierHead, self).__init__()
+        hidden_size = BASE_MODEL_OUTPUT_DIM if hidden_size is None else hidden_size
         self.base_model = base_model
-        self.cnn = torch.nn.Conv1d(BASE_MODEL_OUTPUT_DIM, NUM_OUTPUTS, kernel_size=1)
-        self.fc = torch.nn.Linear(BASE_MODEL_OUTPUT_DIM, NUM_OUTPUTS)
+        self.cnn = torch.nn.Conv1d(hidden_size, NUM_OUTPUTS, kernel_size=1)
+        self.fc = torch.nn.Linear(hidden_size, NUM_OUTPUTS)
 
-    def forward(self, x):
-        hidden_states = self.base_model(x)[0]
+    def forward(self, x, attention_mask=None):
+        hidden_states = self.base_model(x, attention_mask=attention_mask)[0]
 
         # If you want to max-pool on a CNN of all tokens of the last hidden layer
         # hidden_states = hidden_states.permute(0, 2, 1)
@@ -68,90 +119,159 @@ class ClassifierHead(torch.nn.Module):
         # cnn_states = cnn_states.permute(0, 2, 1)
         # logits, _ = torch.max(cnn_states, 1)
 
-        # FC on 1st token (typically CLS special token)
-        logits = self.fc(hidden_states[:, 0, :])
-        prob = torch.nn.Sigmoid()(logits)
+        # FC on 1st token (typically CLS special token) - kept in fp32 under autocast, a bf16/fp16 sigmoid quantizes
+        # the probabilities into mass ties (the apex O1 path registers sigmoid as a float function for the same reason)
+        with torch.autocast(hidden_states.device.type, enabled=False):
+            logits = self.fc(hidden_states[:, 0, :].float())
+            prob = torch.nn.Sigmoid()(logits)
         return prob
 
 
-def train(model, train_tuple, loss_fn, opt, curr_epoch):
+def load_classifier(model_dir):
+    """ Loads a ClassifierHead saved by main_driver (MODEL_OUTPUT_DIR) onto the CPU in fp32 """
+    config = AutoConfig.from_pretrained(model_dir)
+    classifier = ClassifierHead(AutoModel.from_config(config), hidden_size=config.hidden_size)
+    classifier.load_state_dict(torch.load(os.path.join(model_dir, WEIGHTS_NAME), map_location='cpu'))
+    return classifier.float().eval()
+
+
+def train(model, train_tuple, loss_fn, opt, curr_epoch, pad_token_id, ema=None):
     """
     Trains against the train_tuple features for a single epoch
+    - batches are drawn from length-sorted buckets and trimmed to their longest row
+    - only the row indices get shuffled - batches are gathered from the base arrays and (pinned)
+      prepared ahead of time in a background thread by BatchPrefetcher
+    - the running loss stays on the device and only gets synced to the progress bar every LOG_INTERVAL steps
+    - device placement/mixed precision by BACKEND; a partial gradient accumulation group at the end of the epoch
+      still gets its optimizer step (instead of leaking its gradients into the next epoch), w/ its loss averaged
+      over its own micro-batches
+    - distributed: each rank trains on its shard of the epoch's batches, gradients are only all-reduced
+      (averaged across ranks) on the micro-batch that completes an accumulation group
+    - updates the (optional) EMA of the weights after every optimizer step
     """
     # Shuffle train indices for current epoch, batching
     all_features, all_labels, all_ids = train_tuple
-    train_indices = list(range(len(all_labels)))
-
-    shuffle(train_indices)
-    train_features = all_features[train_indices]
-    train_labels = all_labels[train_indices]
+    all_lengths = get_sequence_lengths(all_features, pad_token_id)
+    if get_world_size() > 1:
+        batches = length_bucketed_batches(all_lengths, BATCH_SIZE, BUCKET_SIZE_MULT,
+                                          rng=np.random.RandomState(DIST_SEED + curr_epoch))
+        batches = shard_batches(batches, get_rank(), get_world_size())
+    else:
+        batches = length_bucketed_batches(all_lengths, BATCH_SIZE, BUCKET_SIZE_MULT)
+    loader = BatchPrefetcher(all_features, all_lengths, all_labels, batches)
+    profiler = step_profiler(os.path.join(SETTINGS_DICT['PROFILE_DIR'], 'trace'),
+                             PROFILE_STEPS if curr_epoch == 0 else None)
 
     model.train()
     iter = 0
-    running_total_loss = 0  # Display running average of loss across epoch
-    with trange(0, len(train_indices), BATCH_SIZE,
-                desc='Epoch {}'.format(curr_epoch)) as t:
-        for batch_idx_start in t:
+    # Display running average of loss across epoch
+    running_metrics = RunningMetrics(BACKEND.device, track_auc=TRACK_TRAIN_AUC)
+    if profiler is not None:
+        profiler.start()
+    with tqdm(loader, desc='Epoch {}'.format(curr_epoch), disable=get_rank() != 0) as t:
+        for batch_features, batch_mask, batch_labels in PROFILER.timed_iter(t):
             iter += 1
-            batch_idx_end = min(batch_idx_start + BATCH_SIZE, len(train_indices))
-
-            batch_features = torch.tensor(train_features[batch_idx_start:batch_idx_end]).cuda()
-            batch_labels = torch.tensor(train_labels[batch_idx_start:batch_idx_end]).float().cuda().unsqueeze(-1)
-
-            preds = model(batch_features)
-            loss = loss_fn(preds, batch_labels)
-            loss = loss / ACCUM_FOR  # Normalize if we're doing GA
-
-            with amp.scale_loss(loss, opt) as scaled_loss:
-                scaled_loss.backward()
-
-            running_total_loss += loss.detach().cpu().numpy()
-            t.set_postfix(loss=running_total_loss / iter)
-
-            if iter % ACCUM_FOR == 0:
-                opt.step()
-                opt.zero_grad()
+            is_update_step = iter % ACCUM_FOR == 0 or iter == len(loader)
+            # skip the gradient all-reduce of DDP until the last micro-batch of the accumulation group
+            sync_context = model.no_sync() if isinstance(model, DistributedDataParallel) and not is_update_step \
+                else contextlib.nullcontext()
+
+            with sync_context:
+                with PROFILER.stage('forward'):
+                    batch_features = BACKEND.to_device(batch_features).long()
+                    batch_mask = BACKEND.to_device(batch_mask)
+                    batch_labels = BACKEND.to_device(batch_labels)
+
+                    with BACKEND.autocast():
+                        preds = model(batch_features, batch_mask)
+                    loss = loss_fn(preds.float(), batch_labels)
+                    running_metrics.update(loss, len(batch_labels), preds, batch_labels)
+                    # Normalize if we're doing GA - by the size of the (possibly partial, last) accumulation group
+                    loss = loss / min(ACCUM_FOR, len(loader) - (iter - 1) // ACCUM_FOR * ACCUM_FOR)
+
+                with PROFILER.stage('backward'):
+                    BACKEND.backward(loss, opt)
+
+            if iter % LOG_INTERVAL == 0 or iter == len(loader):
+                t.set_postfix(running_metrics.sync())
+
+            if is_update_step:
+                with PROFILER.stage('optimizer_step'):
+                    BACKEND.step(opt)
+                    if ema is not None:
+                        ema.update()
+
+            if profiler is not None:
+                profiler.step()
+    if profiler is not None:
+        profiler.stop()
+    PROFILER.add_throughput(len(all_lengths), all_lengths.sum())
+
+
+def predict_sharded(model, features, pad_token_id):
+    """
+    Each distributed rank predicts every world_size-th row, rank 0 gathers the predictions
+    - predicts length-sorted rows and scatters predictions back to the original order (torch_helpers.predict_probs)
+    - the base model runs under autocast, the head (and so the gathered predictions) stays float32
+    :return: [n] predictions on rank 0, None on the other ranks
+    """
+    row_indices = np.arange(get_rank(), len(features), get_world_size())
+    shard_features = features if get_world_size() == 1 else features[row_indices]
+    shard_lengths = get_sequence_lengths(shard_features, pad_token_id)
+    with BACKEND.autocast():
+        shard_preds = predict_probs(getattr(model, 'module', model), shard_features, shard_lengths, BATCH_SIZE,
+                                    device=BACKEND.device)
+    return gather_predictions(shard_preds.astype(np.float32, copy=False), row_indices, len(features))
 
 
-def predict_evaluate(model, data_tuple, epoch, score=False):
+def predict_evaluate(model, data_tuple, epoch, pad_token_id, score=False, save_val=False):
     """
     Make predictions against either val or test set
+    - distributed: every rank predicts a shard of rows, only rank 0 scores and saves them (others return None)
     Saves output to csv in data/outputs/test or data/outputs/validation
     """
     val_score = None
-    val_preds = []
-    model.eval()
-    with torch.no_grad():
-        for batch_idx_start in range(0, len(data_tuple[-1]), BATCH_SIZE):
-            batch_idx_end = min(batch_idx_start + BATCH_SIZE, len(data_tuple[-1]))
-            batch_features = torch.tensor(data_tuple[0][batch_idx_start:batch_idx_end]).cuda()
-            batch_preds = model(batch_features)
-            val_preds.append(batch_preds.cpu().numpy().reshape(-1))
-
-    val_preds = np.concatenate(val_preds)
+    val_preds = predict_sharded(model, data_tuple[0], pad_token_id)
+    if val_preds is None:
+        return val_score
+
     if score:
         # predict validation samples
-        val_score = roc_auc_score(np.round(data_tuple[1]), val_preds)
+        val_score = fast_roc_auc(data_tuple[1], val_preds)
+        if save_val:
+            curr_val_path = os.path.join(SETTINGS_DICT['VAL_PREDICTION_DIR'],
+                                         '{}.csv'.format(epoch))
+            with PROFILER.stage('prediction_writing'):
+                pd.DataFrame({'id': data_tuple[-1], 'toxic': val_preds}) \
+                    .to_csv(curr_val_path, index=False)
     else:
         # predicting test samples
         curr_test_path = os.path.join(SETTINGS_DICT['PREDICTION_DIR'],
                                       '{}.csv'.format(epoch))
-        pd.DataFrame({'id': data_tuple[-1], 'toxic': val_preds}) \
-            .to_csv(curr_test_path, index=False)
+        with PROFILER.stage('prediction_writing'):
+            pd.DataFrame({'id': data_tuple[-1], 'toxic': val_preds}) \
+                .to_csv(curr_test_path, index=False)
 
     return val_score
 
 
 def main_driver(train_tuple, val_tuple, test_tuple, tokenizer):
-    pretrained_config = AutoConfig.from_pretrained(PRETRAINED_MODEL,
-                                                   output_hidden_states=True)
-    pretrained_base = AutoModel.from_pretrained(PRETRAINED_MODEL, config=pretrained_config).cuda()
-    classifier = ClassifierHead(pretrained_base).cuda()
-    loss_fn = torch.nn.BCELoss()
-    opt = torch.optim.Adam(classifier.parameters(), lr=LR)
-
-    amp.register_float_function(torch, 'sigmoid')
-    classifier, opt = amp.initialize(classifier, opt, opt_level='O1', verbosity=0)
+    with PROFILER.stage('model_load'):
+        pretrained_config = AutoConfig.from_pretrained(PRETRAINED_MODEL,
+                                                       output_hidden_states=True)
+        pretrained_base = AutoModel.from_pretrained(PRETRAINED_MODEL, config=pretrained_config)
+        classifier = ClassifierHead(pretrained_base).to(BACKEND.device)
+        loss_fn = torch.nn.BCELoss()
+        opt_params = classifier.parameters() if LR_DECAY is None else layerwise_lr_decay(classifier, LR, LR_DECAY)
+        opt = multi_tensor_adam(opt_params, LR, BACKEND.device)
+        classifier, opt = BACKEND.prepare(classifier, opt)
+        if get_world_size() > 1:
+            # the CNN head and the pooler of the base model aren't used by the loss
+            classifier = DistributedDataParallel(classifier, find_unused_parameters=True,
+                                                 device_ids=[BACKEND.device] if DEVICE == 'cuda' else None)
+    ema = EMA(classifier, EMA_DECAY, EMA_EVERY) if EMA_DECAY is not None else None
+    ema_context = ema.average_parameters if ema is not None else contextlib.nullcontext
+    PROFILER.log('setup')
     list_auc = []
 
     current_tuple = train_tuple
@@ -159,51 +279,77 @@ def main_driver(train_tuple, val_tuple, test_tuple, tokenizer):
         # After half epochs, switch to training against validation set
         if curr_epoch == NUM_EPOCHS // 2 and len(val_tuple[-1]) > 0:
             current_tuple = val_tuple
-        train(classifier, current_tuple, loss_fn, opt, curr_epoch)
+        with PROFILER.stage('train'):
+            train(classifier, current_tuple, loss_fn, opt, curr_epoch, tokenizer.pad_token_id, ema)
 
         # Score against the validation set
+        epoch_raw_auc = None
         if len(val_tuple[-1]) > 0:
-            epoch_raw_auc = predict_evaluate(classifier, val_tuple, curr_epoch, score=True)
-            print('Epoch {} - Val AUC: {:.4f}'.format(curr_epoch, epoch_raw_auc))
-            list_auc.append(epoch_raw_auc)
+            with PROFILER.stage('evaluation'), ema_context():
+                epoch_raw_auc = predict_evaluate(classifier, val_tuple, curr_epoch, tokenizer.pad_token_id,
+                                                 score=True, save_val=current_tuple is train_tuple)
+            if get_rank() == 0:
+                print('Epoch {} - Val AUC: {:.4f}'.format(curr_epoch, epoch_raw_auc))
+                list_auc.append(epoch_raw_auc)
 
-        predict_evaluate(classifier, test_tuple, curr_epoch)
+        with PROFILER.stage('prediction'), ema_context():
+            predict_evaluate(classifier, test_tuple, curr_epoch, tokenizer.pad_token_id)
+        PROFILER.log('epoch', epoch=curr_epoch, val_auc=epoch_raw_auc)
 
     with np.printoptions(precision=4, suppress=True):
         print(np.array(list_auc))
 
-
-if __name__ == '__main__':
-    def cln(x):  # Truncates adjacent whitespaces to single whitespace
-        return ' '.join(x.split())
+    if MODEL_OUTPUT_DIR is not None and get_rank() == 0:
+        with ema_context():
+            save_model(MODEL_OUTPUT_DIR, getattr(classifier, 'module', classifier), pretrained_config, tokenizer)
 
 
+if __name__ == '__main__':
     start_time = time.time()
+    rank, world_size = init_distributed(DIST_BACKEND)
+    if rank != 0:
+        PROFILER.output_path = None
+    if DEVICE == 'cpu':
+        num_threads = NUM_THREADS
+        if num_threads is None and world_size > 1:  # split the cores between the ranks on this node
+            num_threads = max(1, os.cpu_count() // int(os.environ.get('LOCAL_WORLD_SIZE', world_size)))
+        configure_cpu_threads(num_threads, NUM_INTEROP_THREADS, CPU_AFFINITY)
 
     # Load train, validation, and pseudo-label data
-    train_ids, train_strings, train_labels = get_id_text_label_from_csv(TRAIN_CSV_PATH,
-                                                                        text_col='comment_text')
-    train_strings = [cln(x) for x in train_strings]
-
-    val_ids, val_strings, val_labels = get_id_text_label_from_csv(VAL_CSV_PATH,
-                                                                  text_col='comment_text')
-    val_strings = [cln(x) for x in val_strings]
-
-    test_ids, test_strings = get_id_text_from_test_csv(TEST_CSV_PATH, text_col='comment_text')
-    test_strings = [cln(x) for x in test_strings]
-
-    # use MP to batch encode the raw feature strings into Bert token IDs
-    tokenizer = AutoTokenizer.from_pretrained(PRETRAINED_MODEL)
-    encode_partial = partial(tokenizer.encode,
-                             truncation=True,
-                             max_length=MAX_SEQ_LEN,
-                             pad_to_max_length=True,
-                             add_special_tokens=True)
+    with PROFILER.stage('csv_load'):
+        train_ids, train_strings, train_labels = get_id_text_label_from_csv(TRAIN_CSV_PATH,
+                                                                            text_col='comment_text')
+        val_ids, val_strings, val_labels = get_id_text_label_from_csv(VAL_CSV_PATH,
+                                                                      text_col='comment_text')
+        test_ids, test_strings = get_id_text_from_test_csv(TEST_CSV_PATH, text_col='comment_text')
+
+    with PROFILER.stage('cleaning'):
+        train_strings = [cln(x) for x in train_strings]
+        val_strings = [cln(x) for x in val_strings]
+        test_strings = [cln(x) for x in test_strings]
+
+    # batch encode the raw feature strings into Bert token IDs (multiprocessing fallback for slow tokenizers)
+    tokenizer = AutoTokenizer.from_pretrained(PRETRAINED_MODEL, use_fast=USE_FAST_TOKENIZER)
+    encode_fn = partial(encode_strings,
+                        tokenizer=tokenizer,
+                        max_len=MAX_SEQ_LEN,
+                        num_workers=MAX_CORES)
     print('Encoding raw strings into model-specific tokens')
-    with mp.Pool(MAX_CORES) as p:
-        train_features = np.array(p.map(encode_partial, train_strings))
-        val_features = np.array(p.map(encode_partial, val_strings))
-        test_features = np.array(p.map(encode_partial, test_strings))
+    with PROFILER.stage('tokenization'):
+        if USE_TOKEN_CACHE:
+            # rank 0 fills the cache, the other ranks read it once it's done
+            if rank != 0:
+                torch.distributed.barrier()
+            token_cache = TokenCache(SETTINGS_DICT['TOKEN_CACHE_DIR'], PRETRAINED_MODEL, tokenizer, MAX_SEQ_LEN)
+            train_features = token_cache.encode(train_strings, encode_fn)
+            val_features = token_cache.encode(val_strings, encode_fn)
+            test_features = token_cache.encode(test_strings, encode_fn)
+            if rank == 0 and world_size > 1:
+                torch.distributed.barrier()
+        else:
+            train_features = encode_fn(train_strings)
+            val_features = encode_fn(val_strings)
+            test_features = encode_fn(test_strings)
 
     print('Train size: {}, val size: {}'.format(len(train_ids), len(val_ids)))
     print('Train positives: {}, train negatives: {}'.format(train_labels[train_labels == 1].shape,
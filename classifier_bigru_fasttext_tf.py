@@ -1,87 +1,213 @@
 """
 Monolingual classifier using Bidirectional GRU w/ pretrained FastText embeddings
+- saves test-set predictions every epoch to $PREDICTION_DIR/{EPOCH_NUM}.csv
+- saves validation predictions every epoch to $VAL_PREDICTION_DIR/{EPOCH_NUM}.csv
+- PRUNE_EMBEDDINGS sizes the embedding table to the words actually present in the padded train/val/test sequences
+- BUCKETED_INPUT trains on a tf.data pipeline that strips padding and batches rows of similar length
+  (bucket_by_sequence_length, parallel map, prefetch) w/ a masked Embedding, and predicts length-sorted batches
+  whose predictions are scattered back to the original id order - comments that tokenize to nothing get a single
+  (zero-embedding) token, since the cuDNN GRU kernel rejects fully masked rows
+- ADD_RARE_WORDS keeps words outside the top VOCAB_SIZE (instead of dropping them) w/ their FastText subword vectors
+- PROFILE appends per-stage timings, samples/tokens per sec and peak memory to $PROFILE_DIR/classifier_bigru.jsonl
+  (see profiling.py), PROFILE_STEPS captures a TF profiler trace of some 1st epoch steps in $PROFILE_DIR/trace/
 """
 import time
 import json
 import os
+import hashlib
 import pandas as pd
 import numpy as np
 import tensorflow as tf
 from tensorflow.keras.optimizers import Adam
 import tensorflow.keras.layers as layers
 from tensorflow.keras import Model
-from tensorflow.python.keras.preprocessing.sequence import pad_sequences
-from tensorflow.python.keras.preprocessing.text import Tokenizer
-from sklearn.metrics import roc_auc_score
-from preprocessor import get_id_text_label_from_csv, get_id_text_from_test_csv
+from scoring import fast_roc_auc
+from profiling import RunProfiler
+from preprocessor import get_id_text_label_from_csv, get_id_text_from_test_csv, VocabTokenizer
 from fasttext import load_model
 
 with open('SETTINGS.json') as f:
     SETTINGS_DICT = json.load(f)
 
 USE_LANG = 'es'  # select the right FastText language model file
-TRAIN_CSV_PATH = os.path.join(SETTINGS_DICT['TRAIN_DATA_DIR'], 'curr_run_train.csv')
-TEST_CSV_PATH = os.path.join(SETTINGS_DICT['TRAIN_DATA_DIR'], 'curr_run_test.csv')
-VAL_CSV_PATH = os.path.join(SETTINGS_DICT['TRAIN_DATA_DIR'], 'curr_run_val.csv')
+TRAIN_CSV_PATH = os.path.join(SETTINGS_DICT['TRAIN_DATA_DIR'],
+                              'curr_run_train.{}'.format(SETTINGS_DICT['DATA_FORMAT']))
+TEST_CSV_PATH = os.path.join(SETTINGS_DICT['TRAIN_DATA_DIR'],
+                             'curr_run_test.{}'.format(SETTINGS_DICT['DATA_FORMAT']))
+VAL_CSV_PATH = os.path.join(SETTINGS_DICT['TRAIN_DATA_DIR'],
+                            'curr_run_val.{}'.format(SETTINGS_DICT['DATA_FORMAT']))
 NUM_OUTPUTS = 1  # Number of targets
 MAX_SEQ_LEN = 200  # max sequence length for input strings: gets padded/truncated
 NUM_EPOCHS = 4
 BATCH_SIZE = 32
 VOCAB_SIZE = 100000  # Used to generate the embeddings matrix
+PRUNE_EMBEDDINGS = True  # only keep embedding rows of words that appear in the padded sequences
+ADD_RARE_WORDS = False  # keep all words (not just the top VOCAB_SIZE) - best used w/ PRUNE_EMBEDDINGS
 EMBEDDING_DIMS = 300  # Dimensions of the FastText embedder (typically 300)
 HIDDEN_UNITS = 128  # Hidden units for the Bidirectional GRU
+MAX_CORES = 24  # limit MP calls to use this # cores at most; for fitting the vocab and converting texts
+BUCKETED_INPUT = True  # variable-length (bucketed) batches instead of batches padded to MAX_SEQ_LEN
+BUCKET_BOUNDARIES = [16, 32, 64, 128]  # sequence length bucket edges for BUCKETED_INPUT
+SHUFFLE_BUFFER = 100000  # rows in the tf.data shuffle buffer for BUCKETED_INPUT
+EMBEDDING_BATCH_SIZE = 10000  # rows per memmap write when looking up FastText vectors on an embedding cache miss
+PROFILE = True  # log per-stage timings/throughput/peak memory of the run (JSONL)
+PROFILE_STEPS = None  # (first step, last step) of the 1st epoch to capture w/ the TF profiler, e.g., (10, 15)
+
+
+def peak_tensor_memory_mb():
+    """ Peak memory allocated to tensors on the 1st GPU in MB (None w/o a GPU or on TF versions w/o memory info) """
+    if not tf.config.list_physical_devices('GPU') or not hasattr(tf.config.experimental, 'get_memory_info'):
+        return None
+    return tf.config.experimental.get_memory_info('GPU:0')['peak'] / 2 ** 20
+
+
+PROFILER = RunProfiler(os.path.join(SETTINGS_DICT['PROFILE_DIR'], 'classifier_bigru.jsonl') if PROFILE else None,
+                       tensor_memory_fn=peak_tensor_memory_mb)
 
 
 def texts_to_padded_sequences(train_strings, val_strings, test_strings):
     """
-    Use keras tokenizer set to defaults & specified vocab size to
-    tokenize the training and test comments
+    Use a keras-compatible tokenizer (same IDs as keras Tokenizer w/ defaults) set to the specified vocab size to
+    tokenize the training and test comments - vocab counting and conversion run across MAX_CORES processes
     Then apply pre-padding with val 0.
-    :return: tuple of keras Tokenizer and the train & test token sequences
+    :return: tuple of fitted VocabTokenizer and the train & test int32 token sequences
     """
-    tokenizer = Tokenizer(num_words=VOCAB_SIZE)
+    tokenizer = VocabTokenizer(num_words=None if ADD_RARE_WORDS else VOCAB_SIZE, num_workers=MAX_CORES)
     train_val_test_comment_text = train_strings + val_strings + test_strings
     tokenizer.fit_on_texts(train_val_test_comment_text)
 
-    train_sequences = tokenizer.texts_to_sequences(train_strings)
-    train_sequences = pad_sequences(train_sequences, maxlen=MAX_SEQ_LEN)
-
-    val_sequences = tokenizer.texts_to_sequences(val_strings)
-    val_sequences = pad_sequences(val_sequences, maxlen=MAX_SEQ_LEN)
-
-    test_sequences = tokenizer.texts_to_sequences(test_strings)
-    test_sequences = pad_sequences(test_sequences, maxlen=MAX_SEQ_LEN)
+    train_sequences = tokenizer.texts_to_padded_sequences(train_strings, MAX_SEQ_LEN)
+    val_sequences = tokenizer.texts_to_padded_sequences(val_strings, MAX_SEQ_LEN)
+    test_sequences = tokenizer.texts_to_padded_sequences(test_strings, MAX_SEQ_LEN)
     print('generated padded sequences...')
 
     return tokenizer, train_sequences, val_sequences, test_sequences
 
 
-def generate_embedding_matrix(fitted_tokenizer):
+def prune_to_used_vocab(index_word, *sequences):
+    """
+    Re-indexes padded sequences so only words that appear in them get an ID (1..# used words, 0 stays padding)
+    :param index_word: {ID: word} dict of the fitted tokenizer
+    :return: (list of words for IDs 1.., re-indexed sequences...) tuple
+    """
+    max_id = max(int(x.max()) if x.size else 0 for x in sequences)
+    is_used = np.zeros(max_id + 1, dtype=bool)
+    for x in sequences:
+        is_used[np.unique(x)] = True
+    is_used[0] = False
+    used_ids = np.flatnonzero(is_used)
+
+    new_ids = np.zeros(max_id + 1, dtype=np.int32)
+    new_ids[used_ids] = np.arange(1, len(used_ids) + 1, dtype=np.int32)
+    print('pruned vocab to {} used words...'.format(len(used_ids)))
+    return ([index_word[i] for i in used_ids],) + tuple(new_ids[x] for x in sequences)
+
+
+def generate_embedding_matrix(vocab, num_rows):
     """
     Standard FastText sub-word wikipedia trained model
-    :param fitted_tokenizer:
-    :return:
+    - float32 matrix cached as a .npy in $EMBEDDING_CACHE_DIR, keyed on the FastText model file (path, size, mtime)
+      and a hash of the fitted vocabulary - cache hits skip loading the FastText model entirely
+    - on a miss, word vectors are looked up per word (get_word_vector) and written EMBEDDING_BATCH_SIZE rows at a
+      time into a memory-mapped .npy - a batched gather from get_input_matrix() would copy the whole (words +
+      n-gram buckets) input matrix, several GB for the cc.*.300 models
+    - FastText builds vectors of words missing from its own vocab from their subword n-grams
+    :param vocab: words of embedding rows 1.. (row 0 is padding)
+    :param num_rows: rows in the matrix - rows past len(vocab) are zeros
+    :return: [num_rows, EMBEDDING_DIMS] float32 (memory-mapped) matrix
     """
-    ft_model = load_model(os.path.join(SETTINGS_DICT['FT_MODELS_DIR'],
-                                       'cc.{}.300.bin'.format(USE_LANG)))
+    ft_model_path = os.path.join(SETTINGS_DICT['FT_MODELS_DIR'], 'cc.{}.300.bin'.format(USE_LANG))
+
+    ft_model_stat = os.stat(ft_model_path)
+    cache_key = hashlib.blake2b(digest_size=16)
+    cache_key.update('{}|{}|{}|{}|{}'.format(os.path.abspath(ft_model_path), ft_model_stat.st_size,
+                                             ft_model_stat.st_mtime_ns, EMBEDDING_DIMS, num_rows).encode('utf-8'))
+    cache_key.update('\n'.join(vocab).encode('utf-8'))
+    cache_path = os.path.join(SETTINGS_DICT['EMBEDDING_CACHE_DIR'], '{}.npy'.format(cache_key.hexdigest()))
+    if os.path.exists(cache_path):
+        print('loaded cached ft embeddings...')
+        return np.load(cache_path, mmap_mode='r')
 
-    embedding_matrix = np.zeros((VOCAB_SIZE + 1, EMBEDDING_DIMS))
-    for i in range(1, VOCAB_SIZE + 1):
-        try:
-            embedding_matrix[i] = ft_model.get_word_vector(fitted_tokenizer.index_word[i])
-        except KeyError:
-            print('FastText OOV?')
+    if not os.path.exists(SETTINGS_DICT['EMBEDDING_CACHE_DIR']):
+        os.makedirs(SETTINGS_DICT['EMBEDDING_CACHE_DIR'])
+    ft_model = load_model(ft_model_path)
+    tmp_cache_path = cache_path[:-len('.npy')] + '.tmp.npy'
+    embedding_matrix = np.lib.format.open_memmap(tmp_cache_path, mode='w+', dtype=np.float32,
+                                                 shape=(num_rows, EMBEDDING_DIMS))
+    embedding_matrix[0] = 0.
+    embedding_matrix[len(vocab) + 1:] = 0.
+    for batch_start in range(0, len(vocab), EMBEDDING_BATCH_SIZE):
+        batch_words = vocab[batch_start:batch_start + EMBEDDING_BATCH_SIZE]
+        embedding_matrix[batch_start + 1:batch_start + 1 + len(batch_words)] = \
+            np.stack([ft_model.get_word_vector(x) for x in batch_words])
+    embedding_matrix.flush()
+    del embedding_matrix
+    os.replace(tmp_cache_path, cache_path)
 
     print('generated ft embeddings...')
-    return embedding_matrix
+    return np.load(cache_path, mmap_mode='r')
+
+
+def fill_empty_rows(empty_id, *sequences):
+    """
+    Gives rows w/o any tokens (comments that tokenize to nothing) a single empty_id token, in place
+    - empty_id should be a zero embedding row other than 0, so the row isn't fully masked by mask_zero
+    """
+    for x in sequences:
+        x[(x == 0).all(axis=1), -1] = empty_id
+    return sequences
+
+
+def get_sequence_lengths(sequences):
+    """ Number of tokens in each pre-padded sequence (at least 1) """
+    return np.maximum((sequences != 0).sum(axis=1), 1).astype(np.int32)
+
+
+def strip_padding(sequence, length, *rest):
+    """ tf.data map fn - drops the pre-padding of a sequence """
+    return (sequence[MAX_SEQ_LEN - length:],) + rest
+
+
+def make_bucketed_dataset(features, labels):
+    """
+    Shuffled training dataset of variable-length batches of rows w/ similar length
+    - padding is stripped in a parallel map, batches are post-padded to their longest row by bucket_by_sequence_length
+    """
+    autotune = tf.data.experimental.AUTOTUNE
+    return tf.data.Dataset.from_tensor_slices((features, get_sequence_lengths(features), labels.astype(np.float32))) \
+        .shuffle(SHUFFLE_BUFFER, reshuffle_each_iteration=True) \
+        .map(strip_padding, num_parallel_calls=autotune) \
+        .apply(tf.data.experimental.bucket_by_sequence_length(
+            element_length_func=lambda sequence, label: tf.shape(sequence)[0],
+            bucket_boundaries=BUCKET_BOUNDARIES,
+            bucket_batch_sizes=[BATCH_SIZE] * (len(BUCKET_BOUNDARIES) + 1))) \
+        .prefetch(autotune)
+
+
+def predict_length_sorted(classifier, features):
+    """
+    Predicts batches of length-sorted rows (each padded to its longest row), then restores the original row order
+    """
+    autotune = tf.data.experimental.AUTOTUNE
+    lengths = get_sequence_lengths(features)
+    sorted_indices = np.argsort(lengths, kind='stable')
+    dataset = tf.data.Dataset.from_tensor_slices((features[sorted_indices], lengths[sorted_indices])) \
+        .map(lambda sequence, length: strip_padding(sequence, length)[0], num_parallel_calls=autotune) \
+        .padded_batch(BATCH_SIZE, padded_shapes=[None]) \
+        .prefetch(autotune)
+    preds = np.zeros(len(sorted_indices), dtype=np.float32)
+    preds[sorted_indices] = classifier.predict(dataset).reshape(-1)
+    return preds
 
 
 def build_classifier_model(embedding_matrix):
-    input = layers.Input(shape=(MAX_SEQ_LEN,), dtype=np.int32)
+    # variable-length batches need masking so the GRUs skip the (post-)padding
+    input = layers.Input(shape=(None if BUCKETED_INPUT else MAX_SEQ_LEN,), dtype=np.int32)
 
-    embedding_layer = layers.Embedding(VOCAB_SIZE + 1,
+    embedding_layer = layers.Embedding(embedding_matrix.shape[0],
                                        EMBEDDING_DIMS,
                                        weights=[embedding_matrix],
+                                       mask_zero=BUCKETED_INPUT,
                                        trainable=False)
     embedded_input = embedding_layer(input)
     gru_output = layers.Bidirectional(layers.GRU(HIDDEN_UNITS,
@@ -99,7 +225,7 @@ def train_driver(train_tuple,
                  test_tuple,
                  embedding_matrix):
     train_features, train_labels = train_tuple
-    val_features, val_labels = val_tuple
+    val_features, val_labels, val_ids = val_tuple
     test_features, test_ids = test_tuple
 
     classifier = build_classifier_model(embedding_matrix)
@@ -107,44 +233,98 @@ def train_driver(train_tuple,
     opt = tf.keras.mixed_precision.experimental.LossScaleOptimizer(opt, 'dynamic')
     classifier.compile(optimizer=opt, loss='binary_crossentropy')
 
+    if BUCKETED_INPUT:
+        train_dataset = make_bucketed_dataset(train_features, train_labels)
+    train_num_tokens = get_sequence_lengths(train_features).sum()
+    PROFILER.log('setup')
+
     for curr_epoch in range(NUM_EPOCHS):
-        classifier.fit(train_features, train_labels,
-                       batch_size=BATCH_SIZE,
-                       epochs=1,
-                       verbose=1)
+        callbacks = []
+        if PROFILE_STEPS is not None and curr_epoch == 0:
+            callbacks.append(tf.keras.callbacks.TensorBoard(log_dir=os.path.join(SETTINGS_DICT['PROFILE_DIR'], 'trace'),
+                                                            profile_batch=PROFILE_STEPS))
+        epoch_start_time = time.time()
+        with PROFILER.stage('train'):
+            if BUCKETED_INPUT:
+                classifier.fit(train_dataset,
+                               epochs=1,
+                               callbacks=callbacks,
+                               verbose=1)
+            else:
+                classifier.fit(train_features, train_labels,
+                               batch_size=BATCH_SIZE,
+                               epochs=1,
+                               callbacks=callbacks,
+                               verbose=1)
+        PROFILER.add_throughput(len(train_labels), train_num_tokens)
+        print('Epoch {} - train time: {:.1f}s'.format(curr_epoch, time.time() - epoch_start_time))
 
+        val_roc_auc_score = None
         if len(val_labels):
-            val_preds = classifier.predict(val_features)
-            val_roc_auc_score = roc_auc_score(val_labels, val_preds)
+            with PROFILER.stage('evaluation'):
+                if BUCKETED_INPUT:
+                    val_preds = predict_length_sorted(classifier, val_features)
+                else:
+                    val_preds = classifier.predict(val_features)
+                val_roc_auc_score = fast_roc_auc(val_labels, val_preds)
             print(val_roc_auc_score)
+            curr_val_path = os.path.join(SETTINGS_DICT['VAL_PREDICTION_DIR'],
+                                         '{}.csv'.format(curr_epoch))
+            with PROFILER.stage('prediction_writing'):
+                pd.DataFrame({'id': val_ids, 'toxic': val_preds.reshape(-1)}) \
+                    .to_csv(curr_val_path,
+                            index=False)
 
-        test_preds = classifier.predict(test_features).squeeze()
+        predict_start_time = time.time()
+        with PROFILER.stage('prediction'):
+            if BUCKETED_INPUT:
+                test_preds = predict_length_sorted(classifier, test_features)
+            else:
+                test_preds = classifier.predict(test_features).squeeze()
+        print('Epoch {} - test predict time: {:.1f}s'.format(curr_epoch, time.time() - predict_start_time))
         curr_test_path = os.path.join(SETTINGS_DICT['PREDICTION_DIR'],
                                       '{}.csv'.format(curr_epoch))
-        pd.DataFrame({'id': test_ids, 'toxic': test_preds}) \
-            .to_csv(curr_test_path,
-                    index=False)
+        with PROFILER.stage('prediction_writing'):
+            pd.DataFrame({'id': test_ids, 'toxic': test_preds}) \
+                .to_csv(curr_test_path,
+                        index=False)
+        PROFILER.log('epoch', epoch=curr_epoch, val_auc=val_roc_auc_score)
 
 
 if __name__ == '__main__':
     start_time = time.time()
     # Load train, validation, and pseudo-label data
-    train_ids, train_strings, train_labels = get_id_text_label_from_csv(TRAIN_CSV_PATH,
-                                                                        text_col='comment_text')
-    val_ids, val_strings, val_labels = get_id_text_label_from_csv(VAL_CSV_PATH,
-                                                                  text_col='comment_text',
-                                                                  lang=USE_LANG)
-    test_ids, test_strings = get_id_text_from_test_csv(TEST_CSV_PATH, text_col='comment_text')
+    with PROFILER.stage('csv_load'):
+        train_ids, train_strings, train_labels = get_id_text_label_from_csv(TRAIN_CSV_PATH,
+                                                                            text_col='comment_text')
+        val_ids, val_strings, val_labels = get_id_text_label_from_csv(VAL_CSV_PATH,
+                                                                      text_col='comment_text',
+                                                                      lang=USE_LANG)
+        test_ids, test_strings = get_id_text_from_test_csv(TEST_CSV_PATH, text_col='comment_text')
 
-    (tokenizer, train_features, val_features, test_features) \
-        = texts_to_padded_sequences(train_strings, val_strings, test_strings)
+    with PROFILER.stage('tokenization'):
+        (tokenizer, train_features, val_features, test_features) \
+            = texts_to_padded_sequences(train_strings, val_strings, test_strings)
 
     print(train_features.shape, val_features.shape, test_features.shape)
 
-    pretrained_embedding_matrix = generate_embedding_matrix(tokenizer)
+    with PROFILER.stage('embedding_build'):
+        if PRUNE_EMBEDDINGS:
+            vocab, train_features, val_features, test_features = \
+                prune_to_used_vocab(tokenizer.index_word, train_features, val_features, test_features)
+            num_rows = len(vocab) + 1
+        else:
+            num_words = len(tokenizer.index_word) if ADD_RARE_WORDS else VOCAB_SIZE
+            vocab = [tokenizer.index_word[i] for i in range(1, num_words + 1) if i in tokenizer.index_word]
+            num_rows = num_words + 1
+        if BUCKETED_INPUT:
+            # 1 extra (zero) embedding row as the token of empty rows
+            fill_empty_rows(num_rows, train_features, val_features, test_features)
+            num_rows += 1
+        pretrained_embedding_matrix = generate_embedding_matrix(vocab, num_rows)
 
     train_driver([train_features, train_labels],
-                 [val_features, val_labels],
+                 [val_features, val_labels, val_ids],
                  [test_features, test_ids],
                  pretrained_embedding_matrix)
 
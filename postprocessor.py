@@ -1,8 +1,28 @@
 import os
+import json
+import hashlib
 import numpy as np
 import pandas as pd
-from sklearn.metrics import roc_auc_score
+from functools import lru_cache
 from scipy.stats import rankdata
+from scoring import RocAucScorer
+
+
+def load_target_scorer(target_csv):
+    """
+    Sorted ids + RocAucScorer (grouped by lang if the CSV has a lang column) of a target CSV
+    - cached by path, size & mtime, so repeated scoring against the same target only reads the predicted CSVs,
+      while a regenerated target CSV gets re-read
+    """
+    stat = os.stat(target_csv)
+    return _load_target_scorer(target_csv, stat.st_size, stat.st_mtime_ns)
+
+
+@lru_cache(maxsize=8)
+def _load_target_scorer(target_csv, size, mtime_ns):
+    target_df = pd.read_csv(target_csv).sort_values(by='id')
+    groups = target_df['lang'].values if 'lang' in target_df.columns else None
+    return target_df['id'].values, RocAucScorer(target_df['toxic'].values, groups=groups)
 
 
 def score_roc_auc(target_csv, predicted_csv):
@@ -10,44 +30,257 @@ def score_roc_auc(target_csv, predicted_csv):
     Generates ROC AUC from CSVs with target and predicted toxic scores
     - assumes CSVs have id and toxic columns
     """
-    train_df = pd.read_csv(target_csv).sort_values(by='id')
-    compare_df = pd.read_csv(predicted_csv).sort_values(by='id')
-    assert (train_df['id'].values == compare_df['id'].values).all()
+    ids, scorer = load_target_scorer(target_csv)
+    _, predictions = load_prediction_matrix([predicted_csv], ids=ids)
+    return scorer.score(predictions[0])
 
-    return roc_auc_score(train_df['toxic'].values,
-                         compare_df['toxic'].values)
 
+def score_roc_auc_by_lang(target_csv, predicted_csv):
+    """ {lang: ROC AUC} breakdown (plus 'all') - target CSV needs id, toxic and lang columns """
+    ids, scorer = load_target_scorer(target_csv)
+    _, predictions = load_prediction_matrix([predicted_csv], ids=ids)
+    return scorer.score_by_group(predictions[0])
 
-def ensemble_simple_avg_csv(list_csv, output_path='data/preds.csv'):
+
+def score_roc_auc_csvs(target_csv, list_csv):
+    """ ROC AUC of every predicted CSV in list_csv, scored as a single [n_models, n_rows] batch """
+    ids, scorer = load_target_scorer(target_csv)
+    _, predictions = load_prediction_matrix(list_csv, ids=ids)
+    return scorer.score(predictions)
+
+
+def load_prediction_matrix(list_csv, ids=None):
+    """
+    Loads the toxic columns of prediction CSVs into one preallocated float32 [n_models, n_rows] matrix
+    - id ordering is worked out once (sorted ids of the first CSV, unless ids are given)
+    - CSVs w/ the same row order as the first one skip the per-file sort
+    - raises ValueError if a CSV's ids don't match
+    :param list_csv: list of CSVs w/ id/toxic columns
+    :param ids: sorted reference ids (optional)
+    :return: (sorted ids, prediction matrix) tuple
+    """
+    first_df = pd.read_csv(list_csv[0], usecols=['id', 'toxic'], dtype={'toxic': np.float32})
+    first_ids = first_df['id'].values
+    first_order = np.argsort(first_ids, kind='stable')
+    if ids is None:
+        ids = first_ids[first_order]
+
+    predictions = np.empty((len(list_csv), len(ids)), dtype=np.float32)
+    for i, curr_csv in enumerate(list_csv):
+        curr_df = first_df if i == 0 else pd.read_csv(curr_csv, usecols=['id', 'toxic'],
+                                                      dtype={'toxic': np.float32})
+        curr_ids = curr_df['id'].values
+        if len(curr_ids) == len(first_ids) and (curr_ids == first_ids).all():
+            curr_order = first_order
+        else:
+            curr_order = np.argsort(curr_ids, kind='stable')
+        if len(curr_ids) != len(ids) or not (curr_ids[curr_order] == ids).all():
+            raise ValueError('ids in {} do not match ids in {}'.format(curr_csv, list_csv[0]))
+        predictions[i] = curr_df['toxic'].values[curr_order]
+    return ids, predictions
+
+
+def ensemble_predictions(list_csv, method='simple', power=1., weights=None, models_per_chunk=None):
+    """
+    Vectorized ensembling of prediction CSVs
+    - 'simple': mean, 'power': mean of toxic ** power, 'rank': mean of rank / n_rows
+    - optional per-CSV weights turn any of the above into a weighted average
+    - models_per_chunk bounds memory to a [models_per_chunk, n_rows] matrix, accumulating weighted sums across chunks
+    :return: (sorted ids, float64 ensembled toxicity) tuple
+    """
+    weights = np.ones(len(list_csv)) if weights is None else np.asarray(weights, dtype=np.float64)
+    models_per_chunk = len(list_csv) if models_per_chunk is None else models_per_chunk
+
+    ids, total = None, None
+    for chunk_start in range(0, len(list_csv), models_per_chunk):
+        chunk_end = chunk_start + models_per_chunk
+        ids, predictions = load_prediction_matrix(list_csv[chunk_start:chunk_end], ids=ids)
+        if method == 'power':
+            predictions **= power
+        elif method == 'rank':
+            predictions = rankdata(predictions, axis=1) / predictions.shape[1]
+        elif method != 'simple':
+            raise ValueError('Unknown ensemble method: {}'.format(method))
+        # float32 weights keep the matmul from upcasting (copying) the whole prediction matrix
+        chunk_total = (weights[chunk_start:chunk_end].astype(predictions.dtype) @ predictions).astype(np.float64)
+        total = chunk_total if total is None else total + chunk_total
+    return ids, total / weights.sum()
+
+
+def ensemble_simple_avg_csv(list_csv, output_path='data/preds.csv', models_per_chunk=None):
     """ Given a list of CSVs with id/toxic columns, outputs a single CSV with averaged toxicity """
-    base_df = pd.read_csv(list_csv[0]).sort_values('id').set_index('id')
-    for i in range(1, len(list_csv)):
-        base_df['toxic'] += pd.read_csv(list_csv[i]).sort_values('id').set_index('id')['toxic']
-    base_df['toxic'] /= len(list_csv)
-    base_df.reset_index().to_csv(output_path, index=False)
+    ids, predictions = ensemble_predictions(list_csv, models_per_chunk=models_per_chunk)
+    pd.DataFrame({'id': ids, 'toxic': predictions}).to_csv(output_path, index=False)
+
+
+def ensemble_weighted_avg_csv(list_csv, weights, output_path='data/weighted_preds.csv', models_per_chunk=None):
+    """ Weighted average of input CSV toxicity - one weight per CSV """
+    ids, predictions = ensemble_predictions(list_csv, weights=weights, models_per_chunk=models_per_chunk)
+    pd.DataFrame({'id': ids, 'toxic': predictions}).to_csv(output_path, index=False)
 
 
-def ensemble_power_avg_csv(list_csv, power):
+def ensemble_power_avg_csv(list_csv, power, models_per_chunk=None):
     """ Power averaging of input CSV toxicity """
-    base_df = pd.read_csv(list_csv[0]).sort_values('id').set_index('id')
-    base_df['toxic'] = base_df['toxic'] ** power
-    for i in range(1, len(list_csv)):
-        base_df['toxic'] += pd.read_csv(list_csv[i]).sort_values('id').set_index('id')['toxic'].values ** power
-    base_df['toxic'] /= len(list_csv)
-    base_df = base_df.reset_index()
-    base_df[['id', 'toxic']].to_csv('data/power_ensemble_{}.csv'.format(len(list_csv)), index=False)
+    ids, predictions = ensemble_predictions(list_csv, method='power', power=power,
+                                            models_per_chunk=models_per_chunk)
+    pd.DataFrame({'id': ids, 'toxic': predictions}) \
+        .to_csv('data/power_ensemble_{}.csv'.format(len(list_csv)), index=False)
 
 
-def ensemble_rank_avg_csv(list_csv):
+def ensemble_rank_avg_csv(list_csv, models_per_chunk=None):
     """ Rank averaging given list of CSVs """
-    predict_list = [pd.read_csv(curr_csv).sort_values('id').set_index('id') for curr_csv in list_csv]
-    predictions = np.zeros_like(predict_list[0]['toxic'])
-    for predict in predict_list:
-        curr_preds = rankdata(predict['toxic'].values) / predictions.shape[0]
-        predictions = np.add(predictions, curr_preds)
-    predictions /= len(predict_list)
-    predict_list[0]['toxic'] = predictions
-    predict_list[0].reset_index().to_csv('data/rank_ensemble_{}.csv'.format(len(list_csv)), index=False)
+    ids, predictions = ensemble_predictions(list_csv, method='rank', models_per_chunk=models_per_chunk)
+    pd.DataFrame({'id': ids, 'toxic': predictions}) \
+        .to_csv('data/rank_ensemble_{}.csv'.format(len(list_csv)), index=False)
+
+
+def lang_weights_to_rows(lang_weights, langs, default_weight):
+    """ Per-row weights from a {lang: weight} dict """
+    if len(langs) == 0:
+        raise ValueError('Per-lang weights need a lang column in the base predictions')
+    return np.array([lang_weights.get(x, default_weight) for x in langs], dtype=np.float64)
+
+
+class EnsembleState:
+    """
+    Persistent running-sum ensemble of prediction CSVs, blended onto a base (previous ensemble) prediction set
+    - binary state ($state_dir/state.npz): sorted ids, base toxicity (+ lang if the base CSV has it),
+      per-id running sums, weights and counts of the current run's prediction CSVs
+    - manifest ($state_dir/manifest.json): base CSV and the summed-in prediction CSVs, keyed by content hash
+      (w/ path, size & mtime, so that unchanged files don't get re-hashed)
+    - adding a prediction CSV costs a single pass over that CSV - an overwritten CSV w/ new content is a new CSV
+    - a base CSV w/ new content resets the state, while a summed-in CSV that's no longer listed (or was
+      overwritten) rebuilds the current run's sums from the listed CSVs
+    """
+    HASH_BLOCK_SIZE = 2 ** 20
+
+    def __init__(self, state_dir, base_csv):
+        if not os.path.exists(state_dir):
+            os.makedirs(state_dir)
+        self.state_path = os.path.join(state_dir, 'state.npz')
+        self.manifest_path = os.path.join(state_dir, 'manifest.json')
+
+        self.manifest = None
+        if os.path.exists(self.manifest_path) and os.path.exists(self.state_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        if self.manifest is None or 'base' not in self.manifest:
+            self.reset(base_csv)
+            return
+
+        with np.load(self.state_path, allow_pickle=True) as state:
+            self.ids, self.base = state['ids'], state['base']
+            self.langs = state['langs'] if 'langs' in state.files else np.array([], dtype=object)
+            self.sums, self.weights, self.counts = state['sums'], state['weights'], state['counts']
+        base_hash = self._content_hash(base_csv, self.manifest['base'])
+        if base_hash == self.manifest['base']['hash']:
+            self.manifest['base'] = self._file_entry(base_csv, base_hash)
+        else:
+            self.reset(base_csv, base_hash)
+
+    @staticmethod
+    def _signature(path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    @classmethod
+    def _content_hash(cls, path, entry=None):
+        """ blake2b hex digest of a file - taken from its manifest entry if path, size & mtime still match """
+        if entry is not None and entry['path'] == path and entry['signature'] == cls._signature(path):
+            return entry['hash']
+        digest = hashlib.blake2b()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(cls.HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _file_entry(self, path, content_hash):
+        return {'path': path, 'signature': self._signature(path), 'hash': content_hash}
+
+    def reset(self, base_csv, base_hash=None):
+        base_df = pd.read_csv(base_csv, usecols=lambda x: x in ('id', 'toxic', 'lang')).sort_values('id')
+        self.ids = base_df['id'].values
+        self.base = base_df['toxic'].values.astype(np.float64)
+        self.langs = base_df['lang'].values if 'lang' in base_df.columns else np.array([], dtype=object)
+        if base_hash is None:
+            base_hash = self._content_hash(base_csv)
+        self.manifest = {'base': self._file_entry(base_csv, base_hash), 'predictions': {}}
+        self.reset_sums()
+
+    def reset_sums(self):
+        self.sums = np.zeros(len(self.ids), dtype=np.float64)
+        self.weights = np.zeros(len(self.ids), dtype=np.float64)
+        self.counts = np.zeros(len(self.ids), dtype=np.int64)
+        self.manifest['predictions'] = {}
+
+    def add_csv(self, csv_path, weight=1., content_hash=None):
+        """ Adds weight * toxic of a prediction CSV to the running sums of its ids """
+        if content_hash is None:
+            content_hash = self._content_hash(csv_path)
+        curr_df = pd.read_csv(csv_path, usecols=['id', 'toxic'])
+        curr_ids = curr_df['id'].values
+        positions = np.minimum(np.searchsorted(self.ids, curr_ids), len(self.ids) - 1)
+        if not (self.ids[positions] == curr_ids).all():
+            raise ValueError('{} has ids missing from the base predictions'.format(csv_path))
+        self.sums[positions] += weight * curr_df['toxic'].values
+        self.weights[positions] += weight
+        self.counts[positions] += 1
+        self.manifest['predictions'][content_hash] = dict(self._file_entry(csv_path, content_hash), weight=weight)
+
+    def sync(self, list_csv, weight=1.):
+        """
+        Brings the running sums in line w/ list_csv - only CSVs whose content isn't summed in yet are read,
+        unless a summed-in CSV is no longer listed (then all of list_csv is re-added)
+        """
+        included = self.manifest['predictions']
+        by_path = {entry['path']: entry for entry in included.values()}
+        list_hashes = [self._content_hash(x, by_path.get(x)) for x in list_csv]
+        if any(x not in list_hashes or entry['weight'] != weight for x, entry in included.items()):
+            print('Prediction files changed - rebuilding ensemble running sums of the current run')
+            self.reset_sums()
+        num_added = 0
+        for curr_csv, content_hash in zip(list_csv, list_hashes):
+            if content_hash not in self.manifest['predictions']:
+                self.add_csv(curr_csv, weight, content_hash)
+                num_added += 1
+        print('Ensemble state: added {} new of {} prediction files'.format(num_added, len(list_csv)))
+
+    def save(self):
+        """ Writes state then manifest, each via a temp file + rename """
+        tmp_state_path = self.state_path[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp_state_path, ids=self.ids, base=self.base, langs=self.langs,
+                 sums=self.sums, weights=self.weights, counts=self.counts)
+        os.replace(tmp_state_path, self.state_path)
+        with open(self.manifest_path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+
+    def save_blend(self, csv_path, ensemble_weight, default_weight=0.5):
+        """ Writes the blend (see blend) to an id, toxic CSV """
+        ids, toxic = self.blend(ensemble_weight, default_weight)
+        pd.DataFrame({'id': ids, 'toxic': toxic}).to_csv(csv_path, index=False)
+
+    def run_average(self):
+        """ :return: (ids, weighted average toxicity) tuple for ids w/ at least 1 prediction """
+        has_preds = self.weights > 0
+        return self.ids[has_preds], self.sums[has_preds] / self.weights[has_preds]
+
+    def blend(self, ensemble_weight, default_weight=0.5):
+        """
+        :param ensemble_weight: weight of the base predictions (running averages get 1 - ensemble_weight),
+                                or a {lang: weight} dict (needs a base CSV w/ a lang column)
+        :param default_weight: weight for langs missing from an ensemble_weight dict
+        :return: (ids, toxicity) tuple - base toxicity where ids have no predictions
+        """
+        if isinstance(ensemble_weight, dict):
+            ensemble_weight = lang_weights_to_rows(ensemble_weight, self.langs, default_weight)
+        toxic = self.base.copy()
+        has_preds = self.weights > 0
+        if not np.isscalar(ensemble_weight):
+            ensemble_weight = ensemble_weight[has_preds]
+        toxic[has_preds] = ensemble_weight * self.base[has_preds] + \
+            (1 - ensemble_weight) * self.sums[has_preds] / self.weights[has_preds]
+        return self.ids, toxic
 
 
 if __name__ == '__main__':
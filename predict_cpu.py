@@ -0,0 +1,81 @@
+"""
+Scores the test set on CPU-only machines w/ a fine-tuned classifier saved by classifier_baseline.py
+- Set MODEL_OUTPUT_DIR in classifier_baseline.py to save the classifier at the end of training
+- Optional dynamic int8 quantization of the Linear layers (QUANTIZE flag)
+- Intra-op/inter-op thread counts set w/ NUM_THREADS/NUM_INTEROP_THREADS
+- Batch size is autotuned on a sample of test rows if BATCH_SIZE is None
+- Parity check: validation AUC of the fp32 vs quantized model, and rows/sec of each
+- Saves predictions to $TRAIN_DATA_DIR/curr_run_cpu_preds.csv
+"""
+import os
+import time
+import numpy as np
+import pandas as pd
+from transformers import AutoTokenizer
+from classifier_baseline import SETTINGS_DICT, TEST_CSV_PATH, VAL_CSV_PATH, MAX_SEQ_LEN, cln, load_classifier
+from scoring import fast_roc_auc
+from preprocessor import get_id_text_label_from_csv, get_id_text_from_test_csv, encode_strings
+from torch_helpers import get_sequence_lengths, predict_probs, configure_cpu_threads, quantize_linear_layers, \
+    autotune_batch_size
+
+MODEL_DIR = 'models/classifier_baseline/'  # MODEL_OUTPUT_DIR of the training run
+OUTPUT_PATH = os.path.join(SETTINGS_DICT['TRAIN_DATA_DIR'], 'curr_run_cpu_preds.csv')
+QUANTIZE = True  # dynamic int8 quantization of Linear layers
+NUM_THREADS = None  # intra-op threads (None = torch default, typically # physical cores)
+NUM_INTEROP_THREADS = None  # inter-op threads (None = torch default)
+BATCH_SIZE = None  # None = autotune
+PARITY_CHECK = True  # compare fp32 vs quantized predictions against the validation set
+
+
+def timed_predict(model, features, lengths, batch_size):
+    """ :return: (predictions, rows/sec) tuple """
+    start_time = time.time()
+    preds = predict_probs(model, features, lengths, batch_size)
+    return preds, len(preds) / (time.time() - start_time)
+
+
+def parity_check(fp32_model, quantized_model, features, lengths, labels, batch_size):
+    """
+    Validation AUC delta between fp32 and quantized predictions + throughput of each
+    """
+    fp32_preds, fp32_throughput = timed_predict(fp32_model, features, lengths, batch_size)
+    quantized_preds, quantized_throughput = timed_predict(quantized_model, features, lengths, batch_size)
+    fp32_auc = fast_roc_auc(labels, fp32_preds)
+    quantized_auc = fast_roc_auc(labels, quantized_preds)
+    print('fp32 AUC: {:.5f} ({:.1f} rows/sec)'.format(fp32_auc, fp32_throughput))
+    print('int8 AUC: {:.5f} ({:.1f} rows/sec)'.format(quantized_auc, quantized_throughput))
+    print('AUC delta: {:.5f}, max abs pred diff: {:.5f}, speedup: {:.2f}x'.format(
+        quantized_auc - fp32_auc,
+        np.abs(quantized_preds - fp32_preds).max(),
+        quantized_throughput / fp32_throughput))
+
+
+if __name__ == '__main__':
+    start_time = time.time()
+    configure_cpu_threads(NUM_THREADS, NUM_INTEROP_THREADS)
+
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_DIR)
+    classifier = load_classifier(MODEL_DIR)
+    scoring_model = quantize_linear_layers(classifier) if QUANTIZE else classifier
+
+    test_ids, test_strings = get_id_text_from_test_csv(TEST_CSV_PATH, text_col='comment_text')
+    test_features = encode_strings([cln(x) for x in test_strings], tokenizer, MAX_SEQ_LEN)
+    test_lengths = get_sequence_lengths(test_features, tokenizer.pad_token_id)
+
+    batch_size = BATCH_SIZE
+    if batch_size is None:
+        batch_size = autotune_batch_size(scoring_model, test_features, test_lengths)
+        print('Autotuned batch size: {}'.format(batch_size))
+
+    if PARITY_CHECK and QUANTIZE:
+        val_ids, val_strings, val_labels = get_id_text_label_from_csv(VAL_CSV_PATH, text_col='comment_text')
+        if len(val_ids) > 0:
+            val_features = encode_strings([cln(x) for x in val_strings], tokenizer, MAX_SEQ_LEN)
+            parity_check(classifier, scoring_model, val_features,
+                         get_sequence_lengths(val_features, tokenizer.pad_token_id), val_labels, batch_size)
+
+    test_preds, test_throughput = timed_predict(scoring_model, test_features, test_lengths, batch_size)
+    print('Scored {} test rows at {:.1f} rows/sec'.format(len(test_preds), test_throughput))
+    pd.DataFrame({'id': test_ids, 'toxic': test_preds}).to_csv(OUTPUT_PATH, index=False)
+
+    print('Elapsed time: {}'.format(time.time() - start_time))
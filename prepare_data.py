@@ -4,36 +4,140 @@ Generates the training data CSV file required for model training (either Transfo
 - Saves training data to $TRAIN_DATA_DIR/curr_run_train.csv
 - Saves validation data to $TRAIN_DATA_DIR/curr_run_val.csv
 - Saves test data to $TRAIN_DATA_DIR/curr_run_test.csv (to predict against)
+- Output format set by $DATA_FORMAT: csv (default), parquet or arrow (Arrow IPC) - file extensions change to match
+- STREAMING mode reads inputs in CHUNK_SIZE-row chunks (only the needed columns), filters/samples each chunk
+  and appends it to the outputs, so peak memory doesn't grow w/ input size
 """
 import json
 import os
+import numpy as np
 import pandas as pd
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # only needed for parquet/arrow outputs
+    pa = pq = None
 
 LANG_LIST = ['es']  # list of test set language ISOs to create data for
 SAMPLE_FRAC = 0.5  # Proportion of 2018 data (after filtering for LANG_LIST languages) to sub-sample for training
+STREAMING = True  # read/filter/write in chunks instead of loading the full CSVs into memory
+CHUNK_SIZE = 100000  # rows per chunk in STREAMING mode
+SEED = 1337  # seeds the per-chunk sampling RNG in STREAMING mode
+TRAIN_COLS = ['id', 'comment_text', 'lang', 'toxic']
+# pseudo-labels = test.csv (text in 'content') merged w/ the predicted toxic column - renamed to TRAIN_COLS
+PSEUDO_LABEL_COLS = {'id': 'id', 'content': 'comment_text', 'comment_text': 'comment_text', 'lang': 'lang',
+                     'toxic': 'toxic'}
+# parquet/arrow column types of the curr_run_* files ('id' is int64 for val/test, string for train)
+COLUMN_TYPES = {'comment_text': 'string', 'lang': 'string', 'toxic': 'float64'}
 
-if __name__ == '__main__':
-    with open('SETTINGS.json') as f:
-        settings_dict = json.load(f)
 
+def stream_lang_chunks(csv_path, usecols=None):
+    """ Yields CHUNK_SIZE-row chunks of csv_path, keeping only LANG_LIST rows """
+    for chunk in pd.read_csv(csv_path, usecols=usecols, chunksize=CHUNK_SIZE):
+        yield chunk[chunk['lang'].isin(LANG_LIST)]
+
+
+class FrameWriter:
+    """
+    Appends DataFrame chunks to a single CSV, Parquet or Arrow IPC file
+    - the parquet/arrow schema is explicit (TRAIN_COLS w/ COLUMN_TYPES), so an empty or all-NaN chunk can't
+      leave null-typed columns that later chunks fail to write to; every chunk gets cast to it
+    :param id_type: arrow type alias of the 'id' column
+    """
+
+    def __init__(self, path, data_format, id_type='int64'):
+        if data_format != 'csv' and pa is None:
+            raise ImportError('DATA_FORMAT={} requires pyarrow'.format(data_format))
+        self.path = path
+        self.data_format = data_format
+        self.num_chunks = 0
+        self.schema = None
+        if data_format != 'csv':
+            self.schema = pa.schema([(x, pa.type_for_alias(COLUMN_TYPES.get(x, id_type))) for x in TRAIN_COLS])
+        self.writer = None
+
+    def write(self, df):
+        self.num_chunks += 1
+        if self.data_format == 'csv':
+            df.to_csv(self.path, mode='w' if self.num_chunks == 1 else 'a', header=self.num_chunks == 1, index=False)
+            return
+        self._open()
+        self.writer.write_table(pa.Table.from_pandas(df, schema=self.schema, preserve_index=False))
+
+    def _open(self):
+        if self.writer is None:
+            if self.data_format == 'parquet':
+                self.writer = pq.ParquetWriter(self.path, self.schema)
+            else:
+                self.writer = pa.ipc.new_file(self.path, self.schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if self.schema is not None:
+            self._open()  # an empty file w/ the schema if no chunk was written
+            self.writer.close()
+
+
+def get_output_path(settings_dict, name):
+    return os.path.join(settings_dict['TRAIN_DATA_DIR'], '{}.{}'.format(name, settings_dict['DATA_FORMAT']))
+
+
+def prepare_in_memory(settings_dict):
     # Generate and save validation samples
     language_val = pd.read_csv(settings_dict['VALIDATION_PATH'])
     language_val = language_val[language_val['lang'].isin(LANG_LIST)].reset_index(drop=True)
-    language_val.to_csv(os.path.join(settings_dict['TRAIN_DATA_DIR'], 'curr_run_val.csv'),
-                        index=False)
+    with FrameWriter(get_output_path(settings_dict, 'curr_run_val'), settings_dict['DATA_FORMAT']) as writer:
+        writer.write(language_val)
 
     # Generate and save test samples
-    test_df = pd.read_csv(settings_dict['PSEUDO_LABELS_PATH'])
-    language_df = test_df[test_df.lang.isin(LANG_LIST)]
-    language_df.columns = ['id', 'comment_text', 'lang', 'toxic']
-    language_df.to_csv(os.path.join(settings_dict['TRAIN_DATA_DIR'], 'curr_run_test.csv'),
-                       index=False)
+    test_df = pd.read_csv(settings_dict['PSEUDO_LABELS_PATH'], usecols=lambda x: x in PSEUDO_LABEL_COLS)
+    language_df = test_df[test_df.lang.isin(LANG_LIST)].rename(columns=PSEUDO_LABEL_COLS)[TRAIN_COLS]
+    with FrameWriter(get_output_path(settings_dict, 'curr_run_test'), settings_dict['DATA_FORMAT']) as writer:
+        writer.write(language_df)
 
     # Generate and save train samples
     translated_toxic = pd.read_csv(settings_dict['TRAIN_2018_PATH'])
     translated_toxic = translated_toxic[translated_toxic['lang'].isin(LANG_LIST)] \
         .sample(frac=SAMPLE_FRAC)
-    translated_toxic = translated_toxic[['id', 'comment_text', 'lang', 'toxic']]
-    pd.concat([language_df, translated_toxic]) \
-        .reset_index(drop=True).to_csv(os.path.join(settings_dict['TRAIN_DATA_DIR'], 'curr_run_train.csv'),
-                                       index=False)
+    translated_toxic = translated_toxic[TRAIN_COLS]
+    train_df = pd.concat([language_df, translated_toxic]).reset_index(drop=True)
+    train_df['id'] = train_df['id'].astype(str)  # pseudo-label (int) and 2018 (hex str) ids share the column
+    with FrameWriter(get_output_path(settings_dict, 'curr_run_train'), settings_dict['DATA_FORMAT'],
+                     id_type='string') as writer:
+        writer.write(train_df)
+
+
+def prepare_streaming(settings_dict):
+    data_format = settings_dict['DATA_FORMAT']
+    rng = np.random.RandomState(SEED)
+
+    # Generate and save validation samples
+    with FrameWriter(get_output_path(settings_dict, 'curr_run_val'), data_format) as val_writer:
+        for chunk in stream_lang_chunks(settings_dict['VALIDATION_PATH'], usecols=TRAIN_COLS):
+            val_writer.write(chunk)
+
+    train_path = get_output_path(settings_dict, 'curr_run_train')
+    with FrameWriter(get_output_path(settings_dict, 'curr_run_test'), data_format) as test_writer, \
+            FrameWriter(train_path, data_format, id_type='string') as train_writer:
+        # Generate and save test samples - pseudo-labels are also the first train samples
+        for chunk in stream_lang_chunks(settings_dict['PSEUDO_LABELS_PATH'], usecols=lambda x: x in PSEUDO_LABEL_COLS):
+            chunk = chunk.rename(columns=PSEUDO_LABEL_COLS)[TRAIN_COLS]
+            test_writer.write(chunk)
+            train_writer.write(chunk.assign(id=chunk['id'].astype(str)))
+
+        # Generate and save train samples
+        for chunk in stream_lang_chunks(settings_dict['TRAIN_2018_PATH'], usecols=TRAIN_COLS):
+            chunk = chunk.sample(frac=SAMPLE_FRAC, random_state=rng)[TRAIN_COLS]
+            train_writer.write(chunk.assign(id=chunk['id'].astype(str)))
+
+
+if __name__ == '__main__':
+    with open('SETTINGS.json') as f:
+        settings_dict = json.load(f)
+
+    if STREAMING:
+        prepare_streaming(settings_dict)
+    else:
+        prepare_in_memory(settings_dict)
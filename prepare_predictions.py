@@ -4,30 +4,108 @@ blends them with the previous ensembled predictions,
 saves to a single CSV ready for submission to the LB
 - Averages epoch predictions and saves to $TRAIN_DATA_DIR/curr_run_preds.csv
 - Blends with previous ensemble and saves to $TRAIN_DATA_DIR/curr_run_submission.csv
+- USE_ENSEMBLE_STATE keeps running sums in $TRAIN_DATA_DIR/ensemble_state/ so that re-runs only read
+  prediction files that weren't summed in yet - the pseudo-labels CSV isn't read when it's unchanged, and the
+  submission gets written from the state
+- BLEND_SEARCH picks the blend weight(s) maximizing validation AUC of the blend of the previous ensemble's
+  validation predictions ($PREVIOUS_VAL_PREDS_PATH) and the current run's ($VAL_PREDICTION_DIR), instead of
+  using ENSEMBLE_WEIGHT - either a single weight ('global') or one per language ('lang')
+  - the weight is searched on the epochs w/ validation predictions (the Transformer doesn't save them for the epochs
+    trained against the val dataset), but applied to the average of every epoch's test predictions - unless
+    BLEND_MATCHING_EPOCHS, which only averages the test predictions of those same epochs
+  - saves the blended validation predictions to $TRAIN_DATA_DIR/curr_run_val_submission.csv - the next run's
+    $PREVIOUS_VAL_PREDS_PATH
 """
 import json
 import os
 import pandas as pd
-from postprocessor import ensemble_simple_avg_csv
+from postprocessor import ensemble_simple_avg_csv, ensemble_predictions, lang_weights_to_rows, EnsembleState
+from preprocessor import read_frame
+from scoring import RocAucScorer, search_blend_weight, search_blend_weights_by_group
 
 # blend weight of the previous ensembled predictions (i.e., current preds will have 1-ENSEMBLE_WEIGHT weight)
 ENSEMBLE_WEIGHT = 0.5
+USE_ENSEMBLE_STATE = True  # incremental running-sum ensemble instead of re-averaging every prediction file
+BLEND_SEARCH = None  # None = use ENSEMBLE_WEIGHT, 'global' = search 1 weight, 'lang' = search 1 weight per language
+# w/ BLEND_SEARCH: only average the test predictions of the epochs that have validation predictions
+BLEND_MATCHING_EPOCHS = False
+
+
+def search_ensemble_weight(settings_dict):
+    """
+    Searches blend weight(s) of the previous ensemble by validation AUC, saves the blended validation predictions
+    :return: float weight ('global') or {lang: weight} dict ('lang')
+    """
+    # current run's validation predictions - averaged across epochs
+    val_csv = sorted([os.path.join(settings_dict['VAL_PREDICTION_DIR'], x)
+                      for x in os.listdir(settings_dict['VAL_PREDICTION_DIR'])])
+    val_ids, curr_preds = ensemble_predictions(val_csv)
+
+    # validation targets of the predicted ids (e.g., the BiGRU only predicts USE_LANG rows)
+    val_df = read_frame(os.path.join(settings_dict['TRAIN_DATA_DIR'],
+                                     'curr_run_val.{}'.format(settings_dict['DATA_FORMAT'])),
+                        columns=['id', 'toxic', 'lang']).set_index('id').loc[val_ids]
+    prev_df = pd.read_csv(settings_dict['PREVIOUS_VAL_PREDS_PATH']).set_index('id')
+    prev_preds = prev_df.loc[val_ids, 'toxic'].values
+
+    scorer = RocAucScorer(val_df['toxic'].values, groups=val_df['lang'].values)
+    print('Val AUC - previous ensemble: {:.5f}, current run: {:.5f}'.format(scorer.score(prev_preds),
+                                                                            scorer.score(curr_preds)))
+    if BLEND_SEARCH == 'lang':
+        group_weights = search_blend_weights_by_group(scorer, prev_preds, curr_preds)
+        for lang, (weight, auc) in group_weights.items():
+            print('{} - ENSEMBLE_WEIGHT: {:.4f}, val AUC: {:.5f}'.format(lang, weight, auc))
+        weight = {lang: lang_weight for lang, (lang_weight, _) in group_weights.items()}
+        row_weights = lang_weights_to_rows(weight, val_df['lang'].values, ENSEMBLE_WEIGHT)
+    else:
+        weight, auc = search_blend_weight(scorer, prev_preds, curr_preds)
+        print('ENSEMBLE_WEIGHT: {:.4f}, val AUC: {:.5f}'.format(weight, auc))
+        row_weights = weight
+
+    # validation rows the current run didn't predict keep the previous ensemble's predictions
+    prev_df.loc[val_ids, 'toxic'] = row_weights * prev_preds + (1 - row_weights) * curr_preds
+    prev_df.reset_index().to_csv(os.path.join(settings_dict['TRAIN_DATA_DIR'], 'curr_run_val_submission.csv'),
+                                 index=False)
+    return weight
+
 
 if __name__ == '__main__':
     with open('SETTINGS.json') as f:
         settings_dict = json.load(f)
 
     x = sorted([os.path.join(settings_dict['PREDICTION_DIR'], x) for x in os.listdir(settings_dict['PREDICTION_DIR'])])
+    ensemble_weight = ENSEMBLE_WEIGHT
+    if BLEND_SEARCH is not None:
+        ensemble_weight = search_ensemble_weight(settings_dict)
+        if BLEND_MATCHING_EPOCHS:
+            val_epochs = set(os.listdir(settings_dict['VAL_PREDICTION_DIR']))
+            x = [path for path in x if os.path.basename(path) in val_epochs]
+
+    if USE_ENSEMBLE_STATE:
+        ensemble_state = EnsembleState(os.path.join(settings_dict['TRAIN_DATA_DIR'], 'ensemble_state'),
+                                       settings_dict['PSEUDO_LABELS_PATH'])
+        ensemble_state.sync(x)
 
-    # Average-ensemble current run's predictions and save
-    ensemble_simple_avg_csv(x, output_path=os.path.join(settings_dict['TRAIN_DATA_DIR'], 'curr_run_preds.csv'))
-    preds_df = pd.read_csv(os.path.join(settings_dict['TRAIN_DATA_DIR'], 'curr_run_preds.csv'))
+        # Save current run's averaged predictions, then the blend w/ the previous ensembled predictions
+        ids, toxic = ensemble_state.run_average()
+        pd.DataFrame({'id': ids, 'toxic': toxic}) \
+            .to_csv(os.path.join(settings_dict['TRAIN_DATA_DIR'], 'curr_run_preds.csv'), index=False)
+        ensemble_state.save_blend(os.path.join(settings_dict['TRAIN_DATA_DIR'], 'curr_run_submission.csv'),
+                                  ensemble_weight, default_weight=ENSEMBLE_WEIGHT)
+        ensemble_state.save()
+    else:
+        # Average-ensemble current run's predictions and save
+        ensemble_simple_avg_csv(x, output_path=os.path.join(settings_dict['TRAIN_DATA_DIR'], 'curr_run_preds.csv'))
+        preds_df = pd.read_csv(os.path.join(settings_dict['TRAIN_DATA_DIR'], 'curr_run_preds.csv'))
 
-    # Load previous ensembled predictions
-    test_df = pd.read_csv(settings_dict['PSEUDO_LABELS_PATH'])
+        # Load previous ensembled predictions
+        test_df = pd.read_csv(settings_dict['PSEUDO_LABELS_PATH'])
+        if isinstance(ensemble_weight, dict):
+            ensemble_weight = lang_weights_to_rows(ensemble_weight, test_df.loc[preds_df.id.values, 'lang'].values,
+                                                   ENSEMBLE_WEIGHT)
 
-    # Blend and save
-    test_df.loc[preds_df.id.values, 'toxic'] = ENSEMBLE_WEIGHT * test_df.loc[preds_df.id.values, 'toxic'].values + \
-                                               (1-ENSEMBLE_WEIGHT) * preds_df['toxic'].values
-    test_df[['id', 'toxic']].to_csv(os.path.join(settings_dict['TRAIN_DATA_DIR'], 'curr_run_submission.csv'),
-                                    index=False)
+        # Blend and save
+        test_df.loc[preds_df.id.values, 'toxic'] = ensemble_weight * test_df.loc[preds_df.id.values, 'toxic'].values + \
+                                                   (1-ensemble_weight) * preds_df['toxic'].values
+        test_df[['id', 'toxic']].to_csv(os.path.join(settings_dict['TRAIN_DATA_DIR'], 'curr_run_submission.csv'),
+                                        index=False)
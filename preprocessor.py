@@ -1,13 +1,25 @@
+import os
+import hashlib
+import itertools
+import weakref
+import multiprocessing as mp
 import numpy as np
 import pandas as pd
 from functools import lru_cache
+from collections import Counter
 from sklearn.model_selection import KFold
 from scipy.stats import truncnorm
-from random import random
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:  # only needed for parquet/arrow data files - CSVs load w/ pandas alone
+    pa = pq = pc = None
 
 SEED = 1337
 NUM_FOLDS = 4
 TOXIC_TARGET_COLS = ['toxic', 'severe_toxic', 'obscene', 'threat', 'insult', 'identity_hate']
+KERAS_FILTERS = '!"#$%&()*+,-./:;<=>?@[\\]^_`{|}~\t\n'  # keras Tokenizer default filters
 LANG_MAPPING = {lang: np.identity(7)[i] for i, lang in enumerate(['en', 'tr', 'pt', 'ru', 'fr', 'it', 'es'])}
 
 
@@ -21,16 +33,48 @@ def generate_train_kfolds_indices(input_df):
             seeded_kf.split(range(len(input_df)))]
 
 
+def read_frame(path, columns=None, lang=None):
+    """
+    Loads a CSV, Parquet (.parquet) or Arrow IPC (.arrow) data file into a DataFrame
+    - only the listed columns are read (column pruning)
+    - for parquet, the lang predicate is pushed down to the reader (skips non-matching row groups)
+    - arrow files are memory-mapped, and filtered before conversion to pandas
+    :param path: data file path, format picked by extension
+    :param columns: list of columns to keep (None = all)
+    :param lang: keep only rows w/ this 'lang' value (None = all)
+    """
+    if columns is not None and lang is not None and 'lang' not in columns:
+        columns = columns + ['lang']
+    if path.endswith(('.parquet', '.arrow')) and pa is None:
+        raise ImportError('DATA_FORMAT={} requires pyarrow'.format(os.path.splitext(path)[1][1:]))
+
+    if path.endswith('.parquet'):
+        table = pq.read_table(path, columns=columns,
+                              filters=None if lang is None else [('lang', '=', lang)])
+        return table.to_pandas()
+    if path.endswith('.arrow'):
+        with pa.memory_map(path, 'r') as source:
+            table = pa.ipc.open_file(source).read_all()
+            if columns is not None:
+                table = table.select(columns)
+            if lang is not None:
+                table = table.filter(pc.equal(table['lang'], lang))
+            return table.to_pandas()
+
+    raw_df = pd.read_csv(path, usecols=columns)
+    if lang is not None:
+        raw_df = raw_df[raw_df['lang'] == lang]
+    return raw_df
+
+
 def get_id_text_label_from_csv(csv_path, text_col='comment_text',
                                sample_frac=1.,
                                add_label=None,
                                lang=None):
     """
-    Load training data
+    Load training data (CSV, Parquet or Arrow - see read_frame)
     """
-    raw_df = pd.read_csv(csv_path)
-    if lang is not None:
-        raw_df = raw_df[raw_df['lang'] == lang]
+    raw_df = read_frame(csv_path, columns=['id', text_col, 'toxic'], lang=lang)
     if sample_frac < 1:
         raw_df = raw_df.sample(frac=sample_frac)
     if add_label is None:
@@ -46,7 +90,7 @@ def get_translation_pair_from_csv(csv_path,
                                   en_text_col='comment_text_en',
                                   sample_frac=1.):
     """ Returns both raw and translated comments  """
-    raw_df = pd.read_csv(csv_path)
+    raw_df = read_frame(csv_path, columns=['id', raw_text_col, en_text_col, 'toxic'])
     if sample_frac < 1:
         raw_df = raw_df.sample(frac=sample_frac)
     return (raw_df['id'].values,
@@ -60,11 +104,11 @@ def get_balanced_id_text_label_from_csv(csv_path, text_col='comment_text',
                                         add_label=None):
     """
     Load balanced dataset - 0.5 * sample from positives, 0.5 from negatives w/ replacement
-    :param csv_path: path of csv with 'id' 'comment_text', 'toxic' columns present
+    :param csv_path: path of csv/parquet/arrow file with 'id' 'comment_text', 'toxic' columns present
     :param sample: NUMBER of samples to draw
     :return:
     """
-    raw_df = pd.read_csv(csv_path)
+    raw_df = read_frame(csv_path, columns=['id', text_col, 'toxic'])
     if sample is not None:
         positive_df, negative_df = raw_df[raw_df.toxic == 1], raw_df[raw_df.toxic == 0]
         raw_df = pd.concat([positive_df.sample(n=sample//2, replace=True),
@@ -80,14 +124,248 @@ def get_balanced_id_text_label_from_csv(csv_path, text_col='comment_text',
 def get_id_text_from_test_csv(csv_path, text_col):
     """
     Load test data
-    :param csv_path: path of csv with 'id' 'comment_text' columns present
+    :param csv_path: path of csv/parquet/arrow file with 'id' 'comment_text' columns present
     :param text_col: column w/ test
     :return:
     """
-    raw_pdf = pd.read_csv(csv_path)
+    raw_pdf = read_frame(csv_path, columns=['id', text_col])
     return raw_pdf['id'].values, list(raw_pdf[text_col].values)
 
 
+_worker_tokenizer = None
+_worker_max_len = None
+
+
+def _init_encode_worker(tokenizer, max_len, seed=None, worker_counter=None):
+    """
+    Pool initializer - pickles the tokenizer once per worker instead of once per task
+    - re-seeds the WordPiece dropout of tokenize-monkeypatched tokenizers w/ the worker's index in the pool mixed in,
+      so that workers (forked w/ the parent's RNG state) don't replay the same dropout draws
+    """
+    global _worker_tokenizer, _worker_max_len
+    _worker_tokenizer, _worker_max_len = tokenizer, max_len
+    if seed is not None:
+        with worker_counter.get_lock():
+            worker_index = worker_counter.value
+            worker_counter.value += 1
+        seed = [int(x) for x in np.atleast_1d(seed)] + [worker_index]
+    seed_wordpiece_dropout(seed)
+
+
+def _encode_chunk(strings):
+    return np.array([_worker_tokenizer.encode(x,
+                                              truncation=True,
+                                              max_length=_worker_max_len,
+                                              pad_to_max_length=True,
+                                              add_special_tokens=True) for x in strings], dtype=np.int32)
+
+
+def encode_strings(strings, tokenizer, max_len, chunk_size=10000, num_workers=1, seed=None):
+    """
+    Encodes strings into a preallocated [len(strings), max_len] int32 array of padded token IDs
+    - fast (Rust) tokenizers encode each chunk of strings w/ a single batched call
+    - slow tokenizers fall back to per-string encode, spread over num_workers processes a chunk at a time
+    :param strings: list of raw strings
+    :param tokenizer: HuggingFace tokenizer
+    :param max_len: rows are truncated/padded to this length
+    :param chunk_size: number of strings encoded per call/task
+    :param num_workers: processes used by the slow tokenizer fallback
+    :param seed: slow tokenizers w/ a tokenize-monkeypatched WordPiece: dropout seed of the workers, e.g., (SEED, epoch)
+                 for per-epoch augmentation, w/ each worker's index mixed in - None = fresh entropy
+                 (reproducible w/ num_workers=1 - more workers pick up chunks in whichever order they free up)
+    :return: [len(strings), max_len] int32 array
+    """
+    token_ids = np.empty((len(strings), max_len), dtype=np.int32)
+    chunk_starts = range(0, len(strings), chunk_size)
+
+    if getattr(tokenizer, 'is_fast', False):
+        for chunk_start in chunk_starts:
+            encoded = tokenizer(strings[chunk_start:chunk_start + chunk_size],
+                                truncation=True,
+                                max_length=max_len,
+                                padding='max_length',
+                                add_special_tokens=True,
+                                return_attention_mask=False,
+                                return_token_type_ids=False)
+            token_ids[chunk_start:chunk_start + chunk_size] = encoded['input_ids']
+    else:
+        chunks = (strings[chunk_start:chunk_start + chunk_size] for chunk_start in chunk_starts)
+        worker_counter = mp.Value('i', 0)
+        with mp.Pool(num_workers, initializer=_init_encode_worker,
+                     initargs=(tokenizer, max_len, seed, worker_counter)) as p:
+            # imap keeps the chunk order so each result lands in its preallocated rows
+            for chunk_start, chunk_ids in zip(chunk_starts, p.imap(_encode_chunk, chunks)):
+                token_ids[chunk_start:chunk_start + len(chunk_ids)] = chunk_ids
+    return token_ids
+
+
+def tokenizer_fingerprint(tokenizer):
+    """
+    blake2b hex digest of a HuggingFace tokenizer: its vocab (in ID order), scalar init settings (e.g.,
+    do_lower_case) and special tokens, plus the serialized pipeline of fast (Rust) tokenizers
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for piece, _ in sorted(tokenizer.get_vocab().items(), key=lambda x: x[1]):
+        digest.update(piece.encode('utf-8') + b'\0')
+    settings = {k: v for k, v in getattr(tokenizer, 'init_kwargs', {}).items()
+                if isinstance(v, (str, int, float, bool)) and not k.endswith('_file') and k != 'name_or_path'}
+    digest.update(repr((sorted(settings.items()), sorted(tokenizer.special_tokens_map.items()))).encode('utf-8'))
+    if getattr(tokenizer, 'is_fast', False):
+        digest.update(tokenizer.backend_tokenizer.to_str().encode('utf-8'))
+    return digest.hexdigest()
+
+
+class TokenCache:
+    """
+    Content-addressed on-disk cache of encoded token IDs
+    - one cache sub-dir per (tokenizer, max length) pair - the tokenizer is keyed on a fingerprint of its vocab and
+      settings (see tokenizer_fingerprint), so a tokenizer re-saved/edited under the same name gets a new cache
+    - rows are keyed on a 16-byte blake2b digest of each text
+    - token IDs are stored as a flat int32 file read back through np.memmap
+    - only texts not seen before get passed to the encode function
+    """
+    DIGEST_SIZE = 16
+
+    def __init__(self, cache_dir, model_name, tokenizer, max_len):
+        self.max_len = max_len
+        cache_key = '{}|{}|{}|{}|{}'.format(model_name, type(tokenizer).__name__, len(tokenizer),
+                                            tokenizer_fingerprint(tokenizer), max_len)
+        self.cache_dir = os.path.join(cache_dir,
+                                      hashlib.blake2b(cache_key.encode('utf-8'), digest_size=8).hexdigest())
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.ids_path = os.path.join(self.cache_dir, 'ids.bin')
+        self.digests_path = os.path.join(self.cache_dir, 'digests.bin')
+
+        # digest file is written last on every append - it decides how many rows are valid
+        digests = b''
+        if os.path.exists(self.digests_path):
+            with open(self.digests_path, 'rb') as f:
+                digests = f.read()
+        num_rows = len(digests) // self.DIGEST_SIZE
+        self.row_lookup = {digests[i * self.DIGEST_SIZE:(i + 1) * self.DIGEST_SIZE]: i
+                           for i in range(num_rows)}
+        with open(self.ids_path, 'ab') as f:  # drop rows left over by an interrupted append
+            f.truncate(num_rows * max_len * 4)
+        with open(self.digests_path, 'ab') as f:
+            f.truncate(num_rows * self.DIGEST_SIZE)
+
+    def __len__(self):
+        return len(self.row_lookup)
+
+    def _digest(self, text):
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=self.DIGEST_SIZE).digest()
+
+    def _append(self, digests, token_ids):
+        token_ids = np.ascontiguousarray(token_ids, dtype=np.int32).reshape(len(digests), self.max_len)
+        with open(self.ids_path, 'ab') as f:
+            f.write(token_ids.tobytes())
+        with open(self.digests_path, 'ab') as f:
+            f.write(b''.join(digests))
+        for digest in digests:
+            self.row_lookup[digest] = len(self.row_lookup)
+
+    def encode(self, strings, encode_fn):
+        """
+        Returns int32 token IDs for strings, encoding only the cache misses
+        :param strings: list of raw strings
+        :param encode_fn: callable mapping a list of strings to a list/array of
+                          max_len padded token ID rows
+        :return: [len(strings), max_len] int32 array
+        """
+        digests = [self._digest(x) for x in strings]
+        miss_digests, miss_strings = [], []
+        seen = set()
+        for digest, text in zip(digests, strings):
+            if digest not in self.row_lookup and digest not in seen:
+                seen.add(digest)
+                miss_digests.append(digest)
+                miss_strings.append(text)
+        if len(miss_strings) > 0:
+            print('Token cache: encoding {} of {} strings'.format(len(miss_strings), len(strings)))
+            self._append(miss_digests, encode_fn(miss_strings))
+
+        if len(self.row_lookup) == 0:
+            return np.zeros((0, self.max_len), dtype=np.int32)
+        all_ids = np.memmap(self.ids_path, dtype=np.int32, mode='r',
+                            shape=(len(self.row_lookup), self.max_len))
+        return np.asarray(all_ids[[self.row_lookup[x] for x in digests]])
+
+
+_keras_translate_map = str.maketrans({x: ' ' for x in KERAS_FILTERS})
+_worker_word_index = None
+
+
+def keras_text_to_words(text):
+    """ Same word split as keras text_to_word_sequence w/ default args (lower-case, filters, split on ' ') """
+    return [x for x in text.lower().translate(_keras_translate_map).split(' ') if x]
+
+
+def _count_words(texts):
+    # Counter keeps first-appearance order, needed to break count ties the way keras does
+    word_counts = Counter()
+    for text in texts:
+        word_counts.update(keras_text_to_words(text))
+    return word_counts
+
+
+def _init_sequence_worker(word_index):
+    global _worker_word_index
+    _worker_word_index = word_index
+
+
+def _texts_to_padded_chunk(args):
+    texts, max_len = args
+    sequences = np.zeros((len(texts), max_len), dtype=np.int32)
+    for row, text in enumerate(texts):
+        sequence = [x for x in map(_worker_word_index.get, keras_text_to_words(text)) if x is not None][-max_len:]
+        if len(sequence) > 0:
+            sequences[row, max_len - len(sequence):] = sequence
+    return sequences
+
+
+class VocabTokenizer:
+    """
+    Multiprocessing drop-in for a keras Tokenizer(num_words=...) w/ default args, followed by pad_sequences
+    - word counts are computed per chunk of texts in parallel, then merged in chunk order so that
+      ties in count are broken by first appearance exactly as in keras - word indices are identical
+    - texts are converted and pre-padded/pre-truncated in parallel chunks into one int32 array
+    """
+
+    def __init__(self, num_words, num_workers=1, chunk_size=10000):
+        self.num_words = num_words
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        self.word_counts = Counter()
+        self.word_index = {}
+        self.index_word = {}
+
+    def _chunks(self, texts):
+        return [texts[i:i + self.chunk_size] for i in range(0, len(texts), self.chunk_size)]
+
+    def fit_on_texts(self, texts):
+        with mp.Pool(self.num_workers) as p:
+            for chunk_counts in p.map(_count_words, self._chunks(texts)):
+                self.word_counts.update(chunk_counts)
+        sorted_words = [x for x, _ in sorted(self.word_counts.items(), key=lambda x: x[1], reverse=True)]
+        self.word_index = dict(zip(sorted_words, range(1, len(sorted_words) + 1)))
+        self.index_word = {i: x for x, i in self.word_index.items()}
+
+    def texts_to_padded_sequences(self, texts, max_len):
+        """
+        Same as keras pad_sequences(tokenizer.texts_to_sequences(texts), maxlen=max_len)
+        :return: [len(texts), max_len] int32 array
+        """
+        # only indices below num_words are kept, as in keras texts_to_sequences
+        frozen_index = {x: i for x, i in self.word_index.items() if self.num_words is None or i < self.num_words}
+        sequences = np.zeros((len(texts), max_len), dtype=np.int32)
+        chunks = self._chunks(texts)
+        with mp.Pool(self.num_workers, initializer=_init_sequence_worker, initargs=(frozen_index,)) as p:
+            for i, chunk_sequences in enumerate(p.imap(_texts_to_padded_chunk, [(x, max_len) for x in chunks])):
+                sequences[i * self.chunk_size:i * self.chunk_size + len(chunk_sequences)] = chunk_sequences
+        return sequences
+
+
 @lru_cache(maxsize=None)
 def generate_target_dist(mean, num_bins, low, high):
     """
@@ -116,6 +394,134 @@ def generate_target_dist(mean, num_bins, low, high):
     return supports, probs
 
 
+class StochasticWordpiece:
+    """
+    Greedy longest-match-first WordPiece w/ BPE-dropout-style vocab lookup failures (see tokenize)
+    - vocab pieces are kept in 2 character tries (word-initial pieces and ## pieces), so the vocab hits at a
+      position of a word are found in 1 walk instead of a substring join + dict lookup per candidate end
+    - the hits of a word and its dropout-free pieces only depend on the vocab, so they are computed once per word
+      (LRU-cached)
+    - each hit is rejected w/ prob dropout, longest hit first: the # of rejected hits at a position is geometric, so
+      a single geometric draw picks the piece - same distribution as a random() call per hit
+    - likewise, a single geometric draw per word gives the # of positions whose longest hit is accepted before the
+      1st rejection - most words take their cached dropout-free pieces w/o further draws
+    - draws come from a numpy Generator, vectorized in blocks of block_size draws
+    :param vocab: {piece: id} dict, e.g., tokenizer.get_vocab() or a WordpieceTokenizer's vocab
+    :param dropout: prob. of failing each vocab hit (0 = deterministic WordPiece)
+    :param seed: int or sequence of ints (e.g., (seed, epoch, worker index)) seeding the Generator - None = fresh
+                 entropy
+    :param cache_size: max # of words whose hits are cached
+    """
+
+    def __init__(self, vocab, unk_token='[UNK]', max_input_chars_per_word=100, dropout=0.1, seed=None,
+                 cache_size=2 ** 20, block_size=2 ** 16):
+        self.unk_token = unk_token
+        self.max_input_chars_per_word = max_input_chars_per_word
+        self.dropout = dropout
+        self.rng = np.random.default_rng(seed)
+        self.block_size = block_size
+        if dropout > 0:
+            self.skips = itertools.chain.from_iterable(self._draw_blocks(1. - dropout))  # rejected hits
+            self.runs = itertools.chain.from_iterable(self._draw_blocks(dropout))  # accepted longest hits
+        else:
+            self.skips, self.runs = itertools.repeat(0), itertools.repeat(max_input_chars_per_word)
+        self.prefix_trie, self.suffix_trie = {}, {}
+        for piece in vocab:
+            # word starts are matched against the literal pieces, later positions against the ## pieces
+            tries = [(self.prefix_trie, piece)]
+            if piece.startswith('##') and len(piece) > 2:
+                tries.append((self.suffix_trie, piece[2:]))
+            for node, chars in tries:
+                for char in chars:
+                    node = node.setdefault(char, {})
+                node[''] = piece  # '' can't be a char - marks the end of a piece
+        self.word_hits = lru_cache(maxsize=cache_size)(self._word_hits)
+
+    def _draw_blocks(self, p):
+        """ Endless blocks of # of failures before the 1st success of prob. p """
+        while True:
+            yield (self.rng.geometric(p, self.block_size) - 1).tolist()
+
+    def _word_hits(self, word):
+        """
+        :return: (hits, path, pieces, tokens) tuple - per start position, a tuple of (end, piece) vocab hits
+                 (longest 1st), the start positions w/ hits visited w/o dropout, the longest hit at each of them,
+                 and the tokens w/o dropout ([UNK] if the path dead-ends before the end of the word)
+        """
+        hits = []
+        for start in range(len(word)):
+            node = self.prefix_trie if start == 0 else self.suffix_trie
+            start_hits = []
+            for end in range(start, len(word)):
+                node = node.get(word[end])
+                if node is None:
+                    break
+                if '' in node:
+                    start_hits.append((end + 1, node['']))
+            hits.append(tuple(reversed(start_hits)))
+
+        path, pieces = [], []
+        start = 0
+        while start < len(word) and hits[start]:
+            path.append(start)
+            start, piece = hits[start][0]
+            pieces.append(piece)
+        tokens = tuple(pieces) if start == len(word) else (self.unk_token,)
+        return tuple(hits), tuple(path), tuple(pieces), tokens
+
+    def tokenize_batch(self, texts):
+        """ :return: list of WordPiece token lists, 1 per whitespace-split text """
+        next_skip, next_run = self.skips.__next__, self.runs.__next__
+        output = []
+        for text in texts:
+            tokens = []
+            for word in text.split():
+                if len(word) > self.max_input_chars_per_word:
+                    tokens.append(self.unk_token)
+                    continue
+                hits, path, path_pieces, word_tokens = self.word_hits(word)
+                run = next_run()
+                if run >= len(path):
+                    tokens.extend(word_tokens)
+                    continue
+
+                # longest hits up to the 1st rejection, then at least 1 rejected hit at that position
+                num_tokens = len(tokens)
+                tokens.extend(path_pieces[:run])
+                start = path[run]
+                skip = 1 + next_skip()
+                while True:
+                    start_hits = hits[start]
+                    if skip >= len(start_hits):
+                        del tokens[num_tokens:]
+                        tokens.append(self.unk_token)
+                        break
+                    start, piece = start_hits[skip]
+                    tokens.append(piece)
+                    if start == len(word):
+                        break
+                    skip = next_skip() if hits[start] else 0
+            output.append(tokens)
+        return output
+
+    def tokenize(self, text):
+        return self.tokenize_batch([text])[0]
+
+
+_STOCHASTIC_WORDPIECES = weakref.WeakKeyDictionary()  # WordpieceTokenizer -> StochasticWordpiece
+_wordpiece_seed = None  # seed of the StochasticWordpieces built by tokenize (None = fresh entropy)
+
+
+def seed_wordpiece_dropout(seed=None):
+    """
+    Seeds the dropout of tokenize-monkeypatched WordpieceTokenizers - drops the StochasticWordpieces built so far
+    :param seed: int or sequence of ints, e.g., (SEED, epoch, worker index) - None = fresh entropy
+    """
+    global _wordpiece_seed
+    _wordpiece_seed = seed
+    _STOCHASTIC_WORDPIECES.clear()
+
+
 def tokenize(self, text):
     """
     Modified version of tokenize in transformers tokenization_bert.py
@@ -124,48 +530,12 @@ def tokenize(self, text):
         <tokenizer instance>.wordpiece_tokenizer.tokenize =
                 tokenize.__get__(<instance>.wordpiece_tokenizer, WordpieceTokenizer)
     - implements BPE encode by failing substring to vocab matches with prob 0.1
+    - runs on a StochasticWordpiece built once per WordpieceTokenizer instance (see seed_wordpiece_dropout)
     """
-    def whitespace_tokenize(text):
-        """Runs basic whitespace cleaning and splitting on a piece of text."""
-        text = text.strip()
-        if not text:
-            return []
-        tokens = text.split()
-        return tokens
-
-    output_tokens = []
-    for token in whitespace_tokenize(text):
-        chars = list(token)
-        if len(chars) > self.max_input_chars_per_word:
-            output_tokens.append(self.unk_token)
-            continue
-
-        is_bad = False
-        start = 0
-        sub_tokens = []
-        while start < len(chars):
-            end = len(chars)
-            cur_substr = None
-            while start < end:
-                substr = "".join(chars[start:end])
-                if start > 0:
-                    substr = "##" + substr
-                # Fail vocab lookup with prob 0.1
-                if substr in self.vocab and random() > 0.1:
-                    cur_substr = substr
-                    break
-                end -= 1
-            if cur_substr is None:
-                is_bad = True
-                break
-            sub_tokens.append(cur_substr)
-            start = end
-
-        if is_bad:
-            output_tokens.append(self.unk_token)
-        else:
-            output_tokens.extend(sub_tokens)
-    return output_tokens
+    if self not in _STOCHASTIC_WORDPIECES:
+        _STOCHASTIC_WORDPIECES[self] = StochasticWordpiece(self.vocab, self.unk_token, self.max_input_chars_per_word,
+                                                           seed=_wordpiece_seed)
+    return _STOCHASTIC_WORDPIECES[self].tokenize(text)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,98 @@
+"""
+Domain-adaptive masked language model (MLM) pre-training of the Transformer on the comment corpus
+- Run prepare_data.py prior to generate the prerequisite training files
+- pre-trains PRETRAINED_MODEL of classifier_baseline.py on the cleaned train/val/test comments (no labels needed),
+  then saves the model and tokenizer to OUTPUT_DIR - point PRETRAINED_MODEL at OUTPUT_DIR to fine-tune from it
+- masks batches w/ torch_helpers.MaskedLMCollator on the training device (CPU or GPU)
+- dynamic padding: batches group rows of similar length and get trimmed to their longest row (BatchPrefetcher)
+- device placement/mixed precision by classifier_baseline.BACKEND, token IDs reused from $TOKEN_CACHE_DIR
+"""
+import os
+import time
+from functools import partial
+import torch
+from transformers import AutoTokenizer, AutoModelForMaskedLM
+from tqdm import tqdm
+from classifier_baseline import SETTINGS_DICT, TRAIN_CSV_PATH, VAL_CSV_PATH, TEST_CSV_PATH, PRETRAINED_MODEL, \
+    MAX_SEQ_LEN, MAX_CORES, USE_FAST_TOKENIZER, USE_TOKEN_CACHE, BUCKET_SIZE_MULT, LOG_INTERVAL, BACKEND, cln
+from preprocessor import get_id_text_from_test_csv, TokenCache, encode_strings
+from torch_helpers import get_sequence_lengths, length_bucketed_batches, BatchPrefetcher, RunningMetrics, \
+    MaskedLMCollator
+
+OUTPUT_DIR = 'models/mlm_pretrained/'  # pre-trained model + tokenizer are saved here
+MLM_PROB = 0.15  # fraction of (non-special) tokens that get predicted
+NUM_EPOCHS = 2
+BATCH_SIZE = 32
+LR = 5e-5  # Learning rate - constant value
+SEED = 1337
+
+
+def train_mlm(model, features, lengths, collator, opt, curr_epoch, generator=None):
+    """
+    Trains the MLM against all rows for a single epoch
+    - batches are masked on the device by collator (torch_helpers.MaskedLMCollator), loss logged w/ RunningMetrics
+    """
+    batches = length_bucketed_batches(lengths, BATCH_SIZE, BUCKET_SIZE_MULT)
+    loader = BatchPrefetcher(features, lengths, None, batches)
+
+    model.train()
+    iter = 0
+    running_metrics = RunningMetrics(BACKEND.device)
+    with tqdm(loader, desc='Epoch {}'.format(curr_epoch)) as t:
+        for batch_features, batch_mask in t:
+            iter += 1
+            batch_features = BACKEND.to_device(batch_features).long()
+            batch_mask = BACKEND.to_device(batch_mask)
+            batch_features, batch_labels = collator(batch_features, generator=generator)
+
+            with BACKEND.autocast():
+                loss = model(batch_features, attention_mask=batch_mask, labels=batch_labels).loss.float()
+            running_metrics.update(loss, len(batch_features))
+            BACKEND.backward(loss, opt)
+            BACKEND.step(opt)
+
+            if iter % LOG_INTERVAL == 0 or iter == len(loader):
+                t.set_postfix(running_metrics.sync())
+
+
+if __name__ == '__main__':
+    start_time = time.time()
+    torch.manual_seed(SEED)
+
+    # comment text of every split - MLM doesn't use the labels
+    strings = []
+    for csv_path in [TRAIN_CSV_PATH, VAL_CSV_PATH, TEST_CSV_PATH]:
+        _, split_strings = get_id_text_from_test_csv(csv_path, text_col='comment_text')
+        strings += [cln(x) for x in split_strings]
+
+    tokenizer = AutoTokenizer.from_pretrained(PRETRAINED_MODEL, use_fast=USE_FAST_TOKENIZER)
+    encode_fn = partial(encode_strings,
+                        tokenizer=tokenizer,
+                        max_len=MAX_SEQ_LEN,
+                        num_workers=MAX_CORES)
+    print('Encoding raw strings into model-specific tokens')
+    if USE_TOKEN_CACHE:
+        token_cache = TokenCache(SETTINGS_DICT['TOKEN_CACHE_DIR'], PRETRAINED_MODEL, tokenizer, MAX_SEQ_LEN)
+        features = token_cache.encode(strings, encode_fn)
+    else:
+        features = encode_fn(strings)
+    lengths = get_sequence_lengths(features, tokenizer.pad_token_id)
+    print('MLM rows: {}, tokens: {}'.format(len(lengths), lengths.sum()))
+
+    model = AutoModelForMaskedLM.from_pretrained(PRETRAINED_MODEL)
+    opt = torch.optim.Adam(model.parameters(), lr=LR)
+    model, opt = BACKEND.prepare(model, opt)
+    collator = MaskedLMCollator(tokenizer, MLM_PROB)
+    generator = torch.Generator(device=BACKEND.device)
+    generator.manual_seed(SEED)
+
+    for curr_epoch in range(NUM_EPOCHS):
+        train_mlm(model, features, lengths, collator, opt, curr_epoch, generator)
+
+    if not os.path.exists(OUTPUT_DIR):
+        os.makedirs(OUTPUT_DIR)
+    model.save_pretrained(OUTPUT_DIR)
+    tokenizer.save_pretrained(OUTPUT_DIR)
+    print('Saved MLM pre-trained model to {}'.format(OUTPUT_DIR))
+
+    print('Elapsed time: {}'.format(time.time() - start_time))
@@ -0,0 +1,98 @@
+"""
+Run instrumentation shared by the trainers
+- per-stage wall-clock timers (e.g., csv_load, tokenization, forward, backward) - nested stages are timed separately
+- samples/sec and tokens/sec over the time spent in the 'train' stage
+- peak RSS of the process and peak tensor memory (if the trainer passes a tensor_memory_fn)
+- appends one JSON line per log() call to a JSONL file: a 'setup' record for the stages before the 1st epoch,
+  then 1 record per epoch - records of the same run share the same 'run' timestamp
+- framework-agnostic: device syncs and tensor memory queries are passed in by the trainers
+"""
+import json
+import os
+import resource
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+def peak_rss_mb():
+    """ Peak resident set size of this process in MB (ru_maxrss is in KB on Linux) """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+class RunProfiler:
+    """
+    Accumulates stage timings and sample/token counts between log() calls
+    :param output_path: JSONL file the records are appended to (None = only print them)
+    :param sync_fn: called before a stage's timer stops (e.g., torch.cuda.synchronize) so that stages time the
+                    device work they launch rather than just the launch - adds a device sync per stage
+    :param tensor_memory_fn: returns the peak tensor memory in MB (or None if unknown)
+    """
+
+    def __init__(self, output_path=None, sync_fn=None, tensor_memory_fn=None):
+        self.output_path = output_path
+        self.sync_fn = sync_fn
+        self.tensor_memory_fn = tensor_memory_fn
+        self.run_start = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.reset()
+
+    def reset(self):
+        self.stage_seconds = defaultdict(float)
+        self.num_samples = 0
+        self.num_tokens = 0
+
+    @contextmanager
+    def stage(self, name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync_fn is not None:
+                self.sync_fn()
+            self.stage_seconds[name] += time.perf_counter() - start_time
+
+    def timed_iter(self, iterable, name='data_wait'):
+        """ Yields from iterable, timing each wait for the next item as stage name """
+        iterator = iter(iterable)
+        while True:
+            start_time = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.stage_seconds[name] += time.perf_counter() - start_time
+            yield item
+
+    def add_throughput(self, num_samples, num_tokens=0):
+        self.num_samples += int(num_samples)
+        self.num_tokens += int(num_tokens)
+
+    def log(self, record_name, **extra):
+        """
+        Writes the record of the stages/counts since the last log() call, then resets them
+        :param extra: other JSON-serializable fields (e.g., epoch=1, val_auc=0.93)
+        :return: record dict
+        """
+        train_seconds = self.stage_seconds.get('train', 0.)
+        record = {'run': self.run_start,
+                  'record': record_name,
+                  'stage_seconds': {k: round(v, 4) for k, v in self.stage_seconds.items()},
+                  'samples': self.num_samples,
+                  'tokens': self.num_tokens,
+                  'samples_per_sec': self.num_samples / train_seconds if train_seconds else None,
+                  'tokens_per_sec': self.num_tokens / train_seconds if train_seconds else None,
+                  'peak_rss_mb': peak_rss_mb(),
+                  'peak_tensor_mb': self.tensor_memory_fn() if self.tensor_memory_fn is not None else None}
+        record.update(extra)
+        self.reset()
+
+        print('[{}] {}'.format(record_name, ', '.join('{}: {:.1f}s'.format(k, v)
+                                                      for k, v in record['stage_seconds'].items())))
+        if self.output_path is not None:
+            output_dir = os.path.dirname(self.output_path)
+            if output_dir and not os.path.exists(output_dir):
+                os.makedirs(output_dir)
+            with open(self.output_path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        return record
@@ -0,0 +1,123 @@
+"""
+Vectorized ROC AUC scoring (drop-in for sklearn.metrics.roc_auc_score w/ binary labels)
+- RocAucScorer precomputes the label side (positive mask and class counts) once and reuses it
+  across any number of prediction vectors
+- scores a whole [n_models, n_rows] prediction matrix in a single call
+- per-group (e.g., per-lang) AUC breakdowns
+- AUC via the Mann-Whitney rank-sum statistic, w/ tied predictions given their average rank (same as sklearn)
+"""
+import numpy as np
+
+MAX_MATRIX_ELEMENTS = 2 ** 24  # rows of a prediction matrix are scored in chunks of at most this many elements
+
+
+def _positive_rank_sums(predictions, positive_mask):
+    """
+    Sum of the (1-based, tie-averaged) ranks of positive rows, per row of a [n_models, n_rows] matrix
+    """
+    num_models, num_rows = predictions.shape
+    order = np.argsort(predictions, axis=1, kind='stable')
+    sorted_preds = np.take_along_axis(predictions, order, axis=1)
+    positions = np.broadcast_to(np.arange(num_rows), (num_models, num_rows))
+
+    # first/last sorted position of each run of tied predictions
+    is_run_start = np.ones((num_models, num_rows), dtype=bool)
+    is_run_start[:, 1:] = sorted_preds[:, 1:] != sorted_preds[:, :-1]
+    is_run_end = np.ones((num_models, num_rows), dtype=bool)
+    is_run_end[:, :-1] = is_run_start[:, 1:]
+    run_start = np.maximum.accumulate(np.where(is_run_start, positions, 0), axis=1)
+    run_end = np.minimum.accumulate(np.where(is_run_end, positions, num_rows - 1)[:, ::-1], axis=1)[:, ::-1]
+
+    average_ranks = (run_start + run_end) / 2. + 1.
+    return (average_ranks * positive_mask[order]).sum(axis=1)
+
+
+class RocAucScorer:
+    """
+    ROC AUC against a fixed set of binary labels
+    :param labels: binary (or 0./1. float) labels, rounded to the nearest int as in predict_evaluate
+    :param groups: optional per-row group labels (e.g., lang) for score_by_group
+    """
+
+    def __init__(self, labels, groups=None):
+        self.positive_mask = np.round(np.asarray(labels, dtype=np.float64)).astype(bool)
+        self.num_pos = int(self.positive_mask.sum())
+        self.num_neg = len(self.positive_mask) - self.num_pos
+        self.group_scorers = {}
+        if groups is not None:
+            groups = np.asarray(groups)
+            for group in np.unique(groups):
+                group_indices = np.flatnonzero(groups == group)
+                self.group_scorers[group] = (group_indices, RocAucScorer(self.positive_mask[group_indices]))
+
+    def score(self, predictions):
+        """
+        :param predictions: [n_rows] vector or [n_models, n_rows] matrix of predictions
+        :return: float AUC for a vector, [n_models] AUC array for a matrix
+        """
+        if self.num_pos == 0 or self.num_neg == 0:
+            raise ValueError('Only one class present in labels - ROC AUC is undefined')
+        predictions = np.asarray(predictions)
+        is_vector = predictions.ndim == 1
+        predictions = predictions.reshape(1, -1) if is_vector else predictions
+
+        models_per_chunk = max(1, MAX_MATRIX_ELEMENTS // max(1, predictions.shape[1]))
+        rank_sums = np.concatenate([_positive_rank_sums(predictions[i:i + models_per_chunk], self.positive_mask)
+                                    for i in range(0, predictions.shape[0], models_per_chunk)])
+        aucs = (rank_sums - self.num_pos * (self.num_pos + 1) / 2.) / (self.num_pos * self.num_neg)
+        return float(aucs[0]) if is_vector else aucs
+
+    def score_by_group(self, predictions):
+        """
+        :return: {group: AUC} dict (AUC is NaN for single-class groups) incl. an 'all' entry over every row
+        """
+        predictions = np.asarray(predictions)
+        group_aucs = {'all': self.score(predictions)}
+        for group, (group_indices, group_scorer) in self.group_scorers.items():
+            if group_scorer.num_pos == 0 or group_scorer.num_neg == 0:
+                group_aucs[group] = np.nan
+            else:
+                group_aucs[group] = group_scorer.score(predictions[..., group_indices])
+        return group_aucs
+
+
+def fast_roc_auc(labels, predictions):
+    """ One-off ROC AUC - see RocAucScorer to score many prediction vectors against the same labels """
+    return RocAucScorer(labels).score(np.asarray(predictions).reshape(-1))
+
+
+def search_blend_weight(scorer, base_preds, curr_preds, num_points=101, num_rounds=3):
+    """
+    Weight w in [0, 1] maximizing the AUC of w * base_preds + (1 - w) * curr_preds
+    - each round scores a num_points grid of weights as one [num_points, n_rows] batch,
+      then zooms in on the grid cell around the best weight
+    :return: (best weight, best AUC) tuple
+    """
+    base_preds = np.asarray(base_preds, dtype=np.float64).reshape(1, -1)
+    curr_preds = np.asarray(curr_preds, dtype=np.float64).reshape(1, -1)
+    low, high = 0., 1.
+    best_weight, best_auc = None, -np.inf
+    for _ in range(num_rounds):
+        weights = np.linspace(low, high, num_points)
+        aucs = scorer.score(weights[:, None] * base_preds + (1 - weights[:, None]) * curr_preds)
+        best_idx = int(np.argmax(aucs))
+        if aucs[best_idx] > best_auc:
+            best_weight, best_auc = float(weights[best_idx]), float(aucs[best_idx])
+        step = (high - low) / (num_points - 1)
+        low, high = max(0., best_weight - step), min(1., best_weight + step)
+    return best_weight, best_auc
+
+
+def search_blend_weights_by_group(scorer, base_preds, curr_preds, num_points=101, num_rounds=3):
+    """
+    search_blend_weight run separately for each group of a grouped RocAucScorer
+    :return: {group: (best weight, best AUC)} dict - single-class groups are left out
+    """
+    base_preds, curr_preds = np.asarray(base_preds), np.asarray(curr_preds)
+    group_weights = {}
+    for group, (group_indices, group_scorer) in scorer.group_scorers.items():
+        if group_scorer.num_pos > 0 and group_scorer.num_neg > 0:
+            group_weights[group] = search_blend_weight(group_scorer,
+                                                       base_preds[group_indices], curr_preds[group_indices],
+                                                       num_points, num_rounds)
+    return group_weights
@@ -1,12 +1,15 @@
 from collections import defaultdict
 from itertools import chain
 from torch.optim import Optimizer
+import threading
 import torch
 import warnings
 
 
 class SWA(Optimizer):
-    def __init__(self, optimizer, swa_start=None, swa_freq=None, swa_lr=None):
+    def __init__(self, optimizer, swa_start=None, swa_freq=None, swa_lr=None,
+                 flatten=False, swa_device=None, swa_dtype=None,
+                 async_update=False):
         r"""Implements Stochastic Weight Averaging (SWA).
 
         Stochastic Weight Averaging was proposed in `Averaging Weights Leads to
@@ -41,6 +44,41 @@ class SWA(Optimizer):
             swa_lr (float): learning rate to use starting from step swa_start
                 in automatic mode; if None, learning rate is not changed
                 (default: None)
+            flatten (bool): keep the SWA running averages of each parameter
+                group in one contiguous buffer (each parameter's swa_buffer is
+                a view of it) w/ a same-sized scratch buffer, so that updates
+                and swaps run as a few whole-group ops w/o allocating
+                temporaries; needs 1 extra copy of the parameters (non-flat
+                updates keep a per-parameter scratch copy instead)
+                (default: False)
+            swa_device (torch.device or str, optional): device to keep the
+                running averages on, e.g., 'cpu' to keep them out of GPU
+                memory (pinned if CUDA is available); None = each
+                parameter's device (default: None)
+            swa_dtype (torch.dtype, optional): storage dtype of the running
+                averages, e.g., torch.bfloat16 to halve their memory - updates
+                are computed in float32 and stochastically rounded back, so
+                small late updates aren't rounded away; None = each
+                parameter's dtype (default: None)
+            async_update (bool): w/ swa_device/swa_dtype, parameters are
+                copied to a float32 staging buffer next to the averages and
+                the update runs in a background thread, overlapping w/ the
+                next training steps (default: False)
+
+        .. note::
+            Averages on another device (swa_device) or updated asynchronously
+            keep a persistent staging copy of the parameters next to them.
+            Averages on the parameters' device w/o async_update read the
+            parameters in place, so w/ swa_dtype=torch.bfloat16 they only add
+            half a copy of the parameters, plus a float32 scratch the size of
+            the largest parameter.
+
+            W/ swa_device, swa_dtype or async_update, :meth:`swap_swa_sgd`
+            keeps the live parameters in the staging buffer (so they come back
+            exactly on the 2nd swap - it's only allocated while swapped if it
+            isn't persistent) and the running averages stay in the
+            swa_buffers; :meth:`update_swa_group` can't be called while the
+            averages are swapped in.
 
         Examples:
             >>> # automatic mode
@@ -118,6 +156,20 @@ class SWA(Optimizer):
             raise ValueError("Invalid SWA learning rate: {}".format(swa_lr))
 
         self.optimizer = optimizer
+        self.flatten = flatten
+        self._flat_buffers = {}  # id(param group) -> (flat SWA buffer, flat scratch, scratch views)
+        self._group_scratch = {}  # id(param group) -> per-param scratch tensors of non-flat updates
+        self.swa_device = None if swa_device is None else torch.device(swa_device)
+        self.swa_dtype = swa_dtype
+        self.async_update = async_update
+        self._offloaded = swa_device is not None or swa_dtype is not None or async_update
+        if self._offloaded and flatten:
+            raise ValueError("flatten can't be combined w/ swa_device, swa_dtype or async_update")
+        self._staging = {}  # param -> float32 staging copy of the param (offloaded mode)
+        self._scratch = {}  # device -> float32 accumulation scratch (offloaded mode)
+        self._swapped = False
+        self._pending_update = None
+        self._rounding_generators = {}
 
         self.defaults = self.optimizer.defaults
         self.param_groups = self.optimizer.param_groups
@@ -168,15 +220,181 @@ class SWA(Optimizer):
             >>>         opt.update_swa_group(opt.param_groups[1])
             >>> opt.swap_swa_sgd()
         """
-        for p in group['params']:
+        virtual_decay = 1 / float(group["n_avg"] + 1)
+        flat_buffers = self._get_flat_buffers(group)
+        if self._offloaded:
+            self._update_offloaded_group(group, virtual_decay)
+        elif flat_buffers is not None:
+            flat_buf, flat_scratch, scratch_views = flat_buffers
+            _foreach_copy_(scratch_views, [p.data for p in group['params']])
+            flat_scratch.sub_(flat_buf).mul_(virtual_decay)
+            flat_buf.add_(flat_scratch)
+        else:
+            params, bufs = [], []
+            for p in group['params']:
+                param_state = self.state[p]
+                if 'swa_buffer' not in param_state:
+                    param_state['swa_buffer'] = torch.zeros_like(p.data)
+                params.append(p.data)
+                bufs.append(param_state['swa_buffer'])
+            if id(group) not in self._group_scratch:
+                self._group_scratch[id(group)] = [torch.empty_like(p)
+                                                  for p in params]
+            diffs = self._group_scratch[id(group)]
+            # same elementwise ops (and roundings) as
+            # buf += (p - buf) * virtual_decay, batched over tensors in
+            # the group's persistent scratch
+            _foreach_copy_(diffs, params)
+            torch._foreach_sub_(diffs, bufs)
+            torch._foreach_mul_(diffs, virtual_decay)
+            torch._foreach_add_(bufs, diffs)
+        group["n_avg"] += 1
+
+    def _swa_storage(self, tensor, dtype=None):
+        """Empty tensor shaped like tensor on the device of the offloaded
+        averages, w/ their dtype unless given."""
+        device = tensor.device if self.swa_device is None else self.swa_device
+        if dtype is None:
+            dtype = tensor.dtype if self.swa_dtype is None else self.swa_dtype
+        pin_memory = device.type == 'cpu' and torch.cuda.is_available()
+        return torch.empty(tensor.shape, dtype=dtype, device=device,
+                           pin_memory=pin_memory)
+
+    def _offload_buffers(self, params):
+        """swa_buffers of params in offloaded mode."""
+        bufs = []
+        for p in params:
             param_state = self.state[p]
             if 'swa_buffer' not in param_state:
-                param_state['swa_buffer'] = torch.zeros_like(p.data)
-            buf = param_state['swa_buffer']
-            virtual_decay = 1 / float(group["n_avg"] + 1)
-            diff = (p.data - buf) * virtual_decay
-            buf.add_(diff)
-        group["n_avg"] += 1
+                param_state['swa_buffer'] = self._swa_storage(p.data).zero_()
+            bufs.append(param_state['swa_buffer'])
+        return bufs
+
+    def _uses_staging(self, p):
+        """Async updates read a snapshot of the param and averages on
+        another device read a copy of it - both kept in a persistent staging
+        copy next to the averages. Otherwise the param is read in place."""
+        return self.async_update or \
+            self.state[p]['swa_buffer'].device != p.device
+
+    def _staging_copy(self, p):
+        if p not in self._staging:
+            self._staging[p] = self._swa_storage(
+                p.data, p.dtype if self.swa_dtype is None else torch.float32)
+        return self._staging[p]
+
+    def _accum_scratch(self, tensor):
+        """float32 scratch shaped like tensor, on its device - one buffer per
+        device, reused across tensors (grown to the largest one)."""
+        scratch = self._scratch.get(tensor.device)
+        if scratch is None or scratch.numel() < tensor.numel():
+            scratch = torch.empty(tensor.numel(), dtype=torch.float32,
+                                  device=tensor.device)
+            self._scratch[tensor.device] = scratch
+        return scratch[:tensor.numel()].view_as(tensor)
+
+    def _update_offloaded_group(self, group, virtual_decay):
+        if self._swapped:
+            raise RuntimeError("Swap the SWA averages out (swap_swa_sgd) "
+                               "before updating them")
+        self.wait_swa_update()  # the staging copies and scratch are reused
+        params = group['params']
+        bufs = self._offload_buffers(params)
+        staged = [self._uses_staging(p) for p in params]
+        sources = [self._staging_copy(p).copy_(p.data, non_blocking=True)
+                   if is_staged else p.data
+                   for p, is_staged in zip(params, staged)]
+        copy_done = None
+        if any(p.is_cuda for p in params):
+            copy_done = torch.cuda.Event()
+            copy_done.record()
+
+        def update():
+            if copy_done is not None:
+                copy_done.synchronize()
+            if all(staged) and \
+                    all(x.dtype == b.dtype for x, b in zip(sources, bufs)):
+                torch._foreach_sub_(sources, bufs)
+                torch._foreach_mul_(sources, virtual_decay)
+                torch._foreach_add_(bufs, sources)
+                return
+            # 1 tensor at a time: lower precision averages are accumulated in
+            # a reused float32 scratch, then stochastically rounded back
+            for x, b, is_staged in zip(sources, bufs, staged):
+                accum = b if b.dtype == torch.float32 \
+                    else self._accum_scratch(b).copy_(b)
+                if is_staged:  # x is a copy - use it as the temporary
+                    x.sub_(accum).mul_(virtual_decay)
+                    accum.add_(x)
+                else:  # x is the live param
+                    accum.mul_(1. - virtual_decay).add_(x, alpha=virtual_decay)
+                if accum is not b:
+                    self._stochastic_round_(b, accum)
+
+        if self.async_update:
+            self._pending_update = threading.Thread(target=update, daemon=True)
+            self._pending_update.start()
+        else:
+            update()
+
+    def _stochastic_round_(self, dst, src):
+        """Rounds float32 src (overwritten) into bfloat16 dst: adds random
+        bits below bfloat16's precision, then truncates - unbiased rounding.
+        """
+        if dst.dtype != torch.bfloat16:
+            dst.copy_(src)
+            return
+        if src.device not in self._rounding_generators:
+            self._rounding_generators[src.device] = \
+                torch.Generator(device=src.device)
+            self._rounding_generators[src.device].manual_seed(0)
+        bits = src.view(torch.int32)
+        bits.add_(torch.randint(0, 1 << 16, bits.shape, dtype=torch.int32,
+                                device=bits.device,
+                                generator=self._rounding_generators[src.device]))
+        bits.bitwise_and_(-65536)  # clear the low 16 bits
+        dst.copy_(src)  # exact: truncated values are representable
+
+    def wait_swa_update(self):
+        r"""Waits for a pending background (async_update) SWA update."""
+        if self._pending_update is not None:
+            self._pending_update.join()
+            self._pending_update = None
+
+    def _get_flat_buffers(self, group):
+        """(flat SWA buffer, flat scratch, scratch views) of a group in
+        flatten mode, or None if not flattening.
+
+        Built on first use (and after load_state_dict) from the existing
+        per-parameter swa_buffers, which then become views of the flat
+        buffer. Groups w/ mixed dtypes/devices aren't flattened.
+        """
+        if not self.flatten or not group['params']:
+            return None
+        if id(group) in self._flat_buffers:
+            return self._flat_buffers[id(group)]
+        params = [p.data for p in group['params']]
+        if len({(p.dtype, p.device) for p in params}) > 1:
+            return None
+
+        numel = sum(p.numel() for p in params)
+        flat_buf = torch.zeros(numel, dtype=params[0].dtype,
+                               device=params[0].device)
+        flat_scratch = torch.empty_like(flat_buf)
+        scratch_views = []
+        offset = 0
+        for p in group['params']:
+            param_state = self.state[p]
+            buf_view = flat_buf[offset:offset + p.numel()].view_as(p.data)
+            if 'swa_buffer' in param_state:
+                buf_view.copy_(param_state['swa_buffer'])
+            param_state['swa_buffer'] = buf_view
+            scratch_views.append(
+                flat_scratch[offset:offset + p.numel()].view_as(p.data))
+            offset += p.numel()
+        self._flat_buffers[id(group)] = (flat_buf, flat_scratch,
+                                         scratch_views)
+        return self._flat_buffers[id(group)]
 
     def update_swa(self):
         r"""Updates the SWA running averages of all optimized parameters.
@@ -192,7 +410,23 @@ class SWA(Optimizer):
         averages during training; to continue training `swap_swa_sgd`
         should be called again.
         """
+        if self._offloaded:
+            self._swap_offloaded()
+            return
+
+        scratch = {}  # (dtype, device) -> 1 scratch tensor reused by all params
         for group in self.param_groups:
+            flat_buffers = self._flat_buffers.get(id(group)) \
+                if self.flatten else None
+            if flat_buffers is not None and group["n_avg"] > 0:
+                flat_buf, flat_scratch, scratch_views = flat_buffers
+                params = [p.data for p in group['params']]
+                bufs = [self.state[p]['swa_buffer'] for p in group['params']]
+                _foreach_copy_(scratch_views, params)
+                _foreach_copy_(params, bufs)
+                flat_buf.copy_(flat_scratch)
+                continue
+
             for p in group['params']:
                 param_state = self.state[p]
                 if 'swa_buffer' not in param_state:
@@ -201,11 +435,42 @@ class SWA(Optimizer):
                         "SWA wasn't applied to param {}; skipping it".format(p))
                     continue
                 buf = param_state['swa_buffer']
-                tmp = torch.empty_like(p.data)
+                key = (p.dtype, p.device)
+                if key not in scratch or scratch[key].numel() < p.numel():
+                    max_numel = max(x.numel() for g in self.param_groups
+                                    for x in g['params']
+                                    if (x.dtype, x.device) == key)
+                    scratch[key] = torch.empty(max_numel, dtype=p.dtype,
+                                               device=p.device)
+                tmp = scratch[key][:p.numel()].view_as(p.data)
                 tmp.copy_(p.data)
                 p.data.copy_(buf)
                 buf.copy_(tmp)
 
+    def _swap_offloaded(self):
+        self.wait_swa_update()
+        params = []
+        for group in self.param_groups:
+            for p in group['params']:
+                if 'swa_buffer' not in self.state[p]:
+                    # If swa wasn't applied we don't swap params
+                    warnings.warn(
+                        "SWA wasn't applied to param {}; skipping it".format(p))
+                    continue
+                params.append(p)
+        bufs = self._offload_buffers(params)
+        for p, buf in zip(params, bufs):
+            if self._swapped:  # restore the live params
+                p.data.copy_(self._staging[p])
+                if not self._uses_staging(p):
+                    del self._staging[p]  # only held while swapped
+            else:
+                # persistent staging copies are allocated on 1st use (e.g.,
+                # after load_state_dict), the others only while swapped
+                self._staging_copy(p).copy_(p.data)
+                p.data.copy_(buf)
+        self._swapped = not self._swapped
+
     def step(self, closure=None):
         r"""Performs a single optimization step.
 
@@ -232,9 +497,14 @@ class SWA(Optimizer):
                 average of the variable
             * param_groups - a dict containing all parameter groups
         """
+        self.wait_swa_update()
         opt_state_dict = self.optimizer.state_dict()
-        swa_state = {(id(k) if isinstance(k, torch.Tensor) else k): v
-                     for k, v in self.state.items()}
+        # swa_state is keyed like opt_state: by the packed param keys of
+        # param_groups (ids or indices, depending on the torch version)
+        packed_keys = {id(p): k for group, packed_group in
+                       zip(self.param_groups, opt_state_dict["param_groups"])
+                       for p, k in zip(group["params"], packed_group["params"])}
+        swa_state = {packed_keys[id(k)]: v for k, v in self.state.items()}
         opt_state = opt_state_dict["state"]
         param_groups = opt_state_dict["param_groups"]
         return {"opt_state": opt_state, "swa_state": swa_state,
@@ -247,13 +517,33 @@ class SWA(Optimizer):
             state_dict (dict): SWA optimizer state. Should be an object returned
                 from a call to `state_dict`.
         """
-        swa_state_dict = {"state": state_dict["swa_state"],
-                          "param_groups": state_dict["param_groups"]}
+        self.wait_swa_update()
+        packed_params = {k: p for group, packed_group in
+                         zip(self.param_groups, state_dict["param_groups"])
+                         for p, k in zip(group["params"], packed_group["params"])}
         opt_state_dict = {"state": state_dict["opt_state"],
                           "param_groups": state_dict["param_groups"]}
-        super(SWA, self).load_state_dict(swa_state_dict)
         self.optimizer.load_state_dict(opt_state_dict)
+        # the base optimizer replaces its param groups (incl. n_avg and
+        # step_counter) w/ the loaded ones
+        self.param_groups = self.optimizer.param_groups
         self.opt_state = self.optimizer.state
+        self.state = defaultdict(dict)
+        for k, param_state in state_dict["swa_state"].items():
+            p = packed_params[k]
+            param_state = dict(param_state)
+            if 'swa_buffer' in param_state:
+                # onto the param's device/dtype (or the offloaded storage)
+                buf = param_state['swa_buffer']
+                param_state['swa_buffer'] = self._swa_storage(p.data) \
+                    if self._offloaded else torch.empty_like(p.data)
+                param_state['swa_buffer'].copy_(buf)
+            self.state[p] = param_state
+        # flat buffers get rebuilt from the loaded swa_buffers on next use
+        self._flat_buffers = {}
+        self._group_scratch = {}
+        self._staging = {}
+        self._swapped = False
 
     def add_param_group(self, param_group):
         r"""Add a param group to the :class:`Optimizer` s `param_groups`.
@@ -316,6 +606,15 @@ class SWA(Optimizer):
         model.train(was_training)
 
 
+def _foreach_copy_(dst, src):
+    """Multi-tensor copy (torch >= 2.1), else a per-tensor copy_ loop."""
+    if hasattr(torch, '_foreach_copy_'):
+        torch._foreach_copy_(dst, src)
+    else:
+        for d, s in zip(dst, src):
+            d.copy_(s)
+
+
 # BatchNorm utils
 def _check_bn_apply(module, flag):
     if issubclass(module.__class__, torch.nn.modules.batchnorm._BatchNorm):
@@ -0,0 +1,104 @@
+"""
+Tests of classifier_baseline w/o dataset or model downloads - run from the repo root: python -m pytest -q
+"""
+import os
+import socket
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+import classifier_baseline as baseline
+from torch_helpers import TrainingBackend, predict_probs, init_distributed, get_sequence_lengths, \
+    length_bucketed_batches, shard_batches, gather_predictions
+
+SEED = 1337
+
+
+class _EmbeddingBase(torch.nn.Module):
+    """ Stand-in for the pretrained base model: hidden states are an fp32 embedding lookup under autocast too """
+
+    def __init__(self, vocab_size, hidden_size):
+        super(_EmbeddingBase, self).__init__()
+        self.embedding = torch.nn.Embedding(vocab_size, hidden_size)
+
+    def forward(self, x, attention_mask=None):
+        return (self.embedding(x),)
+
+
+def test_autocast_head_matches_fp32():
+    """ The FC + sigmoid head runs in fp32 under CPU bfloat16 autocast - no quantized, tied probabilities """
+    num_rows, vocab_size, hidden_size = 2000, 5000, 64
+    torch.manual_seed(SEED)
+    baseline.BASE_MODEL_OUTPUT_DIM = hidden_size
+    classifier = baseline.ClassifierHead(_EmbeddingBase(vocab_size, hidden_size))
+    rng = np.random.RandomState(SEED)
+    features = rng.randint(1, vocab_size, (num_rows, 16)).astype(np.int32)
+    features[:, 0] = rng.permutation(np.arange(1, vocab_size))[:num_rows]  # the head only sees the 1st token
+    lengths = np.full(num_rows, 16)
+
+    fp32_preds = predict_probs(classifier, features, lengths, 64)
+    with TrainingBackend('cpu', True).autocast():
+        autocast_preds = predict_probs(classifier, features, lengths, 64)
+    assert np.abs(autocast_preds - fp32_preds).max() < 1e-5
+    assert len(np.unique(autocast_preds)) > 0.99 * num_rows
+
+
+def _ddp_worker(rank, world_size, port, features, labels):
+    """ 1 rank of test_ddp_train_and_gather: an epoch w/ ACCUM_FOR=2 (no_sync micro-batches), then the checks """
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port), WORLD_SIZE=str(world_size), RANK=str(rank))
+    init_distributed('gloo')
+    torch.set_num_threads(1)
+    baseline.LOG_INTERVAL = 10 ** 9
+    baseline.BATCH_SIZE, baseline.ACCUM_FOR = 16, 2
+    baseline.BACKEND = TrainingBackend('cpu', mixed_precision=False)
+    baseline.PROFILER.output_path = None
+    baseline.BASE_MODEL_OUTPUT_DIM = 32
+
+    torch.manual_seed(SEED + rank)  # DDP broadcasts rank 0's initial weights
+    classifier = baseline.ClassifierHead(_EmbeddingBase(int(features.max()) + 1, 32))
+    opt = torch.optim.Adam(classifier.parameters(), lr=1e-2)
+    classifier, opt = baseline.BACKEND.prepare(classifier, opt)
+    classifier = DistributedDataParallel(classifier, find_unused_parameters=True)
+    baseline.train(classifier, [features, labels, None], torch.nn.BCELoss(), opt, 0, 0)
+
+    # every rank ends the epoch w/ the same weights
+    weights = torch.cat([p.detach().reshape(-1) for p in classifier.module.parameters()])
+    all_weights = [torch.zeros_like(weights) for _ in range(world_size)]
+    dist.all_gather(all_weights, weights)
+    assert all(torch.equal(all_weights[0], x) for x in all_weights)
+
+    # the shards interleave back into the batch list, padded by repeating its 1st batches
+    batches = length_bucketed_batches(get_sequence_lengths(features, 0), baseline.BATCH_SIZE,
+                                      rng=np.random.RandomState(SEED))
+    all_shards = [None] * world_size
+    dist.all_gather_object(all_shards, shard_batches(batches, rank, world_size))
+    assert len({len(x) for x in all_shards}) == 1
+    padded = [all_shards[i % world_size][i // world_size] for i in range(world_size * len(all_shards[0]))]
+    assert all(np.array_equal(x, y) for x, y in zip(padded, batches + batches))
+    assert len(padded) - len(batches) < world_size
+
+    # gathered predictions hold every row exactly once, in the original order
+    row_indices = np.arange(rank, len(features), world_size)
+    gathered = gather_predictions(row_indices.astype(np.float32), row_indices, len(features))
+    preds = baseline.predict_sharded(classifier, features, 0)
+    if rank == 0:
+        assert np.array_equal(gathered, np.arange(len(features), dtype=np.float32))
+        full_preds = predict_probs(classifier.module, features, get_sequence_lengths(features, 0), 16)
+        assert np.abs(preds - full_preds).max() < 1e-6
+    else:
+        assert gathered is None and preds is None
+    dist.destroy_process_group()
+
+
+def test_ddp_train_and_gather():
+    """ classifier_baseline.train/predict_sharded over 2 local gloo ranks """
+    num_rows, vocab_size = 203, 500  # a row and batch count that don't split evenly between the ranks
+    rng = np.random.RandomState(SEED)
+    lengths = rng.randint(1, 17, num_rows)
+    features = np.where(np.arange(16)[None, :] < lengths[:, None], rng.randint(1, vocab_size, (num_rows, 16)), 0)
+    labels = (rng.rand(num_rows) < 0.3).astype(np.float32)
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    mp.spawn(_ddp_worker, args=(2, port, features.astype(np.int32), labels), nprocs=2)
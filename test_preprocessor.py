@@ -0,0 +1,130 @@
+"""
+Tests of the stochastic WordPiece tokenizer and its dropout seeding - run from the repo root: python -m pytest -q
+- segmentations are compared against the per-substring tokenize the StochasticWordpiece replaced (benchmarks.py)
+"""
+import random
+from collections import Counter, defaultdict
+import numpy as np
+from scipy.stats import chi2, chi2_contingency
+from benchmarks import synthetic_words, synthetic_corpus, _per_substring_tokenize
+from preprocessor import StochasticWordpiece, encode_strings
+
+SEED = 1337
+NUM_DRAWS = 2000  # segmentations drawn per tested word
+P_VALUE_THRESHOLD = 1e-3  # chi-square p-value below which 2 segmentation distributions are taken to differ
+
+
+def synthetic_vocab(num_words=3000):
+    """
+    (vocab, words, dead-end words) tuple - vocab of words, ## suffixes of every 3rd word and single letters, so
+    dropped hits fall back to shorter pieces
+    - dead-end words: word + 'AB' + 'CD' w/ ##ABC, ##AB and ##CD pieces - greedy ##ABC is followed by an
+      out-of-vocab D ([UNK] w/o dropout), while ##AB + ##CD completes the word
+    """
+    words = synthetic_words(num_words)
+    vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + list('abcdefghijklmnopqrstuvwxyz') + \
+            ['##' + x for x in 'abcdefghijklmnopqrstuvwxyz'] + words + ['##' + x[len(x) // 2:] for x in words[::3]]
+    rng = np.random.RandomState(SEED)
+    dead_end_words = []
+    for word in words[:50]:
+        first, second = [''.join(rng.choice(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ'), 2)) for _ in range(2)]
+        dead_end_words.append(word + first + second)
+        vocab += ['##' + first + second[0], '##' + first, '##' + second]
+    return {x: i for i, x in enumerate(dict.fromkeys(vocab))}, words, dead_end_words
+
+
+def segmentation_p_value(word_counts_a, word_counts_b, min_count=10):
+    """
+    Chi-square test that 2 tokenizers segment each word w/ the same distribution, summed over the words
+    - segmentations w/ fewer than min_count occurrences (over both) are pooled per word
+    :param word_counts_a: {word: Counter of segmentation tuples}
+    :return: p-value
+    """
+    statistic, dof = 0., 0
+    for word in word_counts_a:
+        counts_a, counts_b = word_counts_a[word], word_counts_b[word]
+        frequent = [x for x in counts_a | counts_b if counts_a[x] + counts_b[x] >= min_count]
+        table = np.array([[counts[x] for x in frequent] + [sum(counts.values()) - sum(counts[x] for x in frequent)]
+                          for counts in [counts_a, counts_b]])
+        table = table[:, table.sum(axis=0) > 0]
+        if table.shape[1] > 1:
+            word_statistic, _, word_dof, _ = chi2_contingency(table, correction=False)
+            statistic, dof = statistic + word_statistic, dof + word_dof
+    assert dof > 0
+    return chi2.sf(statistic, dof)
+
+
+def draw_segmentations(tokenize_fn, words):
+    segmentations = defaultdict(Counter)
+    for word in words:
+        segmentations[word].update(tuple(tokenize_fn(word)) for _ in range(NUM_DRAWS))
+    return segmentations
+
+
+class _SlowWordpieceTokenizer:
+    """
+    Stand-in for a slow BERT tokenizer w/ a tokenize-monkeypatched WordpieceTokenizer (not in recent transformers)
+    - encode() pads/truncates like the HuggingFace call in preprocessor._encode_chunk
+    """
+    is_fast = False
+
+    def __init__(self, vocab, unk_token='[UNK]', max_input_chars_per_word=100):
+        self.vocab, self.unk_token, self.max_input_chars_per_word = vocab, unk_token, max_input_chars_per_word
+
+    def tokenize(self, text):
+        from preprocessor import tokenize
+        return tokenize(self, text)
+
+    def encode(self, text, max_length, **kwargs):
+        ids = [self.vocab['[CLS]']] + [self.vocab[x] for x in self.tokenize(text)][:max_length - 2] + \
+              [self.vocab['[SEP]']]
+        return ids + [self.vocab['[PAD]']] * (max_length - len(ids))
+
+
+def test_no_dropout_matches_greedy_wordpiece():
+    vocab, words, dead_end_words = synthetic_vocab()
+    # out-of-vocab characters exercise the [UNK] fallback
+    corpus = [x + ' ' + x[::-1].upper()[:3] if i % 10 == 0 else x
+              for i, x in enumerate(synthetic_corpus(2000, words=words))] + dead_end_words
+    assert StochasticWordpiece(vocab, dropout=0., seed=SEED).tokenize_batch(corpus) == \
+        [_per_substring_tokenize(vocab, x, dropout=0.) for x in corpus]
+
+
+def test_dropout_segmentation_distribution():
+    """ Same segmentation distribution as a random() call per vocab hit, and the test can tell dropout rates apart """
+    vocab, words, dead_end_words = synthetic_vocab()
+    test_words = sorted(words, key=len)[-50:] + dead_end_words
+    random.seed(SEED)
+    reference = draw_segmentations(lambda x: _per_substring_tokenize(vocab, x, dropout=0.1), test_words)
+
+    same_dropout = draw_segmentations(StochasticWordpiece(vocab, dropout=0.1, seed=SEED).tokenize, test_words)
+    assert segmentation_p_value(reference, same_dropout) > P_VALUE_THRESHOLD
+    other_dropout = draw_segmentations(StochasticWordpiece(vocab, dropout=0.15, seed=SEED).tokenize, test_words)
+    assert segmentation_p_value(reference, other_dropout) < P_VALUE_THRESHOLD
+
+
+def test_dropout_streams_per_seed_epoch_worker():
+    vocab, words, _ = synthetic_vocab()
+    corpus = synthetic_corpus(2000, words=words)
+
+    def stream(epoch, worker):
+        return StochasticWordpiece(vocab, seed=(SEED, epoch, worker)).tokenize_batch(corpus)
+
+    assert stream(0, 0) == stream(0, 0)
+    assert stream(0, 0) != stream(0, 1)
+    assert stream(0, 0) != stream(1, 0)
+    assert stream(0, 1) != stream(1, 0)
+
+
+def test_encode_strings_dropout_seeding():
+    """ Seeding of encode_strings' slow tokenizer pool across workers, epochs and reruns """
+    vocab, words, _ = synthetic_vocab()
+    tokenizer, texts = _SlowWordpieceTokenizer(vocab), synthetic_corpus(2000, words=words)
+
+    # 2 chunks of the same texts land on 2 workers (or 1 worker twice) - either way their dropout draws must differ
+    encoded = encode_strings(texts * 2, tokenizer, 32, chunk_size=len(texts), num_workers=2, seed=(SEED, 0))
+    assert not np.array_equal(encoded[:len(texts)], encoded[len(texts):])
+
+    epochs = [encode_strings(texts, tokenizer, 32, num_workers=1, seed=(SEED, x)) for x in [0, 0, 1]]
+    assert np.array_equal(epochs[0], epochs[1])
+    assert not np.array_equal(epochs[0], epochs[2])
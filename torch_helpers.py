@@ -1,56 +1,474 @@
 import os
+import time
+import queue
+import threading
+import contextlib
+import weakref
 import torch
-import re
+import torch.distributed as dist
+import numpy as np
 from transformers import WEIGHTS_NAME, CONFIG_NAME
+from scoring import fast_roc_auc
+
+
+class MaskedLMCollator:
+    """
+    Masked language modeling inputs/labels: 80% MASK, 10% random, 10% original - fully tensorized
+    - special tokens (incl. padding) are looked up in a boolean table indexed by token ID, built once per tokenizer
+      (and cached per device), instead of per-token Python checks
+    - runs on the device of the inputs, so batches can be masked on the GPU or the CPU
+    - works w/ dynamically padded batches (e.g., trimmed by trim_batch/BatchPrefetcher) - padding is never masked
+    """
+
+    def __init__(self, tokenizer, mlm_prob=0.15):
+        self.mlm_prob = mlm_prob
+        self.mask_token_id = tokenizer.mask_token_id
+        self.vocab_size = len(tokenizer)
+        special_ids = set(tokenizer.all_special_ids) | {tokenizer.pad_token_id}
+        is_special = torch.zeros(max(self.vocab_size, max(special_ids) + 1), dtype=torch.bool)
+        is_special[sorted(special_ids)] = True
+        self.is_special = {is_special.device: is_special}
+
+    def special_tokens_mask(self, inputs):
+        if inputs.device not in self.is_special:
+            self.is_special[inputs.device] = self.is_special[torch.device('cpu')].to(inputs.device)
+        return self.is_special[inputs.device][inputs]
+
+    def __call__(self, inputs, generator=None):
+        """
+        :param inputs: LongTensor of token IDs - overwritten w/ the masked inputs
+        :return: (masked inputs, labels) tuple - labels are -100 for tokens that aren't predicted
+        """
+        labels = inputs.clone()
+        # We sample a few tokens in each sequence for masked-LM training
+        probability_matrix = torch.full(labels.shape, self.mlm_prob, device=inputs.device)
+        probability_matrix.masked_fill_(self.special_tokens_mask(inputs), value=0.0)
+        masked_indices = torch.bernoulli(probability_matrix, generator=generator).bool()
+        labels[~masked_indices] = -100  # We only compute loss on masked tokens
+
+        # 80% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK])
+        random_draws = torch.rand(labels.shape, device=inputs.device, generator=generator)
+        indices_replaced = (random_draws < 0.8) & masked_indices
+        inputs[indices_replaced] = self.mask_token_id
+
+        # 10% of the time, we replace masked input tokens with random word
+        indices_random = (random_draws >= 0.9) & masked_indices
+        random_words = torch.randint(self.vocab_size, labels.shape, dtype=inputs.dtype, device=inputs.device,
+                                     generator=generator)
+        inputs[indices_random] = random_words[indices_random]
+
+        # The rest of the time (10% of the time) we keep the masked input tokens unchanged
+        return inputs, labels
+
+
+_MLM_COLLATORS = weakref.WeakKeyDictionary()  # tokenizer -> {mlm_prob: MaskedLMCollator}
 
 
 def mask_tokens(inputs, tokenizer, mlm_prob=0.15):
     """ Prepare masked tokens inputs/labels for masked language modeling: 80% MASK, 10% random, 10% original. """
-    labels = inputs.clone()
-    # We sample a few tokens in each sequence for masked-LM training
-    # (with probability args.mlm_probability defaults to 0.15 in Bert/RoBERTa)
-    probability_matrix = torch.full(labels.shape, mlm_prob)
-    special_tokens_mask = [
-        tokenizer.get_special_tokens_mask(val, already_has_special_tokens=True) for val in labels.tolist()
-    ]
-    pad_tokens_mask = [[1 if x == tokenizer.pad_token_id else 0 for x in val] for val in labels.tolist()]
-    probability_matrix.masked_fill_(torch.tensor(special_tokens_mask, dtype=torch.bool), value=0.0)
-    probability_matrix.masked_fill_(torch.tensor(pad_tokens_mask, dtype=torch.bool), value=0.0)
-    masked_indices = torch.bernoulli(probability_matrix).bool()
-    labels[~masked_indices] = -100  # We only compute loss on masked tokens
-
-    # 80% of the time, we replace masked input tokens with tokenizer.mask_token ([MASK])
-    indices_replaced = torch.bernoulli(torch.full(labels.shape, 0.8)).bool() & masked_indices
-    inputs[indices_replaced] = tokenizer.mask_token_id
-
-    # 10% of the time, we replace masked input tokens with random word
-    indices_random = torch.bernoulli(torch.full(labels.shape, 0.5)).bool() & masked_indices & ~indices_replaced
-    random_words = torch.randint(len(tokenizer), labels.shape, dtype=torch.long).cuda()
-    inputs[indices_random] = random_words[indices_random]
-
-    # The rest of the time (10% of the time) we keep the masked input tokens unchanged
-    return inputs, labels
+    collators = _MLM_COLLATORS.setdefault(tokenizer, {})
+    if mlm_prob not in collators:
+        collators[mlm_prob] = MaskedLMCollator(tokenizer, mlm_prob)
+    return collators[mlm_prob](inputs)
+
+
+def get_sequence_lengths(features, pad_token_id, chunk_size=100000):
+    """
+    Number of non-pad tokens per row of a right-padded [n, max_len] token ID array
+    - counts in chunks of rows to keep the boolean temporary small for large/memmapped arrays
+    """
+    lengths = np.zeros(len(features), dtype=np.int64)
+    for chunk_start in range(0, len(features), chunk_size):
+        chunk = np.asarray(features[chunk_start:chunk_start + chunk_size])
+        lengths[chunk_start:chunk_start + chunk_size] = (chunk != pad_token_id).sum(axis=1)
+    return np.maximum(lengths, 1)
+
+
+def length_bucketed_batches(lengths, batch_size, bucket_size_mult=50, shuffle=True, rng=None):
+    """
+    Groups row indices into batches of similar sequence length
+    - shuffles all indices, splits them into buckets of batch_size * bucket_size_mult rows,
+      sorts each bucket by length and cuts it into batches
+    - batch order is shuffled again so the epoch isn't ordered by bucket
+    :param rng: np.random.RandomState to shuffle with (default: the global numpy RNG) - distributed ranks pass
+                identically seeded RNGs so they all draw the same batches before sharding them (shard_batches)
+    :return: list of row index arrays
+    """
+    rng = np.random if rng is None else rng
+    indices = rng.permutation(len(lengths)) if shuffle else np.arange(len(lengths))
+    bucket_size = batch_size * bucket_size_mult
+    batches = []
+    for bucket_start in range(0, len(indices), bucket_size):
+        bucket = indices[bucket_start:bucket_start + bucket_size]
+        bucket = bucket[np.argsort(lengths[bucket], kind='stable')]
+        batches.extend(bucket[i:i + batch_size] for i in range(0, len(bucket), batch_size))
+    if shuffle:
+        batches = [batches[i] for i in rng.permutation(len(batches))]
+    return batches
+
+
+def init_distributed(backend='gloo'):
+    """
+    Joins the process group described by the env vars set by torchrun (WORLD_SIZE, RANK, MASTER_ADDR, MASTER_PORT)
+    :return: (rank, world_size) tuple - (0, 1) if the process wasn't launched as one of several
+    """
+    if int(os.environ.get('WORLD_SIZE', 1)) == 1:
+        return 0, 1
+    if not dist.is_initialized():
+        dist.init_process_group(backend)
+    return dist.get_rank(), dist.get_world_size()
+
+
+def get_rank():
+    return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+
+def shard_batches(batches, rank, world_size):
+    """
+    Rank's share of a batch list that's identical on every rank (e.g., length_bucketed_batches w/ the same seed)
+    - every rank gets the same # batches, so that gradient all-reduces stay in lockstep - like DistributedSampler,
+      the batch list is padded up to a multiple of world_size by repeating batches from its start (instead of
+      dropping up to world_size - 1 batches every epoch)
+    """
+    num_padding = -len(batches) % world_size
+    padded_batches = list(batches) + [batches[i % len(batches)] for i in range(num_padding)]
+    return padded_batches[rank::world_size]
+
+
+def gather_predictions(preds, row_indices, num_rows):
+    """
+    Collects the predictions each rank made for its row_indices into one array on rank 0
+    :return: [num_rows] float32 array on rank 0, None on the other ranks
+    """
+    gathered = [(row_indices, preds)]
+    if get_world_size() > 1:
+        gathered = [None] * get_world_size() if get_rank() == 0 else None
+        dist.gather_object((row_indices, preds), gathered, dst=0)
+    if get_rank() != 0:
+        return None
+    all_preds = np.zeros(num_rows, dtype=np.float32)
+    for rank_row_indices, rank_preds in gathered:
+        all_preds[rank_row_indices] = rank_preds
+    return all_preds
+
+
+def trim_batch(features, lengths, batch_indices):
+    """
+    Gathers batch rows trimmed to the longest row in the batch
+    - token IDs keep the dtype of features (e.g., int32) - cast w/ .long() after moving them to the device
+    :return: (token IDs, LongTensor attention mask) tuple of shape [batch, longest row]
+    """
+    batch_lengths = lengths[batch_indices]
+    max_len = int(batch_lengths.max())
+    batch_features = torch.from_numpy(np.ascontiguousarray(features[batch_indices, :max_len]))
+    attention_mask = (torch.arange(max_len)[None, :] < torch.from_numpy(batch_lengths)[:, None]).long()
+    return batch_features, attention_mask
+
+
+class BatchPrefetcher:
+    """
+    Iterates over (token IDs, attention mask[, labels]) batches built ahead of time in a background thread
+    - each batch is gathered by index from the base (or memory-mapped) arrays - no per-epoch copy of the whole array
+    - batch tensors are pinned when CUDA is available, so that .cuda(non_blocking=True) copies are asynchronous
+    :param features: [n, max_len] token ID array
+    :param lengths: [n] sequence lengths (see get_sequence_lengths)
+    :param labels: [n] labels, or None for inference
+    :param batches: list of row index arrays (e.g., from length_bucketed_batches)
+    :param num_prefetch: max number of batches built ahead
+    """
+
+    def __init__(self, features, lengths, labels, batches, num_prefetch=4, pin_memory=None):
+        self.features = features
+        self.lengths = lengths
+        self.labels = labels
+        self.batches = batches
+        self.num_prefetch = num_prefetch
+        self.pin_memory = torch.cuda.is_available() if pin_memory is None else pin_memory
+
+    def __len__(self):
+        return len(self.batches)
+
+    def _build_batch(self, batch_indices):
+        batch = trim_batch(self.features, self.lengths, batch_indices)
+        if self.labels is not None:
+            batch += (torch.from_numpy(np.asarray(self.labels[batch_indices], dtype=np.float32)).unsqueeze(-1),)
+        if self.pin_memory:
+            batch = tuple(x.pin_memory() for x in batch)
+        return batch
+
+    def _worker(self, batch_queue, stop_event):
+        try:
+            for batch_indices in self.batches:
+                batch = self._build_batch(batch_indices)
+                while not stop_event.is_set():
+                    try:
+                        batch_queue.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop_event.is_set():
+                    return
+            batch_queue.put(None)
+        except Exception as e:  # re-raised in the consuming thread
+            batch_queue.put(e)
+
+    def __iter__(self):
+        batch_queue = queue.Queue(maxsize=self.num_prefetch)
+        stop_event = threading.Event()
+        worker = threading.Thread(target=self._worker, args=(batch_queue, stop_event), daemon=True)
+        worker.start()
+        try:
+            while True:
+                batch = batch_queue.get()
+                if batch is None:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop_event.set()
+
+
+class RunningMetrics:
+    """
+    Running loss (and optionally AUC) of a training epoch accumulated on the device
+    - update() only queues device ops, so it never blocks on the device like .item()/.cpu() calls per step would
+    - sync() copies the accumulators to the host - call it every few steps (e.g., to refresh a progress bar)
+    :param track_auc: keep the (detached) predictions and labels of every step to compute the running AUC on sync()
+    """
+
+    def __init__(self, device, track_auc=False):
+        self.loss_sum = torch.zeros((), dtype=torch.float64, device=device)
+        self.num_samples = 0
+        self.track_auc = track_auc
+        self.preds = []
+        self.labels = []
+
+    def update(self, loss, batch_size, preds=None, labels=None):
+        """ :param loss: mean loss tensor of the batch (unscaled by gradient accumulation) """
+        self.loss_sum += loss.detach().double() * batch_size
+        self.num_samples += batch_size
+        if self.track_auc and preds is not None:
+            self.preds.append(preds.detach().float().reshape(-1))
+            self.labels.append(labels.detach().float().reshape(-1))
+
+    def sync(self):
+        """
+        - w/ several distributed ranks, loss/samples are summed across ranks (call on every rank) - AUC is rank-local
+        :return: {'loss': mean loss, 'samples': # samples[, 'auc': running AUC]} dict
+        """
+        loss_sum, num_samples = self.loss_sum.item(), self.num_samples
+        if get_world_size() > 1:
+            totals = torch.tensor([loss_sum, num_samples], dtype=torch.float64)
+            dist.all_reduce(totals)
+            loss_sum, num_samples = totals[0].item(), int(totals[1].item())
+        metrics = {'loss': loss_sum / max(1, num_samples), 'samples': num_samples}
+        if self.track_auc and self.preds:
+            self.preds, self.labels = [torch.cat(self.preds)], [torch.cat(self.labels)]
+            labels = self.labels[0].cpu().numpy()
+            if 0 < labels.round().sum() < len(labels):
+                metrics['auc'] = fast_roc_auc(labels, self.preds[0].cpu().numpy())
+        return metrics
+
+
+class TrainingBackend:
+    """
+    Device placement, mixed precision and optimizer stepping of a training loop
+    - CUDA w/ apex: apex AMP (opt_level O1) - pass the apex.amp module as apex_amp
+    - CUDA w/o apex: torch.autocast float16 w/ a GradScaler
+    - CPU: torch.autocast bfloat16 - no loss scaling needed since bfloat16 has the exponent range of float32
+    - losses should be computed from .float() predictions outside of autocast() (BCELoss isn't autocast-safe)
+    - output heads should disable autocast themselves (see classifier_baseline.ClassifierHead) to keep fp32
+      probabilities
+    :param mixed_precision: False trains in float32 on any device
+    """
+
+    def __init__(self, device, mixed_precision=True, apex_amp=None):
+        self.device = torch.device(device)
+        self.mixed_precision = mixed_precision
+        self.apex_amp = apex_amp if mixed_precision and self.device.type == 'cuda' else None
+        self.grad_scaler = None
+        if mixed_precision and self.apex_amp is None and self.device.type == 'cuda':
+            self.grad_scaler = torch.cuda.amp.GradScaler()
+        self.autocast_dtype = torch.float16 if self.device.type == 'cuda' else torch.bfloat16
+
+    def prepare(self, model, opt):
+        """ Moves the model to the device (params are moved in place, so opt can be created beforehand) """
+        model = model.to(self.device)
+        if self.apex_amp is not None:
+            self.apex_amp.register_float_function(torch, 'sigmoid')
+            model, opt = self.apex_amp.initialize(model, opt, opt_level='O1', verbosity=0)
+        return model, opt
+
+    def to_device(self, x):
+        return x.to(self.device, non_blocking=True)
+
+    def autocast(self):
+        if not self.mixed_precision or self.apex_amp is not None:
+            return contextlib.nullcontext()
+        return torch.autocast(self.device.type, dtype=self.autocast_dtype)
+
+    def backward(self, loss, opt):
+        if self.apex_amp is not None:
+            with self.apex_amp.scale_loss(loss, opt) as scaled_loss:
+                scaled_loss.backward()
+        elif self.grad_scaler is not None:
+            self.grad_scaler.scale(loss).backward()
+        else:
+            loss.backward()
+
+    def step(self, opt):
+        if self.grad_scaler is not None:
+            self.grad_scaler.step(opt)
+            self.grad_scaler.update()
+        else:
+            opt.step()
+        opt.zero_grad()
+
+    def synchronize(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+
+def predict_probs(model, features, lengths, batch_size, device='cpu'):
+    """
+    Device-agnostic batched inference over length-sorted rows
+    - runs under torch.inference_mode (torch.no_grad on torch versions without it)
+    :return: float32 predictions scattered back to the original row order
+    """
+    inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+    sorted_indices = np.argsort(lengths, kind='stable')
+    batches = [sorted_indices[i:i + batch_size] for i in range(0, len(sorted_indices), batch_size)]
+    preds = np.zeros(len(sorted_indices), dtype=np.float32)
+    model.eval()
+    with inference_mode():
+        loader = BatchPrefetcher(features, lengths, None, batches, pin_memory=torch.device(device).type == 'cuda')
+        for batch_indices, (batch_features, batch_mask) in zip(batches, loader):
+            batch_preds = model(batch_features.to(device, non_blocking=True).long(),
+                                batch_mask.to(device, non_blocking=True))
+            preds[batch_indices] = batch_preds.float().cpu().numpy().reshape(-1)
+    return preds
+
+
+def peak_tensor_memory_mb():
+    """ Peak memory allocated to CUDA tensors in MB (None on CPU-only machines - see profiling.peak_rss_mb) """
+    if not torch.cuda.is_available():
+        return None
+    return torch.cuda.max_memory_allocated() / 2 ** 20
+
+
+def step_profiler(trace_dir, profile_steps):
+    """
+    torch.profiler capture of a window of training steps, saved as a TensorBoard trace to trace_dir
+    - call .start() before the 1st step, .step() after every step and .stop() at the end
+    :param profile_steps: (first step, last step) tuple of 1-based steps to capture, or None
+    :return: torch.profiler.profile or None if profile_steps is None
+    """
+    if profile_steps is None:
+        return None
+    first_step, last_step = profile_steps
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    wait = max(0, first_step - 2)  # warm up on the step before the window if there's one
+    return torch.profiler.profile(activities=activities,
+                                  schedule=torch.profiler.schedule(wait=wait,
+                                                                   warmup=first_step - 1 - wait,
+                                                                   active=last_step - first_step + 1,
+                                                                   repeat=1),
+                                  on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+                                  record_shapes=True,
+                                  profile_memory=True)
+
+
+def configure_cpu_threads(num_threads=None, num_interop_threads=None, cpu_affinity=None):
+    """
+    Sets torch intra-op/inter-op thread pools - call before any training/inference work
+    (torch refuses to resize the inter-op pool once it's been used)
+    :param cpu_affinity: optional list of CPU ids to pin the process (and the threads it starts) to -
+                         e.g., the cores of a single NUMA node
+    """
+    if cpu_affinity is not None:
+        os.sched_setaffinity(0, cpu_affinity)
+        print('pinned to CPUs: {}'.format(sorted(os.sched_getaffinity(0))))
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads is not None:
+        torch.set_num_interop_threads(num_interop_threads)
+    print('torch threads: {} intra-op, {} inter-op'.format(torch.get_num_threads(),
+                                                           torch.get_num_interop_threads()))
+
+
+def quantize_linear_layers(model):
+    """ Dynamic int8 quantization of all Linear layers (weights int8, activations quantized on the fly) """
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def autotune_batch_size(model, features, lengths, candidates=(8, 16, 32, 64, 128, 256),
+                        sample_size=2048, device='cpu'):
+    """
+    Picks the inference batch size w/ the highest rows/sec on a random sample of rows
+    :return: best batch size
+    """
+    sample = np.sort(np.random.RandomState(0).choice(len(lengths), min(sample_size, len(lengths)), replace=False))
+    sample_features, sample_lengths = np.asarray(features[sample]), lengths[sample]
+    best_batch_size, best_throughput = candidates[0], 0.
+    for batch_size in candidates:
+        predict_probs(model, sample_features[:batch_size], sample_lengths[:batch_size], batch_size, device)  # warm-up
+        start_time = time.time()
+        predict_probs(model, sample_features, sample_lengths, batch_size, device)
+        throughput = len(sample) / (time.time() - start_time)
+        print('Batch size {}: {:.1f} rows/sec'.format(batch_size, throughput))
+        if throughput > best_throughput:
+            best_batch_size, best_throughput = batch_size, throughput
+    return best_batch_size
+
 
 class EMA:
     """
-    Tracks registered param data values with shadow variable that does
-    exponential moving average of the value on update
+    Exponential moving average of all the (trainable) parameters of a model
+    - 1 shadow copy of the params, updated in place w/ a multi-tensor lerp - no per-step allocations
+    - update() is meant to be called after every optimizer step, but only averages every update_every calls
+      (w/ decay ** update_every, so the averaging horizon in steps stays the same)
+    - average_parameters() swaps the EMA weights into the model for evaluation/prediction and swaps the live
+      weights back on exit - the swap exchanges tensors, it doesn't copy them
     """
 
-    def __init__(self, decay):
+    def __init__(self, model, decay, update_every=1):
+        self.params = [p for p in getattr(model, 'module', model).parameters() if p.requires_grad]
+        self.shadow = [p.detach().clone() for p in self.params]
         self.decay = decay
-        self.shadow = {}
+        self.update_every = update_every
+        self.num_calls = 0
 
-    def register(self, name, val):
-        self.shadow[name] = val.clone()
+    @torch.no_grad()
+    def update(self):
+        self.num_calls += 1
+        if self.num_calls % self.update_every != 0:
+            return
+        weight = 1. - self.decay ** self.update_every
+        live = [p.data for p in self.params]
+        if hasattr(torch, '_foreach_lerp_'):
+            torch._foreach_lerp_(self.shadow, live, weight)
+        else:  # shadow += weight * (live - shadow)
+            torch._foreach_mul_(self.shadow, 1. - weight)
+            torch._foreach_add_(self.shadow, live, alpha=weight)
 
-    def get(self, name):
-        return self.shadow[name]
+    def _swap(self):
+        for i, p in enumerate(self.params):
+            p.data, self.shadow[i] = self.shadow[i], p.data
 
-    def update(self, name, x):
-        assert name in self.shadow
-        new_average = (1.0 - self.decay) * x + self.decay * self.shadow[name]
-        self.shadow[name] = new_average.clone()
+    @contextlib.contextmanager
+    def average_parameters(self):
+        self._swap()
+        try:
+            yield
+        finally:
+            self._swap()
 
 
 def save_model(output_dir, model, config, tokenizer):
@@ -67,26 +485,42 @@ def save_model(output_dir, model, config, tokenizer):
 
 
 def layerwise_lr_decay(model, base_lr, decay_factor):
-    # layerwise (at transformer block level) decay of LR
-    decayed_lr_params = []
-    max_num = None
-    for name, param in reversed(list(model.named_parameters())):
-        try:
-            if 'base_model' not in name:  # classifier layers
-                block_lr = base_lr
-            else:
-                if 'layer' in name:
-                    block_num = int(re.findall(r'\d+', name)[0]) + 1
-                    if max_num is None:
-                        max_num = block_num
-                else:  # typically embeddings
-                    block_num = 0
-
-                block_lr = base_lr * decay_factor ** (max_num - block_num)
-        except:  # for base_model without number that aren't embeddings - pooler at the head
-            block_lr = base_lr
-
-        # print(name, block_lr)
-        decayed_lr_params.append({'params': param,
-                                  'lr': block_lr})
-    return decayed_lr_params
+    """
+    Optimizer param groups w/ layerwise (at transformer block level) decay of LR - 1 group per distinct LR
+    - block N of the base model is the 1st integer component of the param name (e.g., base_model.encoder.layer.N.*)
+    - top block and the layers after it (pooler, classifier head outside base_model) get base_lr,
+      each block below gets decay_factor times the LR of the block above, embeddings get the lowest LR
+    :return: list of {'params': [...], 'lr': LR} dicts, from the embeddings up to the head
+    """
+    block_params = {}  # block num (0 = embeddings, None = head) -> params
+    seen_block = False
+    for name, param in model.named_parameters():
+        block_num = None
+        if name.startswith('base_model.'):
+            block_num = next((int(x) + 1 for x in name.split('.') if x.isdigit()), None)
+            if block_num is not None:
+                seen_block = True
+            elif not seen_block:  # base model params before the 1st block - typically embeddings
+                block_num = 0
+            # else: base model params after the last block (e.g., the pooler) train w/ the head
+        block_params.setdefault(block_num, []).append(param)
+
+    max_num = max([x for x in block_params if x is not None], default=0)
+    return [{'params': block_params[block_num],
+             'lr': base_lr if block_num is None else base_lr * decay_factor ** (max_num - block_num)}
+            for block_num in sorted(block_params, key=lambda x: max_num + 1 if x is None else x)]
+
+
+def multi_tensor_adam(params, lr, device='cpu'):
+    """
+    Adam that updates all tensors of a param group w/ multi-tensor kernels instead of a Python loop over tensors
+    - fused on CUDA, foreach elsewhere - falls back to the default implementation on torch versions w/o either
+    :param params: params or param groups (e.g., from layerwise_lr_decay)
+    """
+    params = list(params)
+    try:
+        if torch.device(device).type == 'cuda':
+            return torch.optim.Adam(params, lr=lr, fused=True)
+        return torch.optim.Adam(params, lr=lr, foreach=True)
+    except (TypeError, RuntimeError):
+        return torch.optim.Adam(params, lr=lr)